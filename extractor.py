@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Library interface to extract Sentinel-3 data for batches of sites, reusing
+the open products from one call to the other:
+
+    with Extractor(max_products=4) as ext:
+        bands = ext.extract_bands(scene, coords, ["Oa01_radiance", "SZA"])
+        snow = ext.extract_snow(scene, coords, pollution=True)
+
+The products are disposed when they are evicted from the cache, or when the
+context is exited (or close() is called).
+Written by Maxim Lamare.
+"""
+from pathlib import Path
+
+from run_metrics import EventLog, StageTimer
+from scene_utils import product_info
+
+
+class Extractor(object):
+    """Extract data from Sentinel-3 scenes.
+
+    Args:
+        max_products (int): Maximum number of products kept open
+        event_log (EventLog): Log of the processing failures, written to
+            failed_log.jsonl if None
+        timer (StageTimer): Accumulates the time spent in each stage
+            (optional)
+        position_cache (PixelPositionCache): Cache of the pixel positions of
+            the sites, reused for the scenes of the same ground track
+            (optional)
+    """
+
+    def __init__(
+        self,
+        max_products=4,
+        event_log=None,
+        timer=None,
+        position_cache=None,
+    ):
+        # Import snappy only when an extractor is created
+        from snappy_funcs import ProductCache
+
+        self.products = ProductCache(max_products)
+        if event_log is None:
+            event_log = EventLog(Path("failed_log.jsonl"))
+        self.event_log = event_log
+        self.timer = timer if timer is not None else StageTimer()
+        self.position_cache = position_cache
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Dispose all the open products and write the logged events."""
+        self.products.clear()
+        self.event_log.flush()
+
+    def extract_bands(
+        self, scene, coords, band_names, s3_instrument=None, slstr_res="auto"
+    ):
+        """Extract data from Sentinel-3 bands.
+
+        Args:
+            scene (PosixPath): Path to a S3 scene (.SEN3 folder or its
+                xfdumanifest.xml file)
+            coords (list): List of coordinates (name, lat, lon) to extract
+            band_names (list): List of band (TiePointGrid or mask) names
+            s3_instrument (str): Sentinel-3 instrument name (OLCI or SLSTR),
+                guessed from the scene name if None
+            slstr_res (str): SLSTR reader resolution (auto, 500 or 1000)
+
+        Returns:
+            (dict): band values for each site (name) located in the scene
+        """
+        from snappy_funcs import getS3bands
+
+        s3path = scene_manifest(scene)
+        if s3_instrument is None:
+            s3_instrument = product_info(s3path.parent.name)["instrument"]
+
+        band_values = getS3bands(
+            str(s3path),
+            coords,
+            band_names,
+            self.event_log,
+            s3_instrument,
+            slstr_res if s3_instrument == "SLSTR" else None,
+            timer=self.timer,
+            products=self.products,
+            position_cache=self.position_cache,
+        )
+        self.event_log.flush()
+
+        return band_values
+
+    def extract_snow(
+        self,
+        scene,
+        coords,
+        pollution=False,
+        delta_pol=0.1,
+        gains=False,
+        dem_prods=False,
+        cloud_screen=False,
+        variables=None,
+        engine="snap",
+        toa_engine="snap",
+        threads=1,
+    ):
+        """Extract the S3 SNOW processor outputs.
+
+        Args:
+            scene (PosixPath): Path to a S3 OLCI scene (.SEN3 folder or its
+                xfdumanifest.xml file)
+            coords (list): List of coordinates (name, lat, lon) to extract
+            pollution (bool): S3 SNOW dirty snow flag
+            delta_pol (float): Delta value to consider dirty snow
+            gains (bool): Consider vicarious calibration gains
+            dem_prods (bool): Run the S3 Snow DEM slope plugin
+            cloud_screen (bool): Skip the S3 SNOW processor for the cloudy
+                pixels
+            variables (list): Variables to compute (see
+                output_utils.SNOW_VARIABLES), all if None
+            engine (str): Snow properties retrieval: "snap" (S3 SNOW
+                processor) or "numpy" (snow_engine)
+            toa_engine (str): TOA reflectance conversion: "snap" (Rad2Refl
+                operator) or "numpy" (all sites at once)
+            threads (int): Number of sites processed concurrently with the
+                S3 SNOW processor
+
+        Returns:
+            (dict): S3 SNOW outputs for each site (name) located in the scene
+        """
+        from snappy_funcs import getS3values
+
+        snow_values = getS3values(
+            str(scene_manifest(scene)),
+            coords,
+            pollution,
+            delta_pol,
+            gains,
+            dem_prods,
+            self.event_log,
+            timer=self.timer,
+            products=self.products,
+            cloud_screen=cloud_screen,
+            variables=variables,
+            engine=engine,
+            toa_engine=toa_engine,
+            position_cache=self.position_cache,
+            threads=threads,
+        )
+        self.event_log.flush()
+
+        return snow_values
+
+
+def scene_manifest(scene):
+    """Get the path to the xfdumanifest.xml file of a scene.
+
+    Args:
+        scene (PosixPath): Path to a S3 scene (.SEN3 folder or its
+            xfdumanifest.xml file)
+
+    Returns:
+        (PosixPath): path to the xfdumanifest.xml file
+    """
+    scene = Path(scene)
+    if scene.name == "xfdumanifest.xml":
+        return scene
+
+    return scene / "xfdumanifest.xml"
@@ -9,12 +9,45 @@ https://step.esa.int/main/toolboxes/snap/
 Written by Maxim Lamare.
 """
 import sys
+import json
+import os
 from argparse import ArgumentParser
 from pathlib import Path
-from snappy_funcs import open_prod
+from scene_utils import list_scenes, product_info, scene_band_names
 
 
-def main(sat_image, out_file,):
+def get_band_names(sat_image, snap=False):
+    """List the bands of a satellite product.
+
+    Args:
+        sat_image (PosixPath): Path to an S3 image
+        snap (bool): Open the product with SNAP instead of reading the
+            manifest and NetCDF headers
+
+    Returns:
+        (tuple): band names (list), TiePointGrid names (list), mask names\
+                 (list)
+    """
+    if not snap:
+        return scene_band_names(sat_image)
+
+    # Import snappy only when needed: starting the JVM takes time
+    from snappy_funcs import open_prod, dispose_prod
+
+    # Open SNAP product with "OLCI" option to get default reader
+    # Can be used with any satellite image
+    prod = open_prod(str(sat_image), "OLCI", None)
+
+    band_names = list(prod.getBandNames())
+    tpg_names = list(prod.getTiePointGridNames())
+    mask_names = list(prod.getMaskGroup().getNodeNames())
+
+    dispose_prod(prod)
+
+    return band_names, tpg_names, mask_names
+
+
+def main(sat_image, out_file, snap=False):
     """Satellite band list.
 
     The script returns a list of bands that are available in
@@ -26,11 +59,10 @@ def main(sat_image, out_file,):
 
     sat_fold (PosixPath): Path to an S3 images
     out_file (PosixPath): Path to a file (will be created) to save the list
+    snap (bool): Open the product with SNAP (slow) instead of reading the
+        manifest and NetCDF headers
     """
-
-    # Open SNAP product with "OLCI" option to get default reader
-    # Can be used with any satellite image
-    prod = open_prod(str(sat_image), "OLCI", None)
+    band_names, tpg_names, mask_names = get_band_names(sat_image, snap)
 
     # Parse name of image
     print("File: %s/%s" % (sat_image.parents[0].name,
@@ -38,7 +70,6 @@ def main(sat_image, out_file,):
 
     # Fetch all bands
     print("\nAvailable bands: ")
-    band_names = list(prod.getBandNames())
     if band_names:
         print(band_names)
     else:
@@ -46,7 +77,6 @@ def main(sat_image, out_file,):
 
     # Fetch TiePointGrids
     print("\nAvailable TiePointGrids: ")
-    tpg_names = list(prod.getTiePointGridNames())
     if tpg_names:
         print(tpg_names)
     else:
@@ -54,7 +84,6 @@ def main(sat_image, out_file,):
 
     # Fetch mask names
     print("\nAvailable masks: ")
-    mask_names = list(prod.getMaskGroup().getNodeNames())
     if mask_names:
         print(mask_names)
     else:
@@ -64,24 +93,109 @@ def main(sat_image, out_file,):
     if out_file:
         with open(str(out_file), 'w') as f:
             f.write("File path: %s\n" % str(sat_image.resolve()))
-            f.write("\nBand names:\n")
-            if band_names:
-                for item in band_names:
-                    f.write("%s\n" % item)
-            else:
-                f.write("No Bands found!\n")
-            f.write("\nTiePointGrid names:\n")
-            if tpg_names:
-                for item in tpg_names:
-                    f.write("%s\n" % item)
-            else:
-                f.write("No TiePointGrids found!\n")
-            f.write("\nMask names:\n")
-            if mask_names:
-                for item in mask_names:
-                    f.write("%s\n" % item)
-            else:
-                f.write("No Masks found!\n")
+            write_band_list(f, band_names, tpg_names, mask_names)
+
+
+def write_band_list(f, band_names, tpg_names, mask_names):
+    """Write the band, TiePointGrid and mask names to an open text file."""
+    f.write("\nBand names:\n")
+    if band_names:
+        for item in band_names:
+            f.write("%s\n" % item)
+    else:
+        f.write("No Bands found!\n")
+    f.write("\nTiePointGrid names:\n")
+    if tpg_names:
+        for item in tpg_names:
+            f.write("%s\n" % item)
+    else:
+        f.write("No TiePointGrids found!\n")
+    f.write("\nMask names:\n")
+    if mask_names:
+        for item in mask_names:
+            f.write("%s\n" % item)
+    else:
+        f.write("No Masks found!\n")
+
+
+def inventory(sat_fold, out_file, cache_file, snap=False):
+    """Band inventory of an archive.
+
+    List the bands available for each product type (and processing baseline)
+    found in a folder of S3 images. Only one scene per product type and
+    baseline is read, and the result is stored in a cache file so that the
+    following runs only read the scenes of new product types or baselines.
+
+    Args:
+        sat_fold (PosixPath): Path to a folder containing S3 images
+        out_file (PosixPath): Path to a file (will be created) to save the\
+                              inventory
+        cache_file (PosixPath): Path to the json file caching the band lists\
+                                of each mode (manifest or SNAP)
+        snap (bool): Open the products with SNAP instead of reading the
+            manifest and NetCDF headers
+    """
+    # Load the band lists found in previous runs, kept apart for each mode
+    # (SNAP and the manifest don't list the same bands). The untagged entries
+    # of older caches are dropped.
+    if cache_file.is_file():
+        with open(str(cache_file), "r") as f:
+            cache = json.load(f)
+    else:
+        cache = {}
+    cache = {x: cache[x] for x in ("manifest", "snap") if x in cache}
+    mode_cache = cache.setdefault("snap" if snap else "manifest", {})
+
+    # Group the scenes by product type and baseline
+    product_scenes = {}
+    for sat_image in list_scenes(sat_fold):
+        info = product_info(sat_image.name)
+        key = "%s_%s" % (info["product_type"], info["baseline"])
+        product_scenes.setdefault(key, []).append(sat_image)
+
+    # Read one scene per product type/baseline not found in the cache
+    for key in sorted(product_scenes):
+        if key not in mode_cache:
+            band_names, tpg_names, mask_names = get_band_names(
+                product_scenes[key][0], snap
+            )
+            mode_cache[key] = {
+                "bands": band_names,
+                "tpgs": tpg_names,
+                "masks": mask_names,
+            }
+
+        print(
+            "%s: %s scenes, %s bands, %s TiePointGrids, %s masks"
+            % (
+                key,
+                len(product_scenes[key]),
+                len(mode_cache[key]["bands"]),
+                len(mode_cache[key]["tpgs"]),
+                len(mode_cache[key]["masks"]),
+            )
+        )
+
+    # Update the cache
+    os.makedirs(str(cache_file.parent), exist_ok=True)
+    with open(str(cache_file), "w") as f:
+        json.dump(cache, f, indent=1)
+
+    # If a file is specified, write to file
+    if out_file:
+        with open(str(out_file), 'w') as f:
+            f.write("Archive path: %s\n" % str(sat_fold.resolve()))
+            for key in sorted(product_scenes):
+                f.write(
+                    "\nProduct type: %s (%s scenes)\n"
+                    % (key, len(product_scenes[key]))
+                )
+                write_band_list(
+                    f,
+                    mode_cache[key]["bands"],
+                    mode_cache[key]["tpgs"],
+                    mode_cache[key]["masks"],
+                )
 
 
 if __name__ == "__main__":
@@ -103,7 +217,8 @@ if __name__ == "__main__":
             "--insat",
             metavar="Satellite image file",
             required=True,
-            help="Path to a satellite image.",
+            help="Path to a satellite image, or to a folder of satellite"
+            " images in archive mode.",
         )
         parser.add_argument(
             "-f",
@@ -115,6 +230,32 @@ if __name__ == "__main__":
                  " written",
         )
 
+        parser.add_argument(
+            "-a",
+            "--archive",
+            action="store_true",
+            help="Archive mode: list the bands available for each product"
+            " type and baseline found in the input folder.",
+        )
+        parser.add_argument(
+            "-k",
+            "--cache",
+            metavar="Cache file",
+            required=False,
+            default=os.path.join(
+                os.path.expanduser("~"), ".s3_extract", "band_inventory.json"
+            ),
+            help="Path to the json file caching the band lists per product"
+            " type in archive mode.",
+        )
+        parser.add_argument(
+            "-s",
+            "--snap",
+            action="store_true",
+            help="Open the products with SNAP (slow) instead of reading the"
+            " manifest and NetCDF headers.",
+        )
+
         input_args = parser.parse_args()
 
         # Path object of output file
@@ -124,7 +265,16 @@ if __name__ == "__main__":
             infile = None
 
         # Run main
-        main(
-            Path(input_args.insat),
-            infile,
-        )
+        if input_args.archive:
+            inventory(
+                Path(input_args.insat),
+                infile,
+                Path(input_args.cache),
+                input_args.snap,
+            )
+        else:
+            main(
+                Path(input_args.insat),
+                infile,
+                input_args.snap,
+            )
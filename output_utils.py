@@ -0,0 +1,665 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Functions to write and sort the per-site output files (no SNAP required)."""
+import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+from datetime import datetime
+from multiprocessing import Pool
+import pandas as pd
+
+# Acquisition date and platform columns, common to all outputs
+DT_COLUMNS = [
+    "year",
+    "month",
+    "day",
+    "hour",
+    "minute",
+    "second",
+    "dayofyear",
+    "platform",
+]
+
+# Column order of the S3 SNOW outputs, before the spectral columns
+SNOW_COLUMNS = DT_COLUMNS + [
+    "grain_diameter",
+    "snow_specific_area",
+    "ndsi",
+    "ndbi",
+    "auto_cloud",
+    "sza",
+    "vza",
+    "saa",
+    "vaa",
+]
+
+# Variables of the S3 SNOW outputs that can be selected: the single value
+# outputs, and the groups of bands (broadband albedos, spectral planar
+# albedos, rBRR and TOA reflectances). The geometry is always written.
+SNOW_VARIABLES = [
+    "grain_diameter",
+    "snow_specific_area",
+    "ndsi",
+    "ndbi",
+    "auto_cloud",
+    "albedo_bb",
+    "spectral_planar",
+    "rBRR",
+    "reflectance",
+]
+
+# Columns added by the S3SNOW DEM plugin
+DEM_COLUMNS = ["altitude", "slope", "aspect", "elevation_variance"]
+
+# No data value written in the output files
+NA_REP = {"snow": -999, "bands": "NA"}
+
+
+def natural_keys(text):
+    """Sort strings naturally.
+
+    Sort a list of strings in the natural sorting order.
+
+    Args:
+        text (str): Input text to be sorted
+
+    Returns:
+        (list): list of naturally sorted objects
+    """
+
+    def atoi(text):
+        return int(text) if text.isdigit() else text
+
+    return [atoi(c) for c in re.split(r"(\d+)", text)]
+
+
+def sort_snow_columns(temp_df, dem_prods, variables=None):
+    """Order the columns of a S3 SNOW output dataframe.
+
+    Args:
+        temp_df (pandas.DataFrame): S3 SNOW outputs of a site
+        dem_prods (bool): The S3 Snow DEM slope plugin was run
+        variables (list): Selected variables (see SNOW_VARIABLES), all if\
+                          None
+
+    Returns:
+        (list): ordered column names
+    """
+    # Set column order for sorted files, without the unselected variables
+    columns = [
+        x
+        for x in SNOW_COLUMNS
+        if variables is None
+        or x not in SNOW_VARIABLES
+        or x in variables
+    ]
+
+    # Parameter set of a sweep, after the date and platform columns
+    if "param_set" in temp_df.columns:
+        columns.insert(len(DT_COLUMNS), "param_set")
+
+    # If the S3SNOW DEM plugin is run, add columns to the list
+    if dem_prods:
+        columns += DEM_COLUMNS
+
+    # Get all rBRR, albedo and reflectance bands and natural sort
+    alb_columns = [x for x in temp_df.columns if "albedo_bb" in x]
+    alb_columns.sort(key=natural_keys)
+    rbrr_columns = [x for x in temp_df.columns if "BRR" in x]
+    rbrr_columns.sort(key=natural_keys)
+    planar_albedo_columns = [
+        x for x in temp_df.columns if "spectral_planar" in x
+    ]
+    planar_albedo_columns.sort(key=natural_keys)
+    rtoa_columns = [x for x in temp_df.columns if "reflectance" in x]
+    rtoa_columns.sort(key=natural_keys)
+
+    return (
+        columns
+        + alb_columns
+        + rtoa_columns
+        + rbrr_columns
+        + planar_albedo_columns
+    )
+
+
+def sort_band_columns(temp_df):
+    """Order the columns of a band extraction dataframe.
+
+    Args:
+        temp_df (pandas.DataFrame): band values of a site
+
+    Returns:
+        (list): ordered column names
+    """
+    # Get all extracted bands and natural sort them
+    band_columns = [x for x in temp_df.columns if x not in DT_COLUMNS]
+    band_columns.sort(key=natural_keys)
+
+    return DT_COLUMNS + band_columns
+
+
+def append_site_csv(output_file, site_df, na_rep):
+    """Append rows to the temporary csv file of a site.
+
+    The rows don't always have the same columns (e.g. only the cloud flag and
+    the geometry are written for the cloudy pixels). The columns of the new
+    rows are aligned to the header of the file, and the file is rewritten
+    with a new header if the rows contain new columns.
+
+    Args:
+        output_file (PosixPath): Path to the temporary csv file
+        site_df (pandas.DataFrame): Rows to append
+        na_rep (str): No data value written in the file
+    """
+    # Save header if first write
+    if not output_file.is_file():
+        site_df.to_csv(
+            str(output_file), mode="a", na_rep=na_rep, header=True, index=False
+        )
+        return
+
+    with open(str(output_file), "r") as f:
+        header = next(csv.reader(f))
+
+    if all(x in header for x in site_df.columns):
+        site_df.reindex(columns=header).to_csv(
+            str(output_file),
+            mode="a",
+            na_rep=na_rep,
+            header=False,
+            index=False,
+        )
+    else:
+        # New columns: rewrite the file with all the columns
+        file_df = pd.read_csv(
+            str(output_file), sep=",", dtype=str, keep_default_na=False
+        )
+        columns = header + [x for x in site_df.columns if x not in header]
+        pd.concat(
+            [
+                file_df.reindex(columns=columns),
+                site_df.reindex(columns=columns),
+            ]
+        ).to_csv(str(output_file), na_rep=na_rep, header=True, index=False)
+
+
+def finalize_site(out_fold, site, kind, dem_prods=False, variables=None):
+    """Sort the temporary file of a site.
+
+    Read the temporary csv file of a site, order the columns and the dates,
+    and write the final csv file. The temporary file is then removed.
+
+    Args:
+        out_fold (PosixPath): Path to the output folder
+        site (str): Name of the site
+        kind (str): "snow" for S3 SNOW outputs, "bands" for band extractions
+        dem_prods (bool): The S3 Snow DEM slope plugin was run ("snow" only)
+        variables (list): Selected S3 SNOW variables, all if None ("snow"\
+                          only)
+
+    Returns:
+        (str): name of the site, or None if there was no temporary file
+    """
+    # Read the csv file to a pandas dataframe
+    csv_name = "%s_tmp.csv" % site
+    incsv = out_fold / csv_name
+
+    if not incsv.is_file():
+        return None
+
+    temp_df = pd.read_csv(str(incsv), sep=",")
+
+    # Reorder dataframe colmuns (the columns of a site with only cloudy
+    # pixels are missing)
+    if kind == "snow":
+        temp_df = temp_df.reindex(
+            columns=sort_snow_columns(temp_df, dem_prods, variables)
+        )
+    else:
+        temp_df = temp_df[sort_band_columns(temp_df)]
+
+    # Reorder dates (stable sort: the rows of the parameter sets of a sweep
+    # stay in the order of the sets)
+    temp_df["dt"] = pd.to_datetime(
+        temp_df[["year", "month", "day", "hour", "minute", "second"]]
+    )
+    temp_df.set_index("dt", inplace=True)
+    temp_df.sort_index(kind="mergesort", inplace=True)
+
+    # Save reordered file
+    fname = "%s.csv" % site
+    output_file = out_fold / fname
+
+    # Save dataframe to the csv file
+    temp_df.to_csv(
+        str(output_file),
+        mode="a",
+        na_rep=NA_REP[kind],
+        header=True,
+        index=False,
+    )
+    incsv.unlink()  # Remove temporary file
+
+    return site
+
+
+def _finalize_site_args(args):
+    """Unpack the arguments of finalize_site (for Pool.imap)."""
+    return finalize_site(*args)
+
+
+def finalize_sites(
+    out_fold, sites, kind, dem_prods=False, processes=1, variables=None
+):
+    """Sort the temporary files of a list of sites.
+
+    With more than one process, the sites are sorted in a process pool. Each
+    worker reads a single site at a time, and the workers are renewed
+    regularly, so that the memory used stays bounded.
+
+    Args:
+        out_fold (PosixPath): Path to the output folder
+        sites (list): Names of the sites
+        kind (str): "snow" for S3 SNOW outputs, "bands" for band extractions
+        dem_prods (bool): The S3 Snow DEM slope plugin was run ("snow" only)
+        processes (int): Number of processes
+        variables (list): Selected S3 SNOW variables, all if None ("snow"\
+                          only)
+
+    Returns:
+        (list): names of the sites for which a file was written
+    """
+    tasks = [(out_fold, site, kind, dem_prods, variables) for site in sites]
+
+    if processes > 1:
+        pool = Pool(processes, maxtasksperchild=100)
+        try:
+            done = list(pool.imap_unordered(_finalize_site_args, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        done = [_finalize_site_args(x) for x in tasks]
+
+    return [x for x in done if x is not None]
+
+
+def site_bucket(site, n_buckets):
+    """Get the partition bucket of a site.
+
+    Args:
+        site (str): Name of the site
+        n_buckets (int): Number of site buckets in the dataset
+
+    Returns:
+        (int): bucket of the site, between 0 and n_buckets - 1
+    """
+    digest = hashlib.md5(site.encode("utf-8")).hexdigest()
+
+    return int(digest, 16) % n_buckets
+
+
+def import_pyarrow():
+    """Import pyarrow, needed by the parquet layout.
+
+    The parquet functions of pandas are not used: they are missing from the
+    pandas version of the environment (0.20).
+
+    Returns:
+        (tuple): the pyarrow and pyarrow.parquet modules
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            "The parquet layout requires pyarrow (pip install pyarrow)."
+        )
+
+    return pyarrow, pq
+
+
+def write_parquet(data_df, data_file, row_group_size=None):
+    """Write a dataframe to a Parquet file, without its index.
+
+    Args:
+        data_df (pandas.DataFrame): Data to write
+        data_file (PosixPath): Path to the Parquet file
+        row_group_size (int): Maximum number of rows of a row group, all the\
+                              rows in a single group if None
+    """
+    pyarrow, pq = import_pyarrow()
+    table = pyarrow.Table.from_pandas(data_df, preserve_index=False)
+    pq.write_table(table, str(data_file), row_group_size=row_group_size)
+
+
+def read_parquet(data_file, columns=None, site=None):
+    """Read a Parquet file to a dataframe.
+
+    Args:
+        data_file (PosixPath): Path to the Parquet file
+        columns (list): Columns to read, all if None
+        site (str): Only read the rows of a site. The row groups whose\
+                    min/max site statistics exclude the site are skipped.
+
+    Returns:
+        (pandas.DataFrame): data of the file
+    """
+    _, pq = import_pyarrow()
+    parquet_file = pq.ParquetFile(str(data_file))
+
+    if site is None:
+        return parquet_file.read(columns=columns).to_pandas()
+
+    # Row groups that can contain the site (the first one if there are none,
+    # to get the columns)
+    groups = [
+        i
+        for i in range(parquet_file.num_row_groups)
+        if site_in_row_group(parquet_file.metadata.row_group(i), site)
+    ] or [0]
+    data_df = pd.concat(
+        [
+            parquet_file.read_row_group(i, columns=columns).to_pandas()
+            for i in groups
+        ],
+        ignore_index=True,
+    )
+
+    return data_df[data_df["site"] == site].reset_index(drop=True)
+
+
+def site_in_row_group(row_group, site):
+    """Check if a row group can contain a site, from its statistics.
+
+    Args:
+        row_group (pyarrow.parquet.RowGroupMetaData): Row group metadata
+        site (str): Name of the site
+
+    Returns:
+        (bool): the site can be in the row group (True if the group has no\
+                site statistics)
+    """
+    for i in range(row_group.num_columns):
+        column = row_group.column(i)
+        if column.path_in_schema != "site":
+            continue
+        stats = column.statistics
+        if stats is None or not getattr(stats, "has_min_max", True):
+            return True
+        site_min, site_max = stats.min, stats.max
+        if isinstance(site_min, bytes):
+            site_min = site_min.decode("utf-8")
+            site_max = site_max.decode("utf-8")
+        return site_min <= site <= site_max
+
+    return True
+
+
+class PartitionedWriter(object):
+    """Write the outputs to a single partitioned Parquet dataset.
+
+    Instead of one csv file per site, the values of all sites are stored in
+    long format (site, dt, platform, variable, value) in a Parquet dataset
+    partitioned by site bucket (hash of the site name) and year:
+    <dataset>/site_bucket=<b>/year=<yyyy>/<file>.parquet. The rows are
+    buffered in memory and written in batches. When the writer is closed,
+    each partition is compacted to a single file sorted by site and date, and
+    an index with the min/max site and date of each file is written, so that
+    reading a site only opens the files that can contain it (see read_site).
+    Requires the pyarrow library.
+
+    Args:
+        dataset_fold (PosixPath): Path to the dataset folder
+        n_buckets (int): Number of site buckets
+        buffer_rows (int): Number of rows kept in memory before writing
+    """
+
+    def __init__(self, dataset_fold, n_buckets=64, buffer_rows=500000):
+        import_pyarrow()
+
+        self.dataset_fold = dataset_fold
+        self.n_buckets = n_buckets
+        self.buffer_rows = buffer_rows
+        self.rows = []
+        self.batch = 0
+
+        # Keep the number of buckets of an existing dataset
+        index_file = dataset_fold / "_index.json"
+        if index_file.is_file():
+            with open(str(index_file), "r") as f:
+                self.n_buckets = json.load(f)["n_buckets"]
+
+    def add(self, site, sat_date, platform, values):
+        """Add the values of a site for a scene.
+
+        Args:
+            site (str): Name of the site
+            sat_date (datetime): Acquisition date of the scene
+            platform (int): Platform ID (A=0, B=1)
+            values (dict): variable names and values
+        """
+        for variable, value in values.items():
+            self.rows.append((site, sat_date, platform, variable, value))
+
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to the dataset."""
+        if not self.rows:
+            return
+
+        long_df = pd.DataFrame(
+            self.rows, columns=["site", "dt", "platform", "variable", "value"]
+        )
+        long_df["value"] = pd.to_numeric(long_df["value"], errors="coerce")
+        self.rows = []
+
+        partitions = long_df.groupby(
+            [
+                long_df["site"].map(lambda x: site_bucket(x, self.n_buckets)),
+                long_df["dt"].map(lambda x: x.year),
+            ]
+        )
+
+        # Unique name for the files of this batch
+        fname = "part-%s-%s-%s.parquet" % (
+            datetime.now().strftime("%Y%m%dT%H%M%S"),
+            os.getpid(),
+            self.batch,
+        )
+        self.batch += 1
+
+        for (bucket, year), part_df in partitions:
+            part_fold = partition_folder(self.dataset_fold, bucket, year)
+            os.makedirs(str(part_fold), exist_ok=True)
+            write_parquet(part_df, part_fold / fname)
+
+    def close(self):
+        """Write the remaining rows, compact the partitions and index them."""
+        self.flush()
+        index_dataset(self.dataset_fold, self.n_buckets)
+
+
+def index_dataset(dataset_fold, n_buckets):
+    """Compact the partitions of a dataset and index them.
+
+    The index lists the files with their number of rows and min/max site and
+    date, and all the variables of the dataset.
+
+    Args:
+        dataset_fold (PosixPath): Path to the dataset folder
+        n_buckets (int): Number of site buckets of the dataset
+    """
+    index = {"n_buckets": n_buckets, "files": {}}
+    variables = set()
+    part_folds = sorted(dataset_fold.glob("site_bucket=*/year=*"))
+    for part_fold in part_folds:
+        data_file = compact_partition(part_fold)
+        part_df = read_parquet(data_file, columns=["site", "dt", "variable"])
+        variables.update(part_df["variable"].unique())
+        index["files"][str(data_file.relative_to(dataset_fold))] = {
+            "rows": len(part_df),
+            "site_min": part_df["site"].min(),
+            "site_max": part_df["site"].max(),
+            "dt_min": part_df["dt"].min().isoformat(),
+            "dt_max": part_df["dt"].max().isoformat(),
+        }
+
+    # All the variables, for the columns of the wide format (see read_site)
+    index["variables"] = sorted(variables, key=natural_keys)
+
+    with open(str(dataset_fold / "_index.json"), "w") as f:
+        json.dump(index, f, indent=1)
+
+
+def merge_datasets(dataset_folds, out_dataset):
+    """Merge partitioned datasets (e.g. written by the shards of a run).
+
+    The files of each partition of the datasets are copied to the same
+    partition of the merged dataset, which is then compacted and indexed.
+
+    Args:
+        dataset_folds (list): Paths (PosixPath) to the dataset folders, each\
+                              indexed by PartitionedWriter.close
+        out_dataset (PosixPath): Path to the merged dataset folder (must not\
+                                 exist)
+
+    Returns:
+        (int): number of site buckets of the merged dataset
+    """
+    if out_dataset.exists():
+        raise ValueError("The dataset %s already exists." % out_dataset)
+
+    n_buckets = None
+    for i, dataset_fold in enumerate(dataset_folds):
+        with open(str(dataset_fold / "_index.json"), "r") as f:
+            index = json.load(f)
+
+        # The sites of the datasets have to be in the same buckets
+        if n_buckets is None:
+            n_buckets = index["n_buckets"]
+        elif index["n_buckets"] != n_buckets:
+            raise ValueError(
+                "The datasets have different numbers of site buckets."
+            )
+
+        for data_file in sorted(index["files"]):
+            part_fold = (out_dataset / data_file).parent
+            os.makedirs(str(part_fold), exist_ok=True)
+            shutil.copyfile(
+                str(dataset_fold / data_file),
+                str(part_fold / ("part-%s.parquet" % i)),
+            )
+
+    index_dataset(out_dataset, n_buckets)
+
+    return n_buckets
+
+
+def partition_folder(dataset_fold, bucket, year):
+    """Get the folder of a dataset partition."""
+    return dataset_fold / ("site_bucket=%02d" % bucket) / ("year=%s" % year)
+
+
+def compact_partition(part_fold):
+    """Compact the files of a partition.
+
+    Merge all the Parquet files of a partition into a single file sorted by
+    site and date, written in row groups so that the Parquet min/max
+    statistics allow readers to skip the row groups of other sites.
+
+    Args:
+        part_fold (PosixPath): Path to the partition folder
+
+    Returns:
+        (PosixPath): path to the compacted file
+    """
+    data_file = part_fold / "data.parquet"
+    # In the order they were written (the compacted file first), which the
+    # sort below keeps for the rows of the same site, date and variable
+    part_files = sorted(
+        part_fold.glob("*.parquet"), key=lambda x: natural_keys(x.name)
+    )
+
+    if part_files == [data_file]:
+        return data_file
+
+    part_df = pd.concat(
+        [read_parquet(x) for x in part_files], ignore_index=True
+    )
+    part_df.sort_values(["site", "dt", "variable"], inplace=True)
+
+    tmp_file = part_fold / "data.parquet.tmp"
+    write_parquet(part_df, tmp_file, row_group_size=50000)
+
+    for x in part_files:
+        x.unlink()
+    tmp_file.rename(data_file)
+
+    return data_file
+
+
+def read_site(dataset_fold, site, wide=True):
+    """Read the values of a site from a partitioned dataset.
+
+    Only the files of the site's bucket whose min/max site range contains the
+    site are read (see PartitionedWriter). In the wide format, the columns
+    are all the variables of the dataset, and only the last values written
+    are kept for the scenes processed several times.
+
+    Args:
+        dataset_fold (PosixPath): Path to the dataset folder
+        site (str): Name of the site
+        wide (bool): Return one row per date and one column per variable,\
+                     as in the csv layout, instead of the long format
+
+    Returns:
+        (pandas.DataFrame): values of the site
+    """
+    with open(str(dataset_fold / "_index.json"), "r") as f:
+        index = json.load(f)
+
+    bucket = "site_bucket=%02d" % site_bucket(site, index["n_buckets"])
+    site_files = [
+        dataset_fold / x
+        for x, stats in sorted(index["files"].items())
+        if x.startswith(bucket)
+        and stats["site_min"] <= site <= stats["site_max"]
+    ]
+
+    site_df = pd.concat(
+        [read_parquet(x, site=site) for x in site_files]
+        or [
+            pd.DataFrame(
+                columns=["site", "dt", "platform", "variable", "value"]
+            )
+        ],
+        ignore_index=True,
+    )
+
+    if not wide:
+        return site_df
+
+    # All the variables of the dataset, as in the csv layout
+    variables = index.get("variables") or sorted(
+        site_df["variable"].unique(), key=natural_keys
+    )
+
+    # No values for the site: nothing to pivot
+    if site_df.empty:
+        return pd.DataFrame(columns=["dt", "platform"] + variables)
+
+    # Keep the last value written for each date (the rows of a scene
+    # processed again are appended to the dataset)
+    site_df = site_df.drop_duplicates(["site", "dt", "variable"], keep="last")
+    wide_df = site_df.set_index(["dt", "platform", "variable"])[
+        "value"
+    ].unstack("variable")
+
+    return wide_df.reindex(columns=variables).reset_index()
@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Timing and monitoring of the processing runs (no SNAP required)."""
+import csv
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Processing stages run once per scene (for all its sites), the other stages
+# are run for each site
+SCENE_STAGES = ["open", "idepix_sites", "snow_engine", "toa_sites"]
+
+
+class StageTimer(object):
+    """Time the processing stages.
+
+    Accumulate the time spent and the number of calls for each processing
+    stage (opening the product, subsetting, running a processor...). The
+    totals can be saved to a json file and are added to the ones already
+    stored in the file, so that the averages improve from run to run.
+
+    Args:
+        json_file (PosixPath): Path to a json file containing the timings of
+            previous runs (optional)
+    """
+
+    def __init__(self, json_file=None):
+        self.totals = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+        if json_file and json_file.is_file():
+            with open(str(json_file), "r") as f:
+                previous = json.load(f)
+            for name in previous:
+                self.totals[name] = previous[name]["total"]
+                self.counts[name] = previous[name]["count"]
+
+    @contextmanager
+    def stage(self, name):
+        """Time the code run within the context as the given stage."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds, count=1):
+        """Add a timing to a stage.
+
+        Args:
+            name (str): Name of the stage
+            seconds (float): Time spent in the stage
+            count (int): Number of calls the time corresponds to
+        """
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def __getstate__(self):
+        # The lock can't be pickled (e.g. to be sent to the scene_watchdog
+        # worker): a new one is created when unpickling
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def averages(self):
+        """Get the average time per call of each stage.
+
+        Returns:
+            (dict): stage names as keys and average times (s) as values
+        """
+        return {
+            name: self.totals[name] / self.counts[name]
+            for name in self.totals
+            if self.counts[name]
+        }
+
+    def save(self, json_file):
+        """Save the stage totals to a json file.
+
+        Args:
+            json_file (PosixPath): Path to the output json file
+        """
+        timings = {
+            name: {
+                "total": round(self.totals[name], 3),
+                "count": self.counts[name],
+                "average": round(self.totals[name] / self.counts[name], 3),
+            }
+            for name in self.totals
+            if self.counts[name]
+        }
+
+        with open(str(json_file), "w") as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+
+
+def estimate_scene_time(n_sites, averages):
+    """Estimate the processing time of a scene.
+
+    The scene cost is the time of the stages run once per scene (opening the
+    product, see SCENE_STAGES) plus, for each site in the scene, the time of
+    all the per-site stages.
+
+    Args:
+        n_sites (int): Number of sites located in the scene
+        averages (dict): average time (s) of each stage (see StageTimer)
+
+    Returns:
+        (float): estimated processing time in seconds, or None if no timings\
+                 are available
+    """
+    if not averages:
+        return None
+
+    scene_time = sum(averages[x] for x in averages if x in SCENE_STAGES)
+    site_time = sum(averages[x] for x in averages if x not in SCENE_STAGES)
+
+    return scene_time + n_sites * site_time
+
+
+def python_rss_mb():
+    """Get the resident memory of the Python process.
+
+    Read from /proc on Linux. On other systems, the peak resident memory is
+    returned instead.
+
+    Returns:
+        (float): resident memory in MB
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * resource.getpagesize() / 1024.0 ** 2
+    except IOError:
+        # ru_maxrss is in bytes on Mac OS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 ** 2
+
+
+class MemoryMonitor(object):
+    """Record the memory use before and after each scene.
+
+    The JVM heap, the resident memory of the Python process running SNAP
+    (the worker process with a timeout) and the number of open products are
+    written to a csv file. After each scene, the memory baseline (JVM
+    heap used and Python resident memory) is compared to the previous scenes:
+    a warning is printed when it has grown for a number of scenes in a row,
+    which points to a leak.
+
+    Args:
+        csv_file (PosixPath): Path to the output csv file
+        window (int): Number of consecutive scenes with a growing baseline\
+                      before warning
+        min_growth (float): Minimum growth (MB) of the baseline over the\
+                            window to warn
+    """
+
+    columns = [
+        "time",
+        "scene",
+        "stage",
+        "jvm_used_mb",
+        "jvm_committed_mb",
+        "python_rss_mb",
+        "open_products",
+    ]
+
+    def __init__(self, csv_file, window=5, min_growth=50.0):
+        self.csv_file = csv_file
+        self.window = window
+        self.min_growth = min_growth
+        self.baselines = []
+
+        if not csv_file.is_file():
+            with open(str(csv_file), "w") as f:
+                csv.writer(f).writerow(self.columns)
+
+    def record(self, scene, stage, snap_memory):
+        """Record the memory use.
+
+        Args:
+            scene (str): Name of the scene
+            stage (str): "before" or "after" the scene processing
+            snap_memory (dict): JVM memory, resident memory of the process\
+                                running SNAP and open products (see\
+                                snappy_funcs.memory_state)
+        """
+        row = dict(snap_memory)
+        row.update(
+            {
+                "time": datetime.now().isoformat(),
+                "scene": scene,
+                "stage": stage,
+            }
+        )
+
+        with open(str(self.csv_file), "a") as f:
+            csv.writer(f).writerow(
+                [
+                    round(row[x], 1) if isinstance(row[x], float) else row[x]
+                    for x in self.columns
+                ]
+            )
+
+        if stage == "after":
+            self.check_baseline(row["jvm_used_mb"] + row["python_rss_mb"])
+
+    def check_baseline(self, baseline):
+        """Warn if the post-scene baseline keeps climbing.
+
+        Args:
+            baseline (float): memory used after the last scene (MB)
+        """
+        self.baselines = (self.baselines + [baseline])[-(self.window + 1):]
+
+        if len(self.baselines) <= self.window:
+            return
+
+        growing = all(
+            x < y for x, y in zip(self.baselines[:-1], self.baselines[1:])
+        )
+        growth = self.baselines[-1] - self.baselines[0]
+
+        if growing and growth >= self.min_growth:
+            print(
+                "Warning: memory baseline grew by %.0f MB over the last %s"
+                " scenes (%.0f MB), possible leak." % (
+                    growth, self.window, baseline
+                )
+            )
+            # Only warn again after a new full window of growth
+            self.baselines = [baseline]
+
+
+class EventLog(object):
+    """Structured log of the processing failures.
+
+    Each event is written as a json line with the time, the scene, the site
+    (None for the events of a whole scene), the processing stage, a reason
+    code, a message and optionally a duration (s). The events are buffered
+    and appended to the file in batches rather than one by one. The log is
+    summarised with s3_log_summary.py.
+
+    Args:
+        log_file (PosixPath): Path to the json lines file
+        buffer_size (int): Number of events buffered before writing them
+    """
+
+    def __init__(self, log_file, buffer_size=1000):
+        self.log_file = log_file
+        self.buffer_size = buffer_size
+        self.events = []
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def log(
+        self, scene, reason, message, sites=None, stage=None, duration=None
+    ):
+        """Log an event, once for each site.
+
+        Args:
+            scene (str): Name of the scene
+            reason (str): Reason code (e.g. "invalid_pixel")
+            message (str): Description of the event
+            sites (list): Names of the sites concerned, None for the whole\
+                          scene
+            stage (str): Processing stage (see StageTimer)
+            duration (float): Duration (s) related to the event
+        """
+        event_time = datetime.now().isoformat()
+        with self.lock:
+            for site in sites or [None]:
+                self.counts[reason] = self.counts.get(reason, 0) + 1
+                self.events.append(
+                    {
+                        "time": event_time,
+                        "scene": scene,
+                        "site": site,
+                        "stage": stage,
+                        "reason": reason,
+                        "message": message,
+                        "duration": duration,
+                    }
+                )
+
+        if len(self.events) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered events to the file."""
+        with self.lock:
+            events, self.events = self.events, []
+
+        if not events:
+            return
+
+        with open(str(self.log_file), "a") as fd:
+            for event in events:
+                fd.write(json.dumps(event, sort_keys=True) + "\n")
+
+    def __getstate__(self):
+        # The lock can't be pickled (e.g. to be sent to the scene_watchdog
+        # worker): a new one is created when unpickling
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def read_events(log_file):
+    """Read the events of a log written by EventLog.
+
+    Lines that can't be parsed (e.g. the last line of a log written by a
+    crashed run) are skipped.
+
+    Args:
+        log_file (PosixPath): Path to the json lines file
+
+    Returns:
+        (list): events (dict)
+    """
+    events = []
+    with open(str(log_file), "r") as fd:
+        for line in fd:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return events
+
+
+def format_duration(seconds):
+    """Format a duration as hours:minutes:seconds.
+
+    Args:
+        seconds (float): duration in seconds, or None
+
+    Returns:
+        (str): formatted duration, "unknown" if None
+    """
+    if seconds is None:
+        return "unknown"
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+def prometheus_labels(labels):
+    """Format labels for the Prometheus text format.
+
+    Args:
+        labels (dict): label names and values
+
+    Returns:
+        (str): formatted labels, e.g. '{stage="open"}'
+    """
+    if not labels:
+        return ""
+
+    values = []
+    for name in sorted(labels):
+        value = str(labels[name]).replace("\\", "\\\\")
+        value = value.replace('"', '\\"').replace("\n", "\\n")
+        values.append('%s="%s"' % (name, value))
+
+    return "{%s}" % ",".join(values)
+
+
+class ProgressMonitor(object):
+    """Progress and throughput of a run.
+
+    Count the processed scenes and the extracted sites to get the rates
+    (scenes per minute, sites per second) and the estimated time left. The
+    status is printed with each scene, and can be exported to a Prometheus
+    textfile (node_exporter textfile collector) with the average time of the
+    processing stages and the failure counts, to detect stalled or slow runs
+    (see s3_extract_last_update_timestamp_seconds). The file is replaced
+    atomically after each scene.
+
+    Args:
+        total_scenes (int): Number of scenes to process
+        textfile (PosixPath): Path to the Prometheus .prom file (optional)
+        labels (dict): Labels added to all the metrics, e.g. to tell the\
+                       runs of a machine apart (optional)
+    """
+
+    def __init__(self, total_scenes, textfile=None, labels=None):
+        self.total_scenes = total_scenes
+        self.textfile = textfile
+        self.labels = labels or {}
+        self.start = time.time()
+        self.last_update = self.start
+        self.scenes = 0
+        self.skipped = 0
+        self.sites = 0
+
+    def update(self, n_sites=0, skipped=False, averages=None, failures=None):
+        """Count a finished scene.
+
+        Args:
+            n_sites (int): Number of sites extracted from the scene
+            skipped (bool): The scene wasn't processed (bad scene, timeout)
+            averages (dict): average time (s) of each stage (see StageTimer)
+            failures (dict): number of failures by reason (see EventLog)
+        """
+        if skipped:
+            self.skipped += 1
+        else:
+            self.scenes += 1
+            self.sites += n_sites
+        self.last_update = time.time()
+
+        if self.textfile:
+            self.write(averages, failures)
+
+    def rates(self):
+        """Get the throughput of the run.
+
+        Returns:
+            (dict): elapsed time (s), scenes per minute, sites per second and\
+                    estimated time left (s, None before the first scene)
+        """
+        elapsed = max(time.time() - self.start, 1e-6)
+        finished = self.scenes + self.skipped
+
+        if finished:
+            eta = elapsed / finished * max(self.total_scenes - finished, 0)
+        else:
+            eta = None
+
+        return {
+            "elapsed_seconds": elapsed,
+            "scenes_per_minute": self.scenes / elapsed * 60.0,
+            "sites_per_second": self.sites / elapsed,
+            "eta_seconds": eta,
+        }
+
+    def status(self):
+        """Get the status line printed on the console.
+
+        Returns:
+            (str): rates and estimated time left
+        """
+        rates = self.rates()
+
+        return "%.1f scenes/min, %.1f sites/s, ETA %s" % (
+            rates["scenes_per_minute"],
+            rates["sites_per_second"],
+            format_duration(rates["eta_seconds"]),
+        )
+
+    def write(self, averages=None, failures=None):
+        """Write the metrics to the Prometheus textfile.
+
+        Args:
+            averages (dict): average time (s) of each stage (see StageTimer)
+            failures (dict): number of failures by reason (see EventLog)
+        """
+        rates = self.rates()
+        eta = rates["eta_seconds"]
+
+        # Name, description and samples (labels, value) of each metric
+        metrics = [
+            (
+                "scenes_total",
+                "Number of scenes to process.",
+                [({}, self.total_scenes)],
+            ),
+            (
+                "scenes_processed",
+                "Number of processed scenes.",
+                [({}, self.scenes)],
+            ),
+            (
+                "scenes_skipped",
+                "Number of skipped scenes.",
+                [({}, self.skipped)],
+            ),
+            (
+                "sites_extracted",
+                "Number of extracted sites.",
+                [({}, self.sites)],
+            ),
+            (
+                "scenes_per_minute",
+                "Processed scenes per minute.",
+                [({}, rates["scenes_per_minute"])],
+            ),
+            (
+                "sites_per_second",
+                "Extracted sites per second.",
+                [({}, rates["sites_per_second"])],
+            ),
+            (
+                "elapsed_seconds",
+                "Time since the start of the run.",
+                [({}, rates["elapsed_seconds"])],
+            ),
+            (
+                "eta_seconds",
+                "Estimated time left.",
+                [({}, eta if eta is not None else "NaN")],
+            ),
+            (
+                "last_update_timestamp_seconds",
+                "Time the last scene finished.",
+                [({}, self.last_update)],
+            ),
+            (
+                "stage_average_seconds",
+                "Average time of the processing stages.",
+                [({"stage": x}, averages[x]) for x in sorted(averages or {})],
+            ),
+            (
+                "failures",
+                "Number of failures by reason.",
+                [({"reason": x}, failures[x]) for x in sorted(failures or {})],
+            ),
+        ]
+
+        lines = []
+        for name, description, samples in metrics:
+            name = "s3_extract_%s" % name
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s gauge" % name)
+            for labels, value in samples:
+                labels = dict(self.labels, **labels)
+                lines.append(
+                    "%s%s %s" % (name, prometheus_labels(labels), value)
+                )
+
+        # Write to a temporary file first: the collector never reads a
+        # partial file
+        tmp_file = self.textfile.with_name(self.textfile.name + ".tmp")
+        with open(str(tmp_file), "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(str(tmp_file), str(self.textfile))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark the S3 SNOW extraction on a sample scene for a grid of SNAP tile
+cache, tile size and parallelism settings, and save the fastest
+configuration of the machine, to be used with the --snap-config option of
+s3_extract_snow_products.py and s3_band_extract.py.
+Written by Maxim Lamare.
+"""
+import sys
+import csv
+import itertools
+import json
+import multiprocessing
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from run_metrics import EventLog
+from scene_utils import in_footprint, scene_footprint
+from snap_config import SNAP_SETTINGS
+
+
+def main(
+    sat_image,
+    coords_file,
+    out_file,
+    tile_caches,
+    tile_sizes,
+    parallelisms,
+    repeats=2,
+    max_sites=20,
+):
+    """Find the fastest SNAP settings.
+
+    The S3 SNOW extraction (getS3values) is run on the sites located in the
+    scene once to warm up the JVM, then for each combination of settings.
+    The tile cache is emptied before each run, and the fastest of the
+    repeated runs is kept for each combination.
+
+    Args:
+        sat_image (PosixPath): Path to a S3 OLCI scene (.SEN3 folder)
+        coords_file (PosixPath): Path to a csv containing site coordinates
+        out_file (PosixPath): Path to the json file where the best settings\
+                              and all the timings are written
+        tile_caches (list): Tile cache capacities to test (MB)
+        tile_sizes (list): Tile sizes to test (pixels)
+        parallelisms (list): Numbers of threads to test
+        repeats (int): Number of runs for each combination
+        max_sites (int): Maximum number of sites of the scene used
+
+    Returns:
+        (dict): best settings, run time and timings of all the combinations
+    """
+    # Keep the sites located in the scene
+    footprint = scene_footprint(sat_image / "xfdumanifest.xml")
+    with open(str(coords_file), "r") as f:
+        coords = [
+            (row[0], float(row[1]), float(row[2])) for row in csv.reader(f)
+        ]
+    coords = [x for x in coords if in_footprint(footprint, x[1], x[2])]
+    coords = coords[:max_sites]
+
+    if not coords:
+        raise ValueError("No sites located in the scene %s." % sat_image.name)
+
+    # Import snappy only when the benchmark runs
+    from snappy_funcs import configure_snap, flush_tile_cache, getS3values
+
+    s3path = str(sat_image / "xfdumanifest.xml")
+    event_log = EventLog(out_file.parent / "autotune_log.jsonl")
+
+    # Warm up the JVM (class loading, compilation) so that the first
+    # combination isn't penalised
+    print("Warming up on %s sites of %s" % (len(coords), sat_image.name))
+    getS3values(s3path, coords, False, 0.1, False, False, event_log)
+
+    results = []
+    for tile_cache_mb, tile_size, parallelism in itertools.product(
+        tile_caches, tile_sizes, parallelisms
+    ):
+        configure_snap(tile_cache_mb, tile_size, parallelism)
+
+        run_times = []
+        for _ in range(repeats):
+            flush_tile_cache()
+            start = time.time()
+            getS3values(s3path, coords, False, 0.1, False, False, event_log)
+            run_times.append(time.time() - start)
+
+        results.append(
+            {
+                "tile_cache_mb": tile_cache_mb,
+                "tile_size": tile_size,
+                "parallelism": parallelism,
+                "seconds": round(min(run_times), 3),
+            }
+        )
+        print(
+            "Tile cache %s MB, tile size %s, parallelism %s: %.1f s"
+            % (tile_cache_mb, tile_size, parallelism, min(run_times))
+        )
+
+    event_log.flush()
+
+    best = min(results, key=lambda x: x["seconds"])
+    config = {x: best[x] for x in SNAP_SETTINGS}
+    config.update(
+        {
+            "seconds": best["seconds"],
+            "scene": sat_image.name,
+            "sites": len(coords),
+            "results": results,
+        }
+    )
+
+    with open(str(out_file), "w") as f:
+        json.dump(config, f, indent=1, sort_keys=True)
+
+    print(
+        "Best: tile cache %s MB, tile size %s, parallelism %s (%.1f s)"
+        % (
+            best["tile_cache_mb"],
+            best["tile_size"],
+            best["parallelism"],
+            best["seconds"],
+        )
+    )
+
+    return config
+
+
+if __name__ == "__main__":
+
+    # If no arguments, return a help message
+    if len(sys.argv) == 1:
+        print(
+            'No arguments provided. Please run the command: "python %s -h"'
+            " for help." % sys.argv[0]
+        )
+        sys.exit(2)
+    else:
+        cpus = multiprocessing.cpu_count()
+
+        # Parse Arguments from command line
+        parser = ArgumentParser(
+            description="Find the fastest SNAP settings of the machine."
+        )
+        parser.add_argument(
+            "-i",
+            "--insat",
+            metavar="Sample scene",
+            required=True,
+            help="Path to a S3 OLCI scene (.SEN3 folder) used for the"
+            " benchmark.",
+        )
+        parser.add_argument(
+            "-c",
+            "--coords",
+            metavar="Site coordinates",
+            required=True,
+            help="Path to the input file containing the coordiantes for each"
+            " site. Has to be a csv in format: site,lat,lon. Only the sites"
+            " located in the scene are used.",
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            metavar="Output",
+            required=True,
+            help="Path to the json file where the best settings are written,"
+            " to be used with the --snap-config option.",
+        )
+        parser.add_argument(
+            "--tile-cache",
+            metavar="Tile cache",
+            type=int,
+            nargs="+",
+            required=False,
+            default=[512, 1024, 2048],
+            help="Tile cache capacities to test (MB), defaults to 512 1024"
+            " 2048.",
+        )
+        parser.add_argument(
+            "--tile-size",
+            metavar="Tile size",
+            type=int,
+            nargs="+",
+            required=False,
+            default=[256, 512, 1024],
+            help="Tile sizes to test (pixels), defaults to 256 512 1024.",
+        )
+        parser.add_argument(
+            "--parallelism",
+            metavar="Parallelism",
+            type=int,
+            nargs="+",
+            required=False,
+            default=sorted(set([max(cpus // 2, 1), cpus])),
+            help="Numbers of threads to test, defaults to half and all the"
+            " processors.",
+        )
+        parser.add_argument(
+            "--repeats",
+            metavar="Repeats",
+            type=int,
+            required=False,
+            default=2,
+            help="Number of runs for each combination, defaults to 2.",
+        )
+        parser.add_argument(
+            "--max-sites",
+            metavar="Maximum sites",
+            type=int,
+            required=False,
+            default=20,
+            help="Maximum number of sites of the scene used, defaults to 20.",
+        )
+
+        input_args = parser.parse_args()
+
+        # Run main
+        main(
+            Path(input_args.insat),
+            Path(input_args.coords),
+            Path(input_args.output),
+            input_args.tile_cache,
+            input_args.tile_size,
+            input_args.parallelism,
+            repeats=input_args.repeats,
+            max_sites=input_args.max_sites,
+        )
@@ -13,12 +13,46 @@ import csv
 import pandas as pd
 from datetime import datetime
 import xml.etree.ElementTree as ET
-
-from snappy_funcs import getS3bands
-from s3_extract_snow_products import natural_keys
-
-
-def main(sat_fold, coords_file, out_fold, inbands, slstr_res, sat_platform):
+import json
+
+from output_utils import PartitionedWriter, finalize_sites
+from scene_utils import (
+    list_scenes,
+    parse_shard,
+    plan_run,
+    select_platform,
+    select_shard,
+    shard_folder,
+)
+from run_metrics import StageTimer
+from site_cache import PixelPositionCache
+from scene_watchdog import SceneRunner
+from snap_config import read_snap_config
+
+
+def main(
+    sat_fold,
+    coords_file,
+    out_fold,
+    inbands,
+    slstr_res,
+    sat_platform,
+    shard=None,
+    dry_run=False,
+    timings_file=None,
+    memory_log=None,
+    workers=1,
+    layout="csv",
+    position_cache_file=None,
+    timeout=None,
+    bad_scenes_file=None,
+    verify_checksums=False,
+    metrics_file=None,
+    snap_config_file=None,
+    tile_cache_mb=None,
+    tile_size=None,
+    parallelism=None,
+):
     """Sentinel-3 band extraction.
 
     Extract a specified list of bands for all images
@@ -33,7 +67,42 @@ def main(sat_fold, coords_file, out_fold, inbands, slstr_res, sat_platform):
         out_fold (PosixPath): Path to a folder in which the output will be\
                             written
         bands (list): A list of bands to extract from the satellite images.
+        slstr_res (str): SLSTR reader resolution (auto, 500 or 1000)
+        sat_platform (str): Sentinel-3 platform(s) to process (A, B or AB)
+        shard (tuple): Only process the scenes of shard i out of N (i, N)
+        dry_run (bool): Only print the planned (scene, sites) pairs
+        timings_file (PosixPath): Path to the json file storing the timings\
+                                  of the processing stages
+        memory_log (PosixPath): Path to a csv file in which the memory use\
+                                before and after each scene is recorded
+        workers (int): Number of processes sorting the output files
+        layout (str): Output layout: "csv" (one file per site) or "parquet"\
+                      (single dataset partitioned by site and year)
+        position_cache_file (PosixPath): Path to a json file caching the\
+                                         pixel positions of the sites\
+                                         (optional)
+        timeout (float): Maximum processing time (s) of a scene: the SNAP\
+                         processing is run in a worker process, restarted\
+                         if a scene takes longer. None to run it in the\
+                         current process.
+        bad_scenes_file (PosixPath): Path to a json file registering the\
+                                     scenes that can't be processed, which\
+                                     are skipped (optional)
+        verify_checksums (bool): Verify the MD5 checksums of the files of\
+                                 each scene before opening it
+        metrics_file (PosixPath): Path to a Prometheus textfile in which the\
+                                  progress and throughput of the run are\
+                                  exported (optional)
+        snap_config_file (PosixPath): Path to a json file containing the\
+                                      SNAP settings (see s3_autotune.py)
+        tile_cache_mb (int): JAI tile cache capacity (MB)
+        tile_size (int): Default tile size (pixels)
+        parallelism (int): Number of threads computing the tiles
     """
+    # If the run is sharded, write to the shard's own output folder
+    if shard:
+        out_fold = shard_folder(out_fold, shard)
+
     # Initialise the list of coordinates
     coords = []
 
@@ -43,32 +112,69 @@ def main(sat_fold, coords_file, out_fold, inbands, slstr_res, sat_platform):
         for row in rdr:
             coords.append((row[0], float(row[1]), float(row[2])))
 
-    counter = 1  # Set satellite image counter
+    # The timings of the processing stages are stored to estimate run times
+    if timings_file is None:
+        timings_file = out_fold / "stage_timings.json"
+
+    # In dry-run mode, only list the sites in the footprint of each scene
+    if dry_run:
+        satfolders = select_platform(list_scenes(sat_fold), sat_platform)
+        if shard:
+            satfolders = select_shard(satfolders, shard)
 
-    # Set the path of the log file for failed processing
-    output_errorfile = out_fold / "failed_log.txt"
+        plan = plan_run(
+            satfolders, coords, StageTimer(timings_file).averages()
+        )
+        print(json.dumps(plan, indent=1))
+
+        return plan
+
+    # Reuse the pixel positions of the sites on the same ground track
+    if position_cache_file:
+        position_cache = PixelPositionCache(position_cache_file)
+    else:
+        position_cache = None
+
+    # Write all sites to a single partitioned dataset instead of csv files
+    if layout == "parquet":
+        dataset_writer = PartitionedWriter(out_fold / "dataset")
+    else:
+        dataset_writer = None
 
     # List folders in the satellite image directory (include all .SEN3 folders
     # that are located in sub-directories within 'sat_fold')
-    satfolders = []
-    for p in sat_fold.rglob("*"):
-        if p.as_posix().endswith(".SEN3"):
-            satfolders.append(p)
+    satfolders = select_platform(list_scenes(sat_fold), sat_platform)
+
+    # Only keep the scenes of the shard if the run is split
+    if shard:
+        satfolders = select_shard(satfolders, shard)
+
+    # Run the SNAP processing of the scenes, logging and skipping the scenes
+    # that fail
+    runner = SceneRunner(
+        out_fold,
+        len(satfolders),
+        timings_file,
+        timeout=timeout,
+        memory_log=memory_log,
+        bad_scenes_file=bad_scenes_file,
+        verify_checksums=verify_checksums,
+        metrics_file=metrics_file,
+        snap_settings=read_snap_config(
+            snap_config_file, tile_cache_mb, tile_size, parallelism
+        ),
+    )
 
     for sat_image in satfolders:
 
         # To store results, make a dictionnary with sites as keys
         all_site = dict.fromkeys([x[0] for x in coords], pd.DataFrame())
 
-        # Only process image if it is from the desired platform
+        # Sentinel-3 platform of the image (A or B)
         sat_image_platform = sat_image.name[2]
-        if sat_image_platform != sat_platform and sat_platform != "AB":
-            continue
 
-        print(
-            "Processing image n°%s/%s: %s"
-            % (counter, len(satfolders), sat_image.name)
-        )
+        if not runner.start(sat_image):
+            continue
 
         # Satellite image's full path
         s3path = sat_image / "xfdumanifest.xml"
@@ -91,14 +197,29 @@ def main(sat_fold, coords_file, out_fold, inbands, slstr_res, sat_platform):
                         )
 
         # Extract S3 data for the coordinates contained in the images
-        s3_band_values = getS3bands(
-            str(s3path),
-            coords,
-            inbands,
-            output_errorfile,
-            s3_instrument,
-            slstr_res,
+        scene_kwargs = {
+            "event_log": runner.event_log,
+            "s3_instrument": s3_instrument,
+            "slstr_res": slstr_res,
+            "timer": runner.timer,
+            "position_cache": position_cache,
+        }
+        s3_band_values = runner.run(
+            sat_image,
+            "snappy_funcs.getS3bands",
+            (str(s3path), coords, inbands),
+            scene_kwargs,
+            sync=[
+                x
+                for x in ("event_log", "timer", "position_cache")
+                if scene_kwargs[x] is not None
+            ],
         )
+        if s3_band_values is None:
+            continue
+
+        if position_cache:
+            position_cache.save(position_cache_file)
 
         # Get time from the satellite image folder (quicker than
         # reading the xml file, but only works for S3's standard file naming.)
@@ -108,6 +229,15 @@ def main(sat_fold, coords_file, out_fold, inbands, slstr_res, sat_platform):
 
         # Put the data from the image into a panda dataframe
         for site in s3_band_values:
+            # Consolidated layout: add the values to the dataset
+            if dataset_writer:
+                dataset_writer.add(
+                    site,
+                    sat_date,
+                    0 if sat_image_platform == "A" else 1,
+                    s3_band_values[site],
+                )
+                continue
 
             # Create dataframe
             alb_df = pd.DataFrame(s3_band_values[site], index=[sat_date])
@@ -153,52 +283,19 @@ def main(sat_fold, coords_file, out_fold, inbands, slstr_res, sat_platform):
                     header=True,
                     index=False,
                 )
-        # Increment counter
-        counter += 1
 
-    # After having run the process for the images, reopen the temp files
-    # and sort the data correctly
-
-    # Set column order for sorted files
-    dt_columns = ["year", "month", "day", "hour", "minute", "second", 
-                  "dayofyear", "platform"]
-
-    # Open temp files
-    for location in coords:
-
-        # Read the temp csv file to a pandas dataframe
-        csv_name = "%s_tmp.csv" % location[0]
-        incsv = out_fold / csv_name
-        if incsv.is_file():
-            temp_df = pd.read_csv(str(incsv), sep=",")
-
-            # Get all extracted bands and natural sort them
-            band_columns = [x for x in temp_df.columns if x not in dt_columns]
-            band_columns.sort(key=natural_keys)
+    runner.close()
 
-            # Reorder dataframe colmuns
-            temp_df = temp_df[dt_columns + band_columns]
+    # Compact and index the dataset: there are no files to sort
+    if dataset_writer:
+        dataset_writer.close()
+        return
 
-            # Reorder dates
-            temp_df["dt"] = pd.to_datetime(
-                temp_df[["year", "month", "day", "hour", "minute", "second"]]
-            )
-            temp_df.set_index("dt", inplace=True)
-            temp_df.sort_index(inplace=True)
-
-            # Save reordered file
-            fname = "%s.csv" % location[0]
-            output_file = out_fold / fname
-
-            # Save dataframe to the csv file
-            temp_df.to_csv(
-                str(output_file),
-                mode="a",
-                na_rep="NA",
-                header=True,
-                index=False,
-            )
-            incsv.unlink()  # Remove temporary file
+    # After having run the process for the images, reopen the temp files
+    # and sort the data correctly
+    finalize_sites(
+        out_fold, [x[0] for x in coords], "bands", processes=workers
+    )
 
 
 if __name__ == "__main__":
@@ -253,9 +350,12 @@ if __name__ == "__main__":
             "--res",
             metavar="SLSTR reader resolution",
             required=False,
-            default="500",
+            default="auto",
+            choices=["auto", "500", "1000"],
             help="Specify the reader for opening SLSTR images: either the 500m"
-            "or the 1km. Options are '500' or '1000', defaults to '500'.",
+            " or the 1km. Options are 'auto', '500' or '1000', defaults to"
+            " 'auto': each band is read with the reader of its grid, opening"
+            " the scene once per grid.",
         )
         parser.add_argument(
             "-p",
@@ -266,7 +366,144 @@ if __name__ == "__main__":
             help="Specify the Sentinel-3 platform to include data from."
             "Options are 'A', 'B', or 'AB' (for both platforms).",
         )
-
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Don't process the data: print the sites located in each"
+            " scene and the estimated run time as json.",
+        )
+        parser.add_argument(
+            "--timings",
+            metavar="Stage timings",
+            required=False,
+            default=None,
+            help="Path to the json file storing the timings of the processing"
+            " stages, used for the run time estimates. Defaults to"
+            " 'stage_timings.json' in the output folder.",
+        )
+        parser.add_argument(
+            "--memory-log",
+            metavar="Memory log",
+            required=False,
+            default=None,
+            help="Path to a csv file in which the JVM heap, the resident"
+            " memory of the process running SNAP and the number of open"
+            " products are recorded before and after each scene. A warning"
+            " is printed when the memory keeps growing from scene to scene.",
+        )
+        parser.add_argument(
+            "--workers",
+            metavar="Workers",
+            type=int,
+            required=False,
+            default=1,
+            help="Number of processes sorting the per-site output files at"
+            " the end of the run, defaults to 1.",
+        )
+        parser.add_argument(
+            "--layout",
+            metavar="Output layout",
+            required=False,
+            default="csv",
+            choices=["csv", "parquet"],
+            help="Output layout: 'csv' (one file per site, default) or"
+            " 'parquet': a single long-format dataset partitioned by site"
+            " and year, in the 'dataset' sub-folder (requires pyarrow).",
+        )
+        parser.add_argument(
+            "--position-cache",
+            metavar="Position cache",
+            required=False,
+            default=None,
+            help="Path to a json file caching the pixel positions of the"
+            " sites by ground track (platform, relative orbit and frame)."
+            " A cached position is reused for the next scenes of the track"
+            " if the site is within half the pixel diagonal of the centre of"
+            " the pixel.",
+        )
+        parser.add_argument(
+            "--timeout",
+            metavar="Scene timeout",
+            type=float,
+            required=False,
+            default=None,
+            help="Maximum processing time of a scene in seconds. The SNAP"
+            " processing is run in a worker process, killed and restarted if"
+            " a scene takes longer: the scene is logged in 'failed_log.jsonl'"
+            " and skipped. By default, there is no timeout.",
+        )
+        parser.add_argument(
+            "--bad-scenes",
+            metavar="Bad scenes",
+            required=False,
+            default=None,
+            help="Path to a json file registering the scenes that can't be"
+            " processed, with the reason. The files listed in the manifest of"
+            " each scene are checked (existence and size) before it is"
+            " opened: the corrupt scenes, and the scenes timing out (see"
+            " --timeout), are registered and skipped in the next runs.",
+        )
+        parser.add_argument(
+            "--verify-checksums",
+            action="store_true",
+            help="Also verify the MD5 checksums of the files of each scene"
+            " listed in the manifest (requires reading all the files).",
+        )
+        parser.add_argument(
+            "--metrics-file",
+            metavar="Metrics file",
+            required=False,
+            default=None,
+            help="Path to a Prometheus textfile (e.g. in the node_exporter"
+            " textfile collector folder) in which the progress of the run"
+            " (scenes, sites, rates, estimated time left, stage averages,"
+            " failures by reason) is written after each scene.",
+        )
+        parser.add_argument(
+            "--snap-config",
+            metavar="SNAP configuration",
+            required=False,
+            default=None,
+            help="Path to a json file containing the SNAP tile cache, tile"
+            " size and parallelism, written by s3_autotune.py. By default,"
+            " the settings of the snap.properties file are used.",
+        )
+        parser.add_argument(
+            "--tile-cache",
+            metavar="Tile cache",
+            type=int,
+            required=False,
+            default=None,
+            help="JAI tile cache capacity in MB (overrides --snap-config).",
+        )
+        parser.add_argument(
+            "--tile-size",
+            metavar="Tile size",
+            type=int,
+            required=False,
+            default=None,
+            help="Default tile size in pixels (overrides --snap-config).",
+        )
+        parser.add_argument(
+            "--parallelism",
+            metavar="Parallelism",
+            type=int,
+            required=False,
+            default=None,
+            help="Number of threads computing the tiles (overrides"
+            " --snap-config).",
+        )
+        parser.add_argument(
+            "-s",
+            "--shard",
+            metavar="Shard",
+            type=parse_shard,
+            required=False,
+            default=None,
+            help="Only process shard i out of N of the scenes, in the format"
+            " i/N. The results are written to a 'shard_i_of_N' sub-folder"
+            " of the output folder, to be merged with s3_merge_shards.py.",
+        )
 
         input_args = parser.parse_args()
 
@@ -278,4 +515,30 @@ if __name__ == "__main__":
             input_args.bands,
             input_args.res,
             input_args.platform,
+            shard=input_args.shard,
+            dry_run=input_args.dry_run,
+            timings_file=Path(input_args.timings) if input_args.timings
+            else None,
+            memory_log=Path(input_args.memory_log)
+            if input_args.memory_log
+            else None,
+            workers=input_args.workers,
+            layout=input_args.layout,
+            position_cache_file=Path(input_args.position_cache)
+            if input_args.position_cache
+            else None,
+            timeout=input_args.timeout,
+            bad_scenes_file=Path(input_args.bad_scenes)
+            if input_args.bad_scenes
+            else None,
+            verify_checksums=input_args.verify_checksums,
+            metrics_file=Path(input_args.metrics_file)
+            if input_args.metrics_file
+            else None,
+            snap_config_file=Path(input_args.snap_config)
+            if input_args.snap_config
+            else None,
+            tile_cache_mb=input_args.tile_cache,
+            tile_size=input_args.tile_size,
+            parallelism=input_args.parallelism,
         )
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-running extraction service answering point queries on a S3 archive.
+The JVM, the catalog of the archive scenes and the recently opened products
+are kept in memory, so that a query only costs the extraction itself.
+Queries hitting the same scene at the same time are extracted together.
+Written by Maxim Lamare.
+"""
+import sys
+import csv
+import json
+import math
+import queue
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import Future
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+
+from extractor import Extractor
+from run_metrics import EventLog
+from scene_utils import SceneCatalog, band_instrument
+from site_cache import PixelPositionCache
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a thread."""
+
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """HTTP server on a Unix socket, handling each request in a thread."""
+
+    daemon_threads = True
+
+
+class QueryBatcher(object):
+    """Run the extractions requested by the queries.
+
+    The extractions are run one at a time in a worker thread, which is the
+    only one to use SNAP. The requests received while the worker is busy (or
+    within a short wait) are grouped by scene, so that each scene is
+    processed once for all the sites and variables requested. If a batch
+    fails, its requests are processed one by one.
+
+    Args:
+        extractor (Extractor): Extractor keeping the products open
+        batch_wait (float): Time (s) to wait for other requests before\
+                            running an extraction
+        snow_options (dict): Options of the S3 SNOW processor (pollution,
+            delta_pol, gains, dem_prods)
+    """
+
+    def __init__(self, extractor, batch_wait=0.2, snow_options=None):
+        self.extractor = extractor
+        self.batch_wait = batch_wait
+        self.snow_options = snow_options or {
+            "pollution": False,
+            "delta_pol": 0.1,
+            "gains": False,
+            "dem_prods": False,
+        }
+        self.tasks = queue.Queue()
+
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, scene, coord, variables, kind):
+        """Request an extraction.
+
+        Args:
+            scene (dict): Scene to extract from (see SceneCatalog)
+            coord (tuple): Coordinate (name, lat, lon) to extract
+            variables (list): Names of the variables to return (all if empty)
+            kind (str): "bands" to read the product bands, "snow" to run the
+                S3 SNOW processor
+
+        Returns:
+            (Future): future result: dictionnary of the values, or None if\
+                      the coordinate couldn't be extracted
+        """
+        future = Future()
+        self.tasks.put(
+            {
+                "scene": scene,
+                "coord": coord,
+                "variables": variables,
+                "kind": kind,
+                "future": future,
+            }
+        )
+
+        return future
+
+    def _run(self):
+        """Group the pending requests by scene and process them."""
+        while True:
+            tasks = [self.tasks.get()]
+
+            # Give concurrent queries the chance to join the batch
+            time.sleep(self.batch_wait)
+            while True:
+                try:
+                    tasks.append(self.tasks.get_nowait())
+                except queue.Empty:
+                    break
+
+            batches = {}
+            for task in tasks:
+                key = (task["scene"]["path"], task["kind"])
+                batches.setdefault(key, []).append(task)
+
+            for key in sorted(batches):
+                self._process(batches[key])
+
+    def _process(self, tasks):
+        """Extract the data for a batch of requests on the same scene."""
+        scene = tasks[0]["scene"]
+        kind = tasks[0]["kind"]
+
+        # Union of the sites and variables requested for the scene
+        coords = []
+        variables = []
+        for task in tasks:
+            if task["coord"] not in coords:
+                coords.append(task["coord"])
+            variables += [x for x in task["variables"] if x not in variables]
+
+        try:
+            if kind == "snow":
+                values = self.extractor.extract_snow(
+                    scene["path"], coords, **self.snow_options
+                )
+            else:
+                values = self.extractor.extract_bands(
+                    scene["path"], coords, variables, scene["instrument"]
+                )
+        except Exception as err:
+            # Process the requests one by one, so that an invalid request
+            # (e.g. an unknown band name) only fails itself
+            if len(tasks) > 1:
+                for task in tasks:
+                    self._process([task])
+            else:
+                tasks[0]["future"].set_exception(err)
+            return
+
+        for task in tasks:
+            site_values = values.get(task["coord"][0])
+            if site_values is not None and task["variables"]:
+                site_values = {
+                    x: site_values.get(x) for x in task["variables"]
+                }
+            task["future"].set_result(site_values)
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Handle the HTTP requests.
+
+    GET /query: extract values, parameters:
+        site: name of a site of the site file, or lat and lon (degrees)
+        start, end: time range (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)
+        variables: comma separated list of band (or S3 SNOW output) names
+        kind: "bands" (default) or "snow" to run the S3 SNOW processor
+        instrument: OLCI or SLSTR (optional, guessed from the variables,\
+            OLCI for kind=snow)
+    GET /refresh: add the new scenes of the archive to the catalog
+    GET /status: number of scenes in the catalog and open products
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {x: y[-1] for x, y in parse_qs(url.query).items()}
+
+        try:
+            if url.path == "/query":
+                response = self.query(params)
+            elif url.path == "/refresh":
+                response = {"new_scenes": self.server.catalog.refresh()}
+            elif url.path == "/status":
+                response = {
+                    "scenes": len(self.server.catalog.scenes),
+                    "open_products": len(
+                        self.server.extractor.products.products
+                    ),
+                }
+            else:
+                self.send_json(404, {"error": "Unknown path: %s" % url.path})
+                return
+        except ValueError as err:
+            self.send_json(400, {"error": str(err)})
+            return
+        except Exception as err:  # Keep the service running
+            self.send_json(500, {"error": str(err)})
+            return
+
+        self.send_json(200, response)
+
+    def query(self, params):
+        """Extract the values requested by a query.
+
+        Args:
+            params (dict): query parameters (see class docstring)
+
+        Returns:
+            (dict): extracted values for each scene
+        """
+        if "site" in params:
+            if params["site"] not in self.server.sites:
+                raise ValueError("Unknown site: %s" % params["site"])
+            coord = (params["site"],) + self.server.sites[params["site"]]
+        elif "lat" in params and "lon" in params:
+            lat, lon = float(params["lat"]), float(params["lon"])
+            coord = ("%s,%s" % (lat, lon), lat, lon)
+        else:
+            raise ValueError("Specify a site, or lat and lon.")
+
+        kind = params.get("kind", "bands")
+        if kind not in ("bands", "snow"):
+            raise ValueError("kind has to be 'bands' or 'snow'.")
+
+        variables = [x for x in params.get("variables", "").split(",") if x]
+        if kind == "bands" and not variables:
+            raise ValueError("Specify the variables to extract.")
+
+        # Only query the scenes of the instrument of the variables
+        instrument = params.get("instrument")
+        if kind == "snow":
+            instrument = "OLCI"
+        elif instrument is None:
+            instrument = band_instrument(variables)
+            if instrument is None:
+                raise ValueError(
+                    "Unable to guess the instrument of the variables, specify"
+                    " the instrument (OLCI or SLSTR)."
+                )
+        elif instrument not in ("OLCI", "SLSTR"):
+            raise ValueError("instrument has to be 'OLCI' or 'SLSTR'.")
+
+        scenes = self.server.catalog.query(
+            coord[1],
+            coord[2],
+            parse_time(params.get("start")),
+            parse_time(params.get("end")),
+            instrument,
+        )
+
+        futures = [
+            (x, self.server.batcher.submit(x, coord, variables, kind))
+            for x in scenes
+        ]
+
+        results = []
+        for scene, future in futures:
+            values = future.result()
+            if values is None:
+                continue
+            values = {
+                x: None if isinstance(y, float) and math.isnan(y) else y
+                for x, y in values.items()
+            }
+            values.update(
+                {
+                    "scene": scene["path"].name,
+                    "time": scene["start_time"].isoformat(),
+                }
+            )
+            results.append(values)
+
+        return {"site": coord[0], "results": results}
+
+    def send_json(self, code, response):
+        """Send a json response."""
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+
+def parse_time(instring):
+    """Convert a date or datetime ISO string to datetime (None if empty)."""
+    if not instring:
+        return None
+
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(instring, fmt)
+        except ValueError:
+            pass
+
+    raise ValueError("Wrong time format: %s" % instring)
+
+
+def main(
+    sat_fold,
+    coords_file,
+    log_file,
+    host,
+    port,
+    unix_socket,
+    max_products,
+    batch_wait,
+):
+    """Run the extraction service.
+
+    Args:
+        sat_fold (PosixPath): Path to a folder containing S3 images
+        coords_file (PosixPath): Path to a csv containing site coordinates\
+                                 (optional)
+        log_file (PosixPath): Path to the json lines file where the failed\
+                              extractions are logged
+        host (str): Host address of the HTTP server
+        port (int): Port of the HTTP server
+        unix_socket (PosixPath): Path to a Unix socket to listen to instead\
+                                 of the HTTP port (optional)
+        max_products (int): Maximum number of products kept open
+        batch_wait (float): Time (s) to wait for concurrent queries before\
+                            running an extraction
+    """
+    # Open the list of named sites
+    sites = {}
+    if coords_file:
+        with open(str(coords_file), "r") as f:
+            rdr = csv.reader(f)
+            for row in rdr:
+                sites[row[0]] = (float(row[1]), float(row[2]))
+
+    if unix_socket:
+        server = ThreadingUnixHTTPServer(str(unix_socket), QueryHandler)
+        print("Listening on %s" % unix_socket)
+    else:
+        server = ThreadingHTTPServer((host, port), QueryHandler)
+        print("Listening on http://%s:%s" % (host, port))
+
+    server.sites = sites
+    server.catalog = SceneCatalog(sat_fold)
+    # Start the JVM now: it stays warm for all the queries. The pixel
+    # positions of the sites are reused for the scenes of the same track.
+    server.extractor = Extractor(
+        max_products, EventLog(log_file), position_cache=PixelPositionCache()
+    )
+    server.batcher = QueryBatcher(server.extractor, batch_wait)
+    print("%s scenes in the catalog" % len(server.catalog.scenes))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.extractor.close()
+        if unix_socket:
+            unix_socket.unlink()
+
+
+if __name__ == "__main__":
+
+    # If no arguments, return a help message
+    if len(sys.argv) == 1:
+        print(
+            'No arguments provided. Please run the command: "python %s -h"'
+            " for help." % sys.argv[0]
+        )
+        sys.exit(2)
+    else:
+        # Parse Arguments from command line
+        parser = ArgumentParser(
+            description="Run a local service answering point queries on a S3"
+            " archive."
+        )
+        parser.add_argument(
+            "-i",
+            "--insat",
+            metavar="Satellite image repository",
+            required=True,
+            help="Path to the folder containing the S3 images to be queried.",
+        )
+        parser.add_argument(
+            "-c",
+            "--coords",
+            metavar="Site coordinates",
+            required=False,
+            default=None,
+            help="Path to the input file containing the coordiantes of the"
+            " sites that can be queried by name. Has to be a csv in format:"
+            " site,lat,lon.",
+        )
+        parser.add_argument(
+            "-l",
+            "--log",
+            metavar="Log file",
+            required=False,
+            default="failed_log.jsonl",
+            help="Path to the json lines file where the failed extractions"
+            " are logged.",
+        )
+        parser.add_argument(
+            "--host",
+            metavar="Host",
+            required=False,
+            default="127.0.0.1",
+            help="Host address of the HTTP server, defaults to 127.0.0.1.",
+        )
+        parser.add_argument(
+            "--port",
+            metavar="Port",
+            type=int,
+            required=False,
+            default=8080,
+            help="Port of the HTTP server, defaults to 8080.",
+        )
+        parser.add_argument(
+            "--socket",
+            metavar="Unix socket",
+            required=False,
+            default=None,
+            help="Path to a Unix socket to listen to instead of the HTTP"
+            " port.",
+        )
+        parser.add_argument(
+            "--max-products",
+            metavar="Open products",
+            type=int,
+            required=False,
+            default=8,
+            help="Maximum number of products kept open, defaults to 8.",
+        )
+        parser.add_argument(
+            "--batch-wait",
+            metavar="Batch wait",
+            type=float,
+            required=False,
+            default=0.2,
+            help="Time (s) to wait for concurrent queries on the same scene"
+            " before running an extraction, defaults to 0.2.",
+        )
+
+        input_args = parser.parse_args()
+
+        # Run main
+        main(
+            Path(input_args.insat),
+            Path(input_args.coords) if input_args.coords else None,
+            Path(input_args.log),
+            input_args.host,
+            input_args.port,
+            Path(input_args.socket) if input_args.socket else None,
+            input_args.max_products,
+            input_args.batch_wait,
+        )
@@ -4,52 +4,98 @@
 Extract S3 OLCI SNOW processor results from S3 OLCI images
 Written by Maxim Lamare
 """
+import os
 import sys
 from pathlib import Path
 from argparse import ArgumentParser, ArgumentTypeError
 import csv
 import pandas as pd
 from datetime import datetime
-import re
-from snappy_funcs import getS3values
-
-
-def str2bool(instring):
-    """Convert string to boolean.
-
-    Converts an input from a given list of possible inputs to the corresponding
-     boolean.
+import json
+from scene_utils import (
+    list_scenes,
+    parse_shard,
+    plan_run,
+    select_platform,
+    select_shard,
+    shard_folder,
+    str2bool,
+)
+from site_cache import PixelPositionCache, TerrainCache
+from scene_watchdog import SceneRunner
+from snap_config import read_snap_config
+import snow_engine
+from run_metrics import StageTimer
+from output_utils import (
+    NA_REP,
+    SNOW_VARIABLES,
+    PartitionedWriter,
+    append_site_csv,
+    finalize_sites,
+)
+
+
+def parse_variables(instring):
+    """Convert a comma separated list of variables to a list.
 
     Args:
-        instring (str): Input string: has to be in a predefined list.
+        instring (str): Comma separated variable names (see SNOW_VARIABLES)
 
     Returns:
-        (bool): Boolean according to the input string.
+        (list): variable names
     """
-    if instring.lower() in ("yes", "true", "t", "y", "1"):
-        return True
-    elif instring.lower() in ("no", "false", "f", "n", "0"):
-        return False
-    else:
-        raise ArgumentTypeError("Boolean value expected.")
+    variables = [x.strip() for x in instring.split(",") if x.strip()]
 
+    unknown = [x for x in variables if x not in SNOW_VARIABLES]
+    if unknown or not variables:
+        raise ArgumentTypeError(
+            "Unknown variables: %s. Options are: %s."
+            % (", ".join(unknown), ", ".join(SNOW_VARIABLES))
+        )
+
+    return variables
 
-def natural_keys(text):
-    """Sort strings naturally.
 
-    Sort a list of strings in the natural sorting order.
+def parse_sweep(instring):
+    """Read the S3 SNOW parameter sets of a sweep.
 
     Args:
-        text (str): Input text to be sorted
+        instring (str): Path to a csv file with a header, containing one\
+                        parameter set per line in format:\
+                        param_set,pollution,delta_pol,gains
 
     Returns:
-        (list): list of naturally sorted objects
+        (list): parameter sets (name, pollution, pollution delta, gains)
     """
+    try:
+        with open(instring, "r") as f:
+            rows = list(csv.DictReader(f))
+    except OSError as err:
+        raise ArgumentTypeError("Unable to read the sweep file: %s." % err)
+
+    try:
+        param_sets = [
+            (
+                row["param_set"].strip(),
+                str2bool(row["pollution"].strip()),
+                float(row["delta_pol"]),
+                str2bool(row["gains"].strip()),
+            )
+            for row in rows
+        ]
+    except (KeyError, AttributeError, TypeError, ValueError):
+        raise ArgumentTypeError(
+            "Parameter sets expected in format:"
+            " param_set,pollution,delta_pol,gains."
+        )
 
-    def atoi(text):
-        return int(text) if text.isdigit() else text
+    names = [x[0] for x in param_sets]
+    if not names or "" in names or len(set(names)) != len(names):
+        raise ArgumentTypeError(
+            "The sweep file must contain parameter sets with unique names."
+        )
 
-    return [atoi(c) for c in re.split("(\d+)", text)]
+    return param_sets
 
 
 def main(
@@ -61,7 +107,30 @@ def main(
     gains,
     dem_prods,
     recovery,
-    sat_platform
+    sat_platform,
+    shard=None,
+    dry_run=False,
+    timings_file=None,
+    memory_log=None,
+    workers=1,
+    layout="csv",
+    cloud_screen=False,
+    terrain_cache_file=None,
+    terrain_tolerance=None,
+    variables=None,
+    engine="snap",
+    toa_engine="snap",
+    position_cache_file=None,
+    timeout=None,
+    bad_scenes_file=None,
+    verify_checksums=False,
+    metrics_file=None,
+    threads=1,
+    snap_config_file=None,
+    tile_cache_mb=None,
+    tile_size=None,
+    parallelism=None,
+    param_sets=None,
 ):
     """S3 OLCI extract.
 
@@ -79,8 +148,88 @@ def main(
         pollution (bool): S3 SNOW dirty snow flag
         delta_pol (int): Delta value to consider dirty snow in S3 SNOW
         gains (bool): Consider vicarious calibration gains
+        dem_prods (bool): Run the S3 Snow DEM slope plugin
+        recovery (bool): Only sort the temporary files of a failed run
+        sat_platform (str): Sentinel-3 platform(s) to process (A, B or AB)
+        shard (tuple): Only process the scenes of shard i out of N (i, N)
+        dry_run (bool): Only print the planned (scene, sites) pairs
+        timings_file (PosixPath): Path to the json file storing the timings\
+                                  of the processing stages
+        memory_log (PosixPath): Path to a csv file in which the memory use\
+                                before and after each scene is recorded
+        workers (int): Number of processes sorting the output files
+        layout (str): Output layout: "csv" (one file per site) or "parquet"\
+                      (single dataset partitioned by site and year)
+        cloud_screen (bool): Run the cloud over snow classification first and\
+                             skip the S3 SNOW processor for cloudy pixels
+        terrain_cache_file (PosixPath): Path to a json file caching the DEM\
+                                        values of the sites (optional)
+        terrain_tolerance (float): Maximum distance (m) between pixel centres\
+                                   to reuse cached DEM values, half the\
+                                   pixel diagonal if None
+        variables (list): Variables to compute and write (see\
+                          output_utils.SNOW_VARIABLES), all if None
+        engine (str): Snow properties retrieval: "snap" (S3 SNOW processor),\
+                      "numpy" (snow_engine) or "validate" (S3 SNOW processor\
+                      compared to snow_engine in\
+                      validation/engine_validation.csv)
+        toa_engine (str): TOA reflectance conversion: "snap" (Rad2Refl\
+                          operator) or "numpy" (all sites at once)
+        position_cache_file (PosixPath): Path to a json file caching the\
+                                         pixel positions of the sites\
+                                         (optional)
+        timeout (float): Maximum processing time (s) of a scene: the SNAP\
+                         processing is run in a worker process, restarted\
+                         if a scene takes longer. None to run it in the\
+                         current process.
+        bad_scenes_file (PosixPath): Path to a json file registering the\
+                                     scenes that can't be processed, which\
+                                     are skipped (optional)
+        verify_checksums (bool): Verify the MD5 checksums of the files of\
+                                 each scene before opening it
+        metrics_file (PosixPath): Path to a Prometheus textfile in which the\
+                                  progress and throughput of the run are\
+                                  exported (optional)
+        threads (int): Number of sites of a scene processed concurrently\
+                       with the S3 SNOW processor
+        snap_config_file (PosixPath): Path to a json file containing the\
+                                      SNAP settings (see s3_autotune.py)
+        tile_cache_mb (int): JAI tile cache capacity (MB)
+        tile_size (int): Default tile size (pixels)
+        parallelism (int): Number of threads computing the tiles
+        param_sets (list): S3 SNOW parameter sets (name, pollution,\
+                           pollution delta, gains) to sweep instead of\
+                           pollution, delta_pol and gains: the processing\
+                           upstream of the S3 SNOW processor is shared, and\
+                           a row tagged with the set name ("param_set") is\
+                           written for each set
 
     """
+    # If the run is sharded, write to the shard's own output folder
+    if shard:
+        out_fold = shard_folder(out_fold, shard)
+
+    # The comparison of the engines is written in a sub-folder, apart from
+    # the site files
+    validation_file = out_fold / "validation" / "engine_validation.csv"
+    if engine == "validate":
+        os.makedirs(str(validation_file.parent), exist_ok=True)
+
+    # The cloud flag is needed to tell the pre-screened pixels apart
+    if cloud_screen and variables and "auto_cloud" not in variables:
+        variables = variables + ["auto_cloud"]
+
+    # The numpy engine doesn't compute all the S3 SNOW outputs
+    if engine == "numpy":
+        snow_engine.check_outputs(variables, pollution)
+
+    # The rows of a sweep are tagged with the parameter set, which neither
+    # snow_engine nor the long-format dataset handle
+    if param_sets and (engine != "snap" or layout != "csv"):
+        raise ValueError(
+            "A parameter sweep requires the 'snap' engine and 'csv' layout."
+        )
+
     # Initialise the list of coordinates
     coords = []
 
@@ -90,6 +239,23 @@ def main(
         for row in rdr:
             coords.append((row[0], float(row[1]), float(row[2])))
 
+    # The timings of the processing stages are stored to estimate run times
+    if timings_file is None:
+        timings_file = out_fold / "stage_timings.json"
+
+    # In dry-run mode, only list the sites in the footprint of each scene
+    if dry_run:
+        satfolders = select_platform(list_scenes(sat_fold), sat_platform)
+        if shard:
+            satfolders = select_shard(satfolders, shard)
+
+        plan = plan_run(
+            satfolders, coords, StageTimer(timings_file).averages()
+        )
+        print(json.dumps(plan, indent=1))
+
+        return plan
+
     # If the recovery mode is activated, don't process data: skip to data
     # sorting to salvage the coordinates that were saved
     if recovery:
@@ -112,50 +278,101 @@ def main(
     # If not in recovery mode, then process as normal
     else:
 
-        counter = 1  # Set counter
+        # Reuse the DEM values of the sites from scene to scene
+        if dem_prods and terrain_cache_file:
+            terrain_cache = TerrainCache(terrain_cache_file, terrain_tolerance)
+        else:
+            terrain_cache = None
 
-        # Set the path of the log file for failed processing
-        output_errorfile = out_fold / "failed_log.txt"
+        # Reuse the pixel positions of the sites on the same ground track
+        if position_cache_file:
+            position_cache = PixelPositionCache(position_cache_file)
+        else:
+            position_cache = None
+
+        # Write all sites to a single partitioned dataset instead of csv files
+        if layout == "parquet":
+            dataset_writer = PartitionedWriter(out_fold / "dataset")
+        else:
+            dataset_writer = None
 
         # Run the extraction from S3 and put results in dataframe
-        
-        # List folders in the satellite image directory (include all .SEN3 
+
+        # List folders in the satellite image directory (include all .SEN3
         # folders that are located in sub-directories within 'sat_fold')
-        satfolders = []
-        for p in sat_fold.rglob("*"):
-            if p.as_posix().endswith(".SEN3"):
-                satfolders.append(p)
+        satfolders = select_platform(list_scenes(sat_fold), sat_platform)
+
+        # Only keep the scenes of the shard if the run is split
+        if shard:
+            satfolders = select_shard(satfolders, shard)
+
+        # Run the SNAP processing of the scenes, logging and skipping the
+        # scenes that fail
+        runner = SceneRunner(
+            out_fold,
+            len(satfolders),
+            timings_file,
+            timeout=timeout,
+            memory_log=memory_log,
+            bad_scenes_file=bad_scenes_file,
+            verify_checksums=verify_checksums,
+            metrics_file=metrics_file,
+            snap_settings=read_snap_config(
+                snap_config_file, tile_cache_mb, tile_size, parallelism
+            ),
+        )
 
         for sat_image in satfolders:
 
             # To store results, make a dictionnary with sites as keys
             all_site = dict.fromkeys([x[0] for x in coords], pd.DataFrame())
 
-            # Only process image if it is from the desired platform
+            # Sentinel-3 platform of the image (A or B)
             sat_image_platform = sat_image.name[2]
-            if sat_image_platform != sat_platform and sat_platform != "AB":
-                continue
-
-            total_images = len(satfolders)
 
-            print(
-                "Processing image n°%s/%s: %s"
-                % (counter, total_images, sat_image.name)
-            )
+            if not runner.start(sat_image):
+                continue
 
             # Satellite image's full path
             s3path = sat_image / "xfdumanifest.xml"
 
             # Extract S3 data for the coordinates contained in the images
-            s3_results = getS3values(
-                str(s3path),
-                coords,
-                pollution,
-                delta_pol,
-                gains,
-                dem_prods,
-                output_errorfile,
+            scene_kwargs = {
+                "event_log": runner.event_log,
+                "timer": runner.timer,
+                "cloud_screen": cloud_screen,
+                "terrain_cache": terrain_cache,
+                "variables": variables,
+                "engine": engine,
+                "validation_file": validation_file,
+                "toa_engine": toa_engine,
+                "position_cache": position_cache,
+                "threads": threads,
+                "param_sets": param_sets,
+            }
+            s3_results = runner.run(
+                sat_image,
+                "snappy_funcs.getS3values",
+                (str(s3path), coords, pollution, delta_pol, gains, dem_prods),
+                scene_kwargs,
+                sync=[
+                    x
+                    for x in (
+                        "event_log",
+                        "timer",
+                        "terrain_cache",
+                        "position_cache",
+                    )
+                    if scene_kwargs[x] is not None
+                ],
             )
+            if s3_results is None:
+                continue
+
+            if terrain_cache:
+                terrain_cache.save(terrain_cache_file)
+            if position_cache:
+                position_cache.save(position_cache_file)
 
             # Get time from the satellite image folder (quicker than
             # reading the xml file)
@@ -165,7 +382,24 @@ def main(
 
             # Put the data from the image into a panda dataframe
             for site in s3_results:
-                alb_df = pd.DataFrame(s3_results[site], index=[sat_date])
+                # Consolidated layout: add the values to the dataset
+                if dataset_writer:
+                    dataset_writer.add(
+                        site,
+                        sat_date,
+                        0 if sat_image_platform == "A" else 1,
+                        s3_results[site],
+                    )
+                    continue
+
+                # One row per parameter set in a sweep
+                if param_sets:
+                    site_rows = s3_results[site]
+                else:
+                    site_rows = [s3_results[site]]
+                alb_df = pd.DataFrame(
+                    site_rows, index=[sat_date] * len(site_rows)
+                )
 
                 # Append date and time columns
                 alb_df["year"] = int(sat_date.year)
@@ -190,109 +424,27 @@ def main(
                 fname = "%s_tmp.csv" % site
                 output_file = out_fold / fname
 
-                # Save dataframe to the csv file
-                # Save header if first write
-                if output_file.is_file():
-                    all_site[site].to_csv(
-                        str(output_file),
-                        mode="a",
-                        na_rep=-999,
-                        header=False,
-                        index=False,
-                    )
-                else:
-                    all_site[site].to_csv(
-                        str(output_file),
-                        mode="a",
-                        na_rep=-999,
-                        header=True,
-                        index=False,
-                    )
+                # Save dataframe to the csv file, aligned with the columns
+                # already written (cloudy pixels have fewer columns)
+                append_site_csv(output_file, all_site[site], NA_REP["snow"])
+
+        runner.close()
 
-            counter += 1  # Increment counter
+        # Compact and index the dataset: there are no files to sort
+        if dataset_writer:
+            dataset_writer.close()
+            return
 
     # After having run the process for the images, reopen the temp files
     # and sort the data correctly
-
-    # Set column order for sorted files
-    columns = [
-        "year",
-        "month",
-        "day",
-        "hour",
-        "minute",
-        "second",
-        "dayofyear",
-        "platform",
-        "grain_diameter",
-        "snow_specific_area",
-        "ndsi",
-        "ndbi",
-        "auto_cloud",
-        "sza",
-        "vza",
-        "saa",
-        "vaa",
-    ]
-
-    # If the S3SNOW DEM plugin is run, add columns to the list
-    if dem_prods:
-        [
-            columns.append(x)
-            for x in ["altitude", "slope", "aspect", "elevation_variance"]
-        ]
-
-    # Open temp files
-    for location in coords:
-
-        # Read the csv file to a pandas dataframe
-        csv_name = "%s_tmp.csv" % location[0]
-        incsv = out_fold / csv_name
-
-        if incsv.is_file():
-            temp_df = pd.read_csv(str(incsv), sep=",")
-
-            # Get all rBRR, albedo and reflectance bands and natural sort
-            alb_columns = [x for x in temp_df.columns if "albedo_bb" in x]
-            alb_columns.sort(key=natural_keys)
-            rbrr_columns = [x for x in temp_df.columns if "BRR" in x]
-            rbrr_columns.sort(key=natural_keys)
-            planar_albedo_columns = [
-                x for x in temp_df.columns if "spectral_planar" in x
-            ]
-            planar_albedo_columns.sort(key=natural_keys)
-            rtoa_columns = [x for x in temp_df.columns if "reflectance" in x]
-            rtoa_columns.sort(key=natural_keys)
-
-            # Reorder dataframe colmuns
-            temp_df = temp_df[
-                columns
-                + alb_columns
-                + rtoa_columns
-                + rbrr_columns
-                + planar_albedo_columns
-            ]
-
-            # Reorder dates
-            temp_df["dt"] = pd.to_datetime(
-                temp_df[["year", "month", "day", "hour", "minute", "second"]]
-            )
-            temp_df.set_index("dt", inplace=True)
-            temp_df.sort_index(inplace=True)
-
-            # Save reordered file
-            fname = "%s.csv" % location[0]
-            output_file = out_fold / fname
-
-            # Save dataframe to the csv file
-            temp_df.to_csv(
-                str(output_file),
-                mode="a",
-                na_rep=-999,
-                header=True,
-                index=False,
-            )
-            incsv.unlink()  # Remove temporary file
+    finalize_sites(
+        out_fold,
+        [x[0] for x in coords],
+        "snow",
+        dem_prods=dem_prods,
+        processes=workers,
+        variables=variables,
+    )
 
 
 if __name__ == "__main__":
@@ -387,6 +539,230 @@ if __name__ == "__main__":
             help="Specify the Sentinel-3 platform to include data from."
             "Options are 'A', 'B', or 'AB' (for both platforms).",
         )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Don't process the data: print the sites located in each"
+            " scene and the estimated run time as json.",
+        )
+        parser.add_argument(
+            "--timings",
+            metavar="Stage timings",
+            required=False,
+            default=None,
+            help="Path to the json file storing the timings of the processing"
+            " stages, used for the run time estimates. Defaults to"
+            " 'stage_timings.json' in the output folder.",
+        )
+        parser.add_argument(
+            "--memory-log",
+            metavar="Memory log",
+            required=False,
+            default=None,
+            help="Path to a csv file in which the JVM heap, the resident"
+            " memory of the process running SNAP and the number of open"
+            " products are recorded before and after each scene. A warning"
+            " is printed when the memory keeps growing from scene to scene.",
+        )
+        parser.add_argument(
+            "--workers",
+            metavar="Workers",
+            type=int,
+            required=False,
+            default=1,
+            help="Number of processes sorting the per-site output files at"
+            " the end of the run, defaults to 1.",
+        )
+        parser.add_argument(
+            "--layout",
+            metavar="Output layout",
+            required=False,
+            default="csv",
+            choices=["csv", "parquet"],
+            help="Output layout: 'csv' (one file per site, default) or"
+            " 'parquet': a single long-format dataset partitioned by site"
+            " and year, in the 'dataset' sub-folder (requires pyarrow).",
+        )
+        parser.add_argument(
+            "--cloud-screen",
+            action="store_true",
+            help="Run the Idepix cloud over snow classification first, once"
+            " per scene, and skip the S3 SNOW processor for the cloudy"
+            " pixels: only the cloud flag and the geometry are written for"
+            " them.",
+        )
+        parser.add_argument(
+            "--variables",
+            metavar="Variables",
+            type=parse_variables,
+            required=False,
+            default=None,
+            help="Comma separated list of the variables to compute and write"
+            " (the geometry is always written). Options are: %s. By"
+            " default, all variables are written." % ", ".join(SNOW_VARIABLES),
+        )
+        parser.add_argument(
+            "--engine",
+            metavar="Snow engine",
+            required=False,
+            default="snap",
+            choices=["snap", "numpy", "validate"],
+            help="Retrieval of the snow properties: 'snap' (S3 SNOW"
+            " processor, default), 'numpy' (vectorized retrieval of the"
+            " clean snow properties for all the sites of a scene at once,"
+            " without albedo_bb and the pollution option) or"
+            " 'validate' (S3 SNOW processor, compared to the numpy retrieval"
+            " in 'validation/engine_validation.csv' in the output folder).",
+        )
+        parser.add_argument(
+            "--toa-engine",
+            metavar="TOA engine",
+            required=False,
+            default="snap",
+            choices=["snap", "numpy"],
+            help="Conversion of the radiances to TOA reflectances: 'snap'"
+            " (Rad2Refl operator for each site, default) or 'numpy' (all the"
+            " sites of a scene at once, using the solar flux of each"
+            " detector).",
+        )
+        parser.add_argument(
+            "--terrain-cache",
+            metavar="Terrain cache",
+            required=False,
+            default=None,
+            help="Path to a json file caching the DEM values (altitude,"
+            " slope, aspect, elevation variance) of the sites. With -e, the"
+            " DEM plugin is only run for the sites whose pixel isn't in the"
+            " cache.",
+        )
+        parser.add_argument(
+            "--terrain-tolerance",
+            metavar="Terrain tolerance",
+            type=float,
+            required=False,
+            default=None,
+            help="Maximum distance (m) between the centre of the site's pixel"
+            " and a cached pixel to reuse its DEM values, defaults to half the"
+            " pixel diagonal.",
+        )
+        parser.add_argument(
+            "--position-cache",
+            metavar="Position cache",
+            required=False,
+            default=None,
+            help="Path to a json file caching the pixel positions of the"
+            " sites by ground track (platform, relative orbit and frame)."
+            " A cached position is reused for the next scenes of the track"
+            " if the site is within half the pixel diagonal of the centre of"
+            " the pixel.",
+        )
+        parser.add_argument(
+            "--timeout",
+            metavar="Scene timeout",
+            type=float,
+            required=False,
+            default=None,
+            help="Maximum processing time of a scene in seconds. The SNAP"
+            " processing is run in a worker process, killed and restarted if"
+            " a scene takes longer: the scene is logged in 'failed_log.jsonl'"
+            " and skipped. By default, there is no timeout.",
+        )
+        parser.add_argument(
+            "--bad-scenes",
+            metavar="Bad scenes",
+            required=False,
+            default=None,
+            help="Path to a json file registering the scenes that can't be"
+            " processed, with the reason. The files listed in the manifest of"
+            " each scene are checked (existence and size) before it is"
+            " opened: the corrupt scenes, and the scenes timing out (see"
+            " --timeout), are registered and skipped in the next runs.",
+        )
+        parser.add_argument(
+            "--verify-checksums",
+            action="store_true",
+            help="Also verify the MD5 checksums of the files of each scene"
+            " listed in the manifest (requires reading all the files).",
+        )
+        parser.add_argument(
+            "--metrics-file",
+            metavar="Metrics file",
+            required=False,
+            default=None,
+            help="Path to a Prometheus textfile (e.g. in the node_exporter"
+            " textfile collector folder) in which the progress of the run"
+            " (scenes, sites, rates, estimated time left, stage averages,"
+            " failures by reason) is written after each scene.",
+        )
+        parser.add_argument(
+            "--threads",
+            metavar="Threads",
+            type=int,
+            required=False,
+            default=1,
+            help="Number of sites of a scene processed concurrently with the"
+            " S3 SNOW processor (threads sharing the JVM), defaults to 1.",
+        )
+        parser.add_argument(
+            "--snap-config",
+            metavar="SNAP configuration",
+            required=False,
+            default=None,
+            help="Path to a json file containing the SNAP tile cache, tile"
+            " size and parallelism, written by s3_autotune.py. By default,"
+            " the settings of the snap.properties file are used.",
+        )
+        parser.add_argument(
+            "--tile-cache",
+            metavar="Tile cache",
+            type=int,
+            required=False,
+            default=None,
+            help="JAI tile cache capacity in MB (overrides --snap-config).",
+        )
+        parser.add_argument(
+            "--tile-size",
+            metavar="Tile size",
+            type=int,
+            required=False,
+            default=None,
+            help="Default tile size in pixels (overrides --snap-config).",
+        )
+        parser.add_argument(
+            "--parallelism",
+            metavar="Parallelism",
+            type=int,
+            required=False,
+            default=None,
+            help="Number of threads computing the tiles (overrides"
+            " --snap-config).",
+        )
+        parser.add_argument(
+            "--sweep",
+            metavar="Parameter sets",
+            type=parse_sweep,
+            required=False,
+            default=None,
+            help="Path to a csv file of S3 SNOW parameter sets to sweep"
+            " in a single pass, with a header and one set per line in"
+            " format: param_set,pollution,delta_pol,gains (replaces -p, -d"
+            " and -g). The subset, geometry, TOA reflectances, cloud flag"
+            " and DEM of each site are computed once, and the S3 SNOW"
+            " processor is run for each set. One row per set is written,"
+            " tagged in a 'param_set' column. Requires the 'snap' engine"
+            " and the 'csv' layout.",
+        )
+        parser.add_argument(
+            "-s",
+            "--shard",
+            metavar="Shard",
+            type=parse_shard,
+            required=False,
+            default=None,
+            help="Only process shard i out of N of the scenes, in the format"
+            " i/N. The results are written to a 'shard_i_of_N' sub-folder"
+            " of the output folder, to be merged with s3_merge_shards.py.",
+        )
 
         input_args = parser.parse_args()
 
@@ -401,4 +777,40 @@ if __name__ == "__main__":
             input_args.elevation,
             input_args.recovery,
             input_args.platform,
+            shard=input_args.shard,
+            dry_run=input_args.dry_run,
+            timings_file=Path(input_args.timings) if input_args.timings
+            else None,
+            memory_log=Path(input_args.memory_log)
+            if input_args.memory_log
+            else None,
+            workers=input_args.workers,
+            layout=input_args.layout,
+            cloud_screen=input_args.cloud_screen,
+            terrain_cache_file=Path(input_args.terrain_cache)
+            if input_args.terrain_cache
+            else None,
+            terrain_tolerance=input_args.terrain_tolerance,
+            variables=input_args.variables,
+            engine=input_args.engine,
+            toa_engine=input_args.toa_engine,
+            position_cache_file=Path(input_args.position_cache)
+            if input_args.position_cache
+            else None,
+            timeout=input_args.timeout,
+            bad_scenes_file=Path(input_args.bad_scenes)
+            if input_args.bad_scenes
+            else None,
+            verify_checksums=input_args.verify_checksums,
+            metrics_file=Path(input_args.metrics_file)
+            if input_args.metrics_file
+            else None,
+            threads=input_args.threads,
+            snap_config_file=Path(input_args.snap_config)
+            if input_args.snap_config
+            else None,
+            tile_cache_mb=input_args.tile_cache,
+            tile_size=input_args.tile_size,
+            parallelism=input_args.parallelism,
+            param_sets=input_args.sweep,
         )
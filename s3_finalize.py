@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sort the temporary per-site files of a s3_extract_snow_products or
+s3_band_extract run into the final per-site files, in parallel.
+Written by Maxim Lamare.
+"""
+import sys
+import csv
+from argparse import ArgumentParser
+from pathlib import Path
+
+from output_utils import finalize_sites
+from scene_utils import str2bool
+
+
+def main(out_fold, kind, dem_prods, processes, coords_file=None):
+    """Finalize the outputs of a run.
+
+    Args:
+        out_fold (PosixPath): Path to the output folder of the run
+        kind (str): "snow" for S3 SNOW outputs, "bands" for band extractions
+        dem_prods (bool): The S3 Snow DEM slope plugin was run ("snow" only)
+        processes (int): Number of processes
+        coords_file (PosixPath): Path to a csv containing site coordinates.\
+                                 If None, all the temporary files are sorted.
+    """
+    if coords_file:
+        with open(str(coords_file), "r") as f:
+            sites = [row[0] for row in csv.reader(f)]
+    else:
+        sites = sorted(
+            x.name[: -len("_tmp.csv")] for x in out_fold.glob("*_tmp.csv")
+        )
+
+    done = finalize_sites(out_fold, sites, kind, dem_prods, processes)
+
+    print("%s site files sorted." % len(done))
+
+
+if __name__ == "__main__":
+
+    # If no arguments, return a help message
+    if len(sys.argv) == 1:
+        print(
+            'No arguments provided. Please run the command: "python %s -h"'
+            " for help." % sys.argv[0]
+        )
+        sys.exit(2)
+    else:
+        # Parse Arguments from command line
+        parser = ArgumentParser(
+            description="Sort the temporary per-site files of a run."
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            metavar="Output",
+            required=True,
+            help="Path to the output folder of the run, containing the"
+            " temporary files.",
+        )
+        parser.add_argument(
+            "-k",
+            "--kind",
+            metavar="Output kind",
+            required=True,
+            choices=["snow", "bands"],
+            help="'snow' for s3_extract_snow_products outputs, 'bands' for"
+            " s3_band_extract outputs.",
+        )
+        parser.add_argument(
+            "-e",
+            "--elevation",
+            metavar="S3SNOW dem products",
+            type=str2bool,
+            default=False,
+            help="Boolean condition: the DEM product plugin was run.",
+        )
+        parser.add_argument(
+            "-c",
+            "--coords",
+            metavar="Site coordinates",
+            required=False,
+            default=None,
+            help="Path to the site file of the run (optional). By default,"
+            " all the temporary files of the folder are sorted.",
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            metavar="Workers",
+            type=int,
+            required=False,
+            default=4,
+            help="Number of processes, defaults to 4.",
+        )
+
+        input_args = parser.parse_args()
+
+        # Run main
+        main(
+            Path(input_args.output),
+            input_args.kind,
+            input_args.elevation,
+            input_args.workers,
+            Path(input_args.coords) if input_args.coords else None,
+        )
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Summarise the failed processing logged by s3_extract_snow_products,
+s3_band_extract or s3_extract_server (failed_log.jsonl files).
+Written by Maxim Lamare.
+"""
+import sys
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+
+from run_metrics import read_events
+
+
+def log_files(in_paths):
+    """List the log files to summarise.
+
+    Args:
+        in_paths (list): Paths (PosixPath) to log files, or to output folders\
+                         containing a failed_log.jsonl file (including the\
+                         shard sub-folders of a sharded run)
+
+    Returns:
+        (list): Paths (PosixPath) to the log files
+    """
+    files = []
+    for in_path in in_paths:
+        if in_path.is_dir():
+            files += sorted(in_path.glob("failed_log.jsonl"))
+            files += sorted(in_path.glob("shard_*_of_*/failed_log.jsonl"))
+        else:
+            files.append(in_path)
+
+    return files
+
+
+def summarise(events, key):
+    """Aggregate events.
+
+    Args:
+        events (list): events (dict, see run_metrics.EventLog)
+        key (str): Field the events are grouped by (reason, scene, site or\
+                   stage)
+
+    Returns:
+        (list): for each group, sorted by decreasing number of events, a\
+                dictionnary with the group name, the number of events, of\
+                scenes and of sites, and the number of events by reason
+    """
+    groups = {}
+    for event in events:
+        group = groups.setdefault(
+            event.get(key),
+            {"events": 0, "scenes": set(), "sites": set(), "reasons": {}},
+        )
+        group["events"] += 1
+        group["scenes"].add(event.get("scene"))
+        if event.get("site") is not None:
+            group["sites"].add(event["site"])
+        reason = event.get("reason")
+        group["reasons"][reason] = group["reasons"].get(reason, 0) + 1
+
+    summary = [
+        {
+            key: name,
+            "events": group["events"],
+            "scenes": len(group["scenes"]),
+            "sites": len(group["sites"]),
+            "reasons": group["reasons"],
+        }
+        for name, group in groups.items()
+    ]
+
+    return sorted(summary, key=lambda x: (-x["events"], str(x[key])))
+
+
+def main(in_paths, key, top=None, as_json=False):
+    """Print the summary of the logs.
+
+    Args:
+        in_paths (list): Paths (PosixPath) to log files or output folders
+        key (str): Field the events are grouped by (reason, scene, site or\
+                   stage)
+        top (int): Only print the groups with the most events (all if None)
+        as_json (bool): Print the summary as json
+
+    Returns:
+        (list): summary of the groups (see summarise)
+    """
+    events = []
+    for log_file in log_files(in_paths):
+        events += read_events(log_file)
+
+    summary = summarise(events, key)[:top]
+
+    if as_json:
+        print(json.dumps(summary, indent=1))
+        return summary
+
+    print("%s events" % len(events))
+    print(
+        "%-60s %8s %8s %8s  %s" % (key, "events", "scenes", "sites", "reasons")
+    )
+    for group in summary:
+        print(
+            "%-60s %8s %8s %8s  %s"
+            % (
+                group[key],
+                group["events"],
+                group["scenes"],
+                group["sites"],
+                ", ".join(
+                    "%s: %s" % (x, group["reasons"][x])
+                    for x in sorted(group["reasons"])
+                ),
+            )
+        )
+
+    return summary
+
+
+if __name__ == "__main__":
+
+    # If no arguments, return a help message
+    if len(sys.argv) == 1:
+        print(
+            'No arguments provided. Please run the command: "python %s -h"'
+            " for help." % sys.argv[0]
+        )
+        sys.exit(2)
+    else:
+        # Parse Arguments from command line
+        parser = ArgumentParser(
+            description="Summarise the failed processing of a run."
+        )
+        parser.add_argument(
+            "-i",
+            "--input",
+            metavar="Logs",
+            required=True,
+            nargs="+",
+            help="Paths to failed_log.jsonl files, or to output folders"
+            " containing them (the shard sub-folders are included).",
+        )
+        parser.add_argument(
+            "-b",
+            "--by",
+            metavar="Group by",
+            required=False,
+            default="reason",
+            choices=["reason", "scene", "site", "stage"],
+            help="Field the failures are grouped by: 'reason' (default),"
+            " 'scene', 'site' or 'stage'.",
+        )
+        parser.add_argument(
+            "-n",
+            "--top",
+            metavar="Top",
+            type=int,
+            required=False,
+            default=None,
+            help="Only print the groups with the most failures.",
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            help="Print the summary as json.",
+        )
+
+        input_args = parser.parse_args()
+
+        # Run main
+        main(
+            [Path(x) for x in input_args.input],
+            input_args.by,
+            input_args.top,
+            input_args.json,
+        )
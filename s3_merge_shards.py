@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Merge the outputs of a sharded s3_extract_snow_products or s3_band_extract run
+(see the --shard option) into the final sorted per-site files, or into a
+single dataset for the parquet layout.
+Written by Maxim Lamare.
+"""
+import csv
+import sys
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+import pandas as pd
+
+from output_utils import DT_COLUMNS, merge_datasets
+
+
+def merge_site_files(in_files, output_file, na_rep):
+    """Merge per-site files.
+
+    Concatenate the csv files of a site produced by different shards and sort
+    the rows by acquisition date. The values are read as text so that they are
+    written back unchanged.
+
+    Args:
+        in_files (list): Paths to the csv files of the site in each shard
+        output_file (PosixPath): Path to the merged csv file
+        na_rep (str): Value written for columns missing in some shards
+    """
+    # Read all shard files, keeping the values as they were written
+    site_dfs = [
+        pd.read_csv(str(x), sep=",", dtype=str, keep_default_na=False)
+        for x in in_files
+    ]
+
+    # Keep the column order of the first file, adding unseen columns at the end
+    columns = []
+    for site_df in site_dfs:
+        columns += [x for x in site_df.columns if x not in columns]
+
+    merged_df = pd.concat(site_dfs, ignore_index=True)[columns]
+
+    # Reorder dates
+    merged_df["dt"] = pd.to_datetime(
+        merged_df[["year", "month", "day", "hour", "minute", "second"]].astype(
+            int
+        )
+    )
+    merged_df.sort_values("dt", kind="mergesort", inplace=True)
+    merged_df.drop("dt", axis=1, inplace=True)
+
+    # Save dataframe to the csv file
+    merged_df.to_csv(str(output_file), na_rep=na_rep, header=True, index=False)
+
+
+def is_site_file(csv_file):
+    """Check if a csv file is a per-site output file.
+
+    Args:
+        csv_file (PosixPath): Path to the csv file
+
+    Returns:
+        (bool): the header of the file contains the date columns
+    """
+    with open(str(csv_file), "r") as f:
+        header = next(csv.reader(f), [])
+
+    return all(x in header for x in DT_COLUMNS)
+
+
+def main(shard_folds, out_fold, na_rep):
+    """Merge shards.
+
+    Combine the per-site csv files (or the partitioned datasets of the
+    parquet layout) and the logs of failed processing found in a list of
+    shard output folders into a single output folder.
+
+    Args:
+        shard_folds (list): List of paths (PosixPath) to the shard folders
+        out_fold (PosixPath): Path to a folder in which the merged files will\
+                              be written
+        na_rep (str): Value written for columns missing in some shards
+    """
+    os.makedirs(str(out_fold), exist_ok=True)
+
+    # Gather the final site files of each shard (temporary files are left
+    # out: they have to be recovered in their shard first)
+    site_files = {}
+    for shard in shard_folds:
+        for x in sorted(shard.glob("*.csv")):
+            if x.name.endswith("_tmp.csv"):
+                print("Warning: unsorted temporary file ignored: %s" % x)
+                continue
+            if not is_site_file(x):
+                print("Warning: not a site file, ignored: %s" % x)
+                continue
+            site_files.setdefault(x.stem, []).append(x)
+
+    for counter, site in enumerate(sorted(site_files), 1):
+        print("Merging site n°%s/%s: %s" % (counter, len(site_files), site))
+        merge_site_files(
+            site_files[site], out_fold / ("%s.csv" % site), na_rep
+        )
+
+    # Merge the datasets of the parquet layout (the datasets of the shards
+    # that didn't finish aren't indexed, and are left out)
+    datasets = []
+    for shard in shard_folds:
+        if (shard / "dataset" / "_index.json").is_file():
+            datasets.append(shard / "dataset")
+        elif (shard / "dataset").is_dir():
+            print("Warning: unfinished dataset ignored: %s" % shard)
+    if datasets:
+        print("Merging the datasets of %s shards" % len(datasets))
+        merge_datasets(datasets, out_fold / "dataset")
+
+    # Concatenate the comparisons of the snow engines (validate engine),
+    # keeping the header of the first file
+    shard_files = [
+        x / "validation" / "engine_validation.csv"
+        for x in shard_folds
+        if (x / "validation" / "engine_validation.csv").is_file()
+    ]
+    if shard_files:
+        validation_file = out_fold / "validation" / "engine_validation.csv"
+        os.makedirs(str(validation_file.parent), exist_ok=True)
+        header = not validation_file.is_file()
+        with open(str(validation_file), "a") as fd:
+            for shard_file in shard_files:
+                with open(str(shard_file), "r") as f:
+                    lines = f.readlines()
+                fd.writelines(lines if header else lines[1:])
+                header = False
+
+    # Concatenate the logs of failed processing (json lines, and the text
+    # logs of older runs)
+    for log_name in ("failed_log.jsonl", "failed_log.txt"):
+        shard_logs = [
+            x / log_name for x in shard_folds if (x / log_name).is_file()
+        ]
+        if not shard_logs:
+            continue
+        with open(str(out_fold / log_name), "a") as fd:
+            for shard_log in shard_logs:
+                with open(str(shard_log), "r") as f:
+                    fd.write(f.read())
+
+
+if __name__ == "__main__":
+
+    # If no arguments, return a help message
+    if len(sys.argv) == 1:
+        print(
+            'No arguments provided. Please run the command: "python %s -h"'
+            " for help." % sys.argv[0]
+        )
+        sys.exit(2)
+    else:
+        # Parse Arguments from command line
+        parser = ArgumentParser(
+            description="Merge the outputs of a sharded run."
+        )
+        parser.add_argument(
+            "-i",
+            "--input",
+            metavar="Shard folders",
+            required=True,
+            nargs="+",
+            help="Paths to the shard output folders to merge, or to the"
+            " output folder of the run containing the 'shard_i_of_N'"
+            " sub-folders.",
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            metavar="Output",
+            required=True,
+            help="Path to the output folder, where the merged results will be"
+            " saved.",
+        )
+        parser.add_argument(
+            "-n",
+            "--nodata",
+            metavar="No data value",
+            required=False,
+            default="-999",
+            help="Value written for columns missing in some shards. Defaults"
+            " to '-999' (s3_extract_snow_products), use 'NA' for"
+            " s3_band_extract outputs.",
+        )
+
+        input_args = parser.parse_args()
+
+        # Expand run output folders to their shard sub-folders
+        shard_paths = []
+        for x in input_args.input:
+            sub_shards = sorted(Path(x).glob("shard_*_of_*"))
+            shard_paths += sub_shards if sub_shards else [Path(x)]
+
+        # Run main
+        main(shard_paths, Path(input_args.output), input_args.nodata)
@@ -0,0 +1,697 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Sentinel-3 scene listing and planning functions (no SNAP required)."""
+import hashlib
+import json
+import os
+import re
+from argparse import ArgumentTypeError
+from datetime import datetime
+import xml.etree.ElementTree as ET
+import numpy as np
+from run_metrics import estimate_scene_time
+
+# Band (or TiePointGrid, mask) name patterns specific to each instrument: the
+# OLCI bands and grids, and the view suffix of the SLSTR names (e.g.
+# S1_radiance_an, F1_BT_in, solar_zenith_tn)
+INSTRUMENT_BANDS = {
+    "OLCI": re.compile(
+        "^(Oa[0-9]{2}_|(SZA|SAA|OZA|OAA)$|quality_flags|detector_index$|"
+        "solar_flux_band_|lambda0_band_|FWHM_band_)"
+    ),
+    "SLSTR": re.compile("_[abcift][no](_|$)"),
+}
+
+
+def list_scenes(sat_fold):
+    """List Sentinel-3 scenes.
+
+    List all the .SEN3 folders located in a folder, including the ones
+    located in sub-directories. The scenes are sorted by name so that the
+    listing is identical from one machine to the other.
+
+    Args:
+        sat_fold (PosixPath): Path to a folder containing S3 images
+
+    Returns:
+        (list): list of PosixPath objects pointing to the .SEN3 folders
+    """
+    satfolders = []
+    for p in sat_fold.rglob("*"):
+        if p.as_posix().endswith(".SEN3"):
+            satfolders.append(p)
+
+    return sorted(satfolders, key=lambda x: x.name)
+
+
+def str2bool(instring):
+    """Convert string to boolean.
+
+    Converts an input from a given list of possible inputs to the corresponding
+     boolean.
+
+    Args:
+        instring (str): Input string: has to be in a predefined list.
+
+    Returns:
+        (bool): Boolean according to the input string.
+    """
+    if instring.lower() in ("yes", "true", "t", "y", "1"):
+        return True
+    elif instring.lower() in ("no", "false", "f", "n", "0"):
+        return False
+    else:
+        raise ArgumentTypeError("Boolean value expected.")
+
+
+def parse_shard(instring):
+    """Convert a shard string to a tuple.
+
+    Converts a string in the format "i/N" (shard i out of N shards, with
+    1 <= i <= N) to a tuple of integers. Used as an argparse type.
+
+    Args:
+        instring (str): Input string, e.g. "2/4".
+
+    Returns:
+        (tuple): shard index (int), shard count (int)
+    """
+    try:
+        index, count = [int(x) for x in instring.split("/")]
+    except ValueError:
+        raise ArgumentTypeError("Shard expected in the format i/N, e.g. 1/4.")
+
+    if count < 1 or index < 1 or index > count:
+        raise ArgumentTypeError(
+            "Invalid shard '%s': i has to be between 1 and N." % instring
+        )
+
+    return index, count
+
+
+def scene_shard(scene_name, shard_count):
+    """Get the shard a scene belongs to.
+
+    The shard is computed from a hash of the scene ID (the .SEN3 folder
+    name), so that the partition doesn't depend on the machine, the folder
+    structure or the order in which the scenes are listed.
+
+    Args:
+        scene_name (str): Name of the S3 scene (.SEN3 folder name)
+        shard_count (int): Total number of shards
+
+    Returns:
+        (int): shard index, between 1 and shard_count
+    """
+    digest = hashlib.md5(scene_name.encode("utf-8")).hexdigest()
+
+    return int(digest, 16) % shard_count + 1
+
+
+def select_shard(satfolders, shard):
+    """Select the scenes belonging to a shard.
+
+    Args:
+        satfolders (list): List of paths to S3 scenes (.SEN3 folders)
+        shard (tuple): shard index (int), shard count (int)
+
+    Returns:
+        (list): paths to the scenes to be processed by the shard
+    """
+    index, count = shard
+
+    return [x for x in satfolders if scene_shard(x.name, count) == index]
+
+
+def shard_folder(out_fold, shard):
+    """Create the output folder of a shard.
+
+    Each shard writes its results in a sub-folder of the output folder, named
+    "shard_<i>_of_<N>", to be combined later with s3_merge_shards.py.
+
+    Args:
+        out_fold (PosixPath): Path to the output folder of the run
+        shard (tuple): shard index (int), shard count (int)
+
+    Returns:
+        (PosixPath): path to the output folder of the shard
+    """
+    shard_out = out_fold / ("shard_%s_of_%s" % shard)
+    os.makedirs(str(shard_out), exist_ok=True)
+
+    return shard_out
+
+
+def product_info(scene_name):
+    """Get the product information from a scene name.
+
+    Parse the Sentinel-3 file naming convention, e.g.
+    S3A_OL_1_EFR____20190101T101010_20190101T101310_20190102T123456_0179_040_\
+    008_1800_LN1_O_NT_002.SEN3
+
+    Args:
+        scene_name (str): Name of the S3 scene (.SEN3 folder name)
+
+    Returns:
+        (dict): platform (str), instrument (str), product type (str),
+        acquisition start time (datetime), relative orbit (str), frame\
+        along-track position (str) and processing baseline (str) of the\
+        scene
+    """
+    fields = scene_name.split("_")
+
+    return {
+        "platform": scene_name[2],
+        "instrument": {"OL": "OLCI", "SL": "SLSTR"}.get(scene_name[4:6]),
+        "product_type": scene_name[4:15].rstrip("_"),
+        "start_time": datetime.strptime(fields[7], "%Y%m%dT%H%M%S"),
+        "relative_orbit": fields[12],
+        "frame": fields[13],
+        "baseline": scene_name.split(".")[0].split("_")[-1],
+    }
+
+
+def band_instrument(band_names):
+    """Guess the Sentinel-3 instrument from a list of band names.
+
+    Args:
+        band_names (list): Names of OLCI or SLSTR bands, TiePointGrids or\
+                           masks
+
+    Returns:
+        (str): "OLCI" or "SLSTR", or None if no band is specific to an\
+               instrument
+
+    Raises:
+        ValueError: if the bands are from both instruments
+    """
+    instruments = set(
+        instrument
+        for band in band_names
+        for instrument, pattern in INSTRUMENT_BANDS.items()
+        if pattern.search(band)
+    )
+
+    if len(instruments) > 1:
+        raise ValueError("The bands are from both OLCI and SLSTR.")
+
+    return instruments.pop() if instruments else None
+
+
+def track_key(scene_name, resolution=None):
+    """Get the ground track key of a scene.
+
+    Sentinel-3 repeats its ground track every 27 days: the scenes of a
+    platform with the same relative orbit and frame cover the same area, with
+    the sites at almost the same pixel positions.
+
+    Args:
+        scene_name (str): Name of the S3 scene (.SEN3 folder name)
+        resolution (str): SLSTR grid the product is read on (optional)
+
+    Returns:
+        (str): product type, platform, relative orbit and frame of the scene\
+               (and resolution if provided), e.g. OL_1_EFR_A_008_1800
+    """
+    info = product_info(scene_name)
+    key = "%s_%s_%s_%s" % (
+        info["product_type"],
+        info["platform"],
+        info["relative_orbit"],
+        info["frame"],
+    )
+
+    if resolution:
+        key += "_%s" % resolution
+
+    return key
+
+
+def manifest_files(s3path):
+    """List the data files of a scene.
+
+    Parse the data object section of the xfdumanifest.xml file of a scene to
+    get the NetCDF files it is made of.
+
+    Args:
+        s3path (PosixPath): Path to a S3 image xfdumanisfest.xml file
+
+    Returns:
+        (list): list of dictionnaries containing the path (PosixPath), the
+        expected size in bytes (int) and the MD5 checksum (str, None if not
+        listed) of each file
+    """
+    xlm_root = ET.parse(str(s3path)).getroot()
+
+    data_files = []
+    for data_object in xlm_root.iter("dataObject"):
+        byte_stream = data_object.find(".//byteStream")
+        file_location = data_object.find(".//fileLocation")
+        if byte_stream is None or file_location is None:
+            continue
+        checksum = byte_stream.find(".//checksum")
+        data_files.append(
+            {
+                "path": s3path.parent / file_location.attrib["href"],
+                "size": int(byte_stream.attrib.get("size", -1)),
+                "md5": checksum.text.strip().lower()
+                if checksum is not None and checksum.text
+                else None,
+            }
+        )
+
+    return data_files
+
+
+def md5sum(file_path, chunk_size=2 ** 20):
+    """Compute the MD5 checksum of a file.
+
+    Args:
+        file_path (PosixPath): Path to the file
+        chunk_size (int): Number of bytes read at a time
+
+    Returns:
+        (str): hexadecimal MD5 checksum
+    """
+    md5 = hashlib.md5()
+    with open(str(file_path), "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def check_scene(sat_image, checksums=False):
+    """Check the integrity of the files of a scene.
+
+    The data files listed in the xfdumanifest.xml file must exist and have
+    the expected size. This is cheap compared to opening the scene with SNAP
+    and catches the truncated downloads. The MD5 checksums are optionally
+    verified, which requires reading all the files.
+
+    Args:
+        sat_image (PosixPath): Path to a S3 scene (.SEN3 folder)
+        checksums (bool): Also verify the MD5 checksums of the files
+
+    Returns:
+        (str): reason why the scene is corrupt, None if the scene is valid
+    """
+    s3path = sat_image / "xfdumanifest.xml"
+    if not s3path.is_file():
+        return "Missing xfdumanifest.xml."
+
+    try:
+        data_files = manifest_files(s3path)
+    except ET.ParseError as err:
+        return "Unreadable xfdumanifest.xml: %s." % err
+
+    if not data_files:
+        return "No data files listed in xfdumanifest.xml."
+
+    for data_file in data_files:
+        if not data_file["path"].is_file():
+            return "Missing file: %s." % data_file["path"].name
+
+        size = data_file["path"].stat().st_size
+        if data_file["size"] >= 0 and size != data_file["size"]:
+            return "Wrong size: %s (%s bytes instead of %s)." % (
+                data_file["path"].name,
+                size,
+                data_file["size"],
+            )
+
+        if (
+            checksums
+            and data_file["md5"]
+            and md5sum(data_file["path"]) != data_file["md5"]
+        ):
+            return "Wrong MD5 checksum: %s." % data_file["path"].name
+
+    return None
+
+
+def nc_variables(nc_path):
+    """Read the variables in a NetCDF file header.
+
+    Only the header is read, no data is loaded. Requires the netCDF4 library.
+
+    Args:
+        nc_path (PosixPath): Path to a NetCDF file
+
+    Returns:
+        (dict): variable names as keys and the variable attributes\
+                (dictionnary) as values
+    """
+    from netCDF4 import Dataset  # Optional dependency, only for listing
+
+    with Dataset(str(nc_path)) as nc:
+        nc_vars = {}
+        for name, var in nc.variables.items():
+            # Skip the coordinate variables (named after their dimension)
+            if name in nc.dimensions:
+                continue
+            nc_vars[name] = {x: var.getncattr(x) for x in var.ncattrs()}
+
+    return nc_vars
+
+
+def instrument_solar_flux(s3path):
+    """Read the solar flux of each OLCI band and detector.
+
+    The flux is read from the instrument_data.nc file of the scene. Requires
+    the netCDF4 library.
+
+    Args:
+        s3path (PosixPath): Path to a S3 OLCI scene (.SEN3 folder or its\
+                            xfdumanifest.xml file)
+
+    Returns:
+        (numpy.ndarray): solar flux (bands x detectors), or None if the file\
+                         can't be read
+    """
+    try:
+        from netCDF4 import Dataset  # Optional dependency
+    except ImportError:
+        return None
+
+    if s3path.name == "xfdumanifest.xml":
+        s3path = s3path.parent
+    nc_path = s3path / "instrument_data.nc"
+
+    if not nc_path.is_file():
+        return None
+
+    with Dataset(str(nc_path)) as nc:
+        if "solar_flux" not in nc.variables:
+            return None
+        # Masked values (fill values) are set to NaN
+        solar_flux = np.ma.filled(
+            nc.variables["solar_flux"][:].astype(float), np.nan
+        )
+
+    return solar_flux
+
+
+def scene_band_names(sat_image):
+    """List the bands of a scene without SNAP.
+
+    Derive the band, TiePointGrid and mask names of a S3 OLCI or SLSTR scene
+    from the files listed in the manifest and their NetCDF headers, following
+    the naming used by the SNAP readers: the variables of the tie point files
+    are TiePointGrids, and a mask is created for each meaning of a flag
+    variable. If the netCDF4 library is not available, the names are guessed
+    from the file names only, and no masks are returned.
+
+    Args:
+        sat_image (PosixPath): Path to a S3 scene (.SEN3 folder)
+
+    Returns:
+        (tuple): band names (list), TiePointGrid names (list), mask names\
+                 (list)
+    """
+    try:
+        import netCDF4  # noqa: F401
+        read_headers = True
+    except ImportError:
+        read_headers = False
+
+    # Accept the path to the manifest file itself
+    if sat_image.is_file():
+        sat_image = sat_image.parent
+
+    band_names = []
+    tpg_names = []
+    mask_names = []
+    for data_file in manifest_files(sat_image / "xfdumanifest.xml"):
+        nc_name = data_file["path"].stem
+
+        # OLCI tie point files start with "tie_", SLSTR ones end with the
+        # tie point grid suffix ("_tn", "_to" or "_tx")
+        is_tpg = nc_name.startswith("tie_") or nc_name[-3:] in (
+            "_tn",
+            "_to",
+            "_tx",
+        )
+
+        if read_headers:
+            nc_vars = nc_variables(data_file["path"])
+        else:
+            nc_vars = {nc_name: {}}
+
+        for name, attributes in nc_vars.items():
+            # SNAP prefixes the OLCI tie point coordinates with TP_
+            if nc_name == "tie_geo_coordinates":
+                name = "TP_%s" % name
+
+            if is_tpg:
+                tpg_names.append(name)
+            else:
+                band_names.append(name)
+
+            # Each flag meaning is a mask
+            if "flag_meanings" in attributes:
+                mask_names += [
+                    "%s_%s" % (name, x)
+                    for x in attributes["flag_meanings"].split()
+                ]
+
+    return band_names, tpg_names, mask_names
+
+
+def select_platform(satfolders, sat_platform):
+    """Select the scenes acquired by a Sentinel-3 platform.
+
+    Args:
+        satfolders (list): List of paths to S3 scenes (.SEN3 folders)
+        sat_platform (str): Sentinel-3 platform(s) to keep (A, B or AB)
+
+    Returns:
+        (list): paths to the scenes acquired by the platform
+    """
+    if sat_platform == "AB":
+        return list(satfolders)
+
+    return [x for x in satfolders if x.name[2] == sat_platform]
+
+
+def scene_footprint(s3path):
+    """Get the footprint of a scene.
+
+    Read the footprint polygon stored in the xfdumanifest.xml file of a scene.
+
+    Args:
+        s3path (PosixPath): Path to a S3 image xfdumanisfest.xml file
+
+    Returns:
+        (list): list of (lat, lon) tuples of the polygon vertices in degrees
+    """
+    xlm_root = ET.parse(str(s3path)).getroot()
+
+    for child in xlm_root.iter():
+        if child.tag.endswith("posList"):
+            values = [float(x) for x in child.text.split()]
+            return list(zip(values[0::2], values[1::2]))
+
+    return []
+
+
+def in_footprint(footprint, inlat, inlon):
+    """Test if a coordinate is located within a footprint.
+
+    Ray casting point in polygon test, on the lat/lon coordinates. Footprints
+    crossing the antimeridian are handled by shifting the longitudes to the
+    0-360 range.
+
+    Args:
+        footprint (list): list of (lat, lon) tuples of the polygon vertices
+        inlat (float): latitude of the coordinate in degrees EPSG:4326
+        inlon (float): longitude of the coordinate in degrees EPSG:4326
+
+    Returns:
+        (bool): True if the coordinate is in the footprint
+    """
+    lons = [x[1] for x in footprint]
+    if lons and max(lons) - min(lons) > 180:
+        footprint = [(x[0], x[1] % 360) for x in footprint]
+        inlon = inlon % 360
+
+    inside = False
+    for (lat1, lon1), (lat2, lon2) in zip(
+        footprint, footprint[1:] + footprint[:1]
+    ):
+        if (lat1 > inlat) != (lat2 > inlat):
+            cross_lon = lon1 + (inlat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+            if inlon < cross_lon:
+                inside = not inside
+
+    return inside
+
+
+def plan_run(satfolders, coords, averages=None):
+    """Plan a processing run.
+
+    List the sites located in the footprint of each scene, using only the
+    manifest files, and estimate the processing time of each scene from the
+    timings of previous runs.
+
+    Args:
+        satfolders (list): List of paths to S3 scenes (.SEN3 folders)
+        coords (list): List of coordinates (name, lat, lon) to extract
+        averages (dict): average time (s) of each stage (see StageTimer)
+
+    Returns:
+        (dict): planned scenes, with the sites they contain, and summary
+    """
+    plan = []
+    for sat_image in satfolders:
+        footprint = scene_footprint(sat_image / "xfdumanifest.xml")
+        sites = [x[0] for x in coords if in_footprint(footprint, x[1], x[2])]
+        plan.append(
+            {
+                "scene": sat_image.name,
+                "path": str(sat_image),
+                "n_sites": len(sites),
+                "sites": sites,
+                "estimated_seconds": estimate_scene_time(len(sites), averages),
+            }
+        )
+
+    # Sites located in none of the scenes often point to a wrong site file
+    # (e.g. swapped lat/lon columns)
+    found_sites = set(x for scene in plan for x in scene["sites"])
+
+    if averages:
+        total_time = sum(x["estimated_seconds"] for x in plan)
+    else:
+        total_time = None
+
+    return {
+        "scenes": plan,
+        "n_scenes": len(plan),
+        "n_scenes_with_sites": len([x for x in plan if x["n_sites"]]),
+        "n_pairs": sum(x["n_sites"] for x in plan),
+        "sites_not_found": [x[0] for x in coords if x[0] not in found_sites],
+        "estimated_seconds": total_time,
+    }
+
+
+class SceneCatalog(object):
+    """Catalog of the scenes of an archive.
+
+    Index the scenes of a folder by acquisition time and footprint, so that
+    the scenes containing a coordinate can be found without listing the
+    archive again.
+
+    Args:
+        sat_fold (PosixPath): Path to a folder containing S3 images
+    """
+
+    def __init__(self, sat_fold):
+        self.sat_fold = sat_fold
+        self.scenes = {}
+        self.refresh()
+
+    def refresh(self):
+        """Add the new scenes of the archive to the catalog.
+
+        Returns:
+            (int): number of scenes added
+        """
+        new_scenes = [
+            x for x in list_scenes(self.sat_fold) if x.name not in self.scenes
+        ]
+
+        for sat_image in new_scenes:
+            scene = product_info(sat_image.name)
+            scene["path"] = sat_image
+            scene["footprint"] = scene_footprint(
+                sat_image / "xfdumanifest.xml"
+            )
+            self.scenes[sat_image.name] = scene
+
+        return len(new_scenes)
+
+    def query(self, inlat, inlon, start=None, end=None, s3_instrument=None):
+        """Find the scenes containing a coordinate.
+
+        Args:
+            inlat (float): latitude of the coordinate in degrees EPSG:4326
+            inlon (float): longitude of the coordinate in degrees EPSG:4326
+            start (datetime): Only scenes acquired after this time
+            end (datetime): Only scenes acquired before this time
+            s3_instrument (str): Only scenes of this instrument (OLCI or\
+                                 SLSTR)
+
+        Returns:
+            (list): the matching scenes (dict, see product_info), sorted by\
+                    acquisition time
+        """
+        matches = []
+        # Copy the scene list: the catalog can be refreshed meanwhile
+        for scene in list(self.scenes.values()):
+            if start and scene["start_time"] < start:
+                continue
+            if end and scene["start_time"] > end:
+                continue
+            if s3_instrument and scene["instrument"] != s3_instrument:
+                continue
+            if in_footprint(scene["footprint"], inlat, inlon):
+                matches.append(scene)
+
+        return sorted(matches, key=lambda x: x["start_time"])
+
+
+class BadSceneRegistry(object):
+    """Registry of the scenes that can't be processed.
+
+    The corrupt scenes (failed integrity check, see check_scene) and the
+    scenes that made SNAP hang are recorded with the reason, so that they are
+    skipped without being opened again. The registry can be saved to a json
+    file to be reused from run to run. A scene is processed again once it is
+    removed from the file (e.g. after downloading it again).
+
+    Args:
+        json_file (PosixPath): Path to a json file containing the scenes of\
+                               previous runs (optional)
+    """
+
+    def __init__(self, json_file=None):
+        self.entries = {}
+
+        if json_file and json_file.is_file():
+            with open(str(json_file), "r") as f:
+                self.entries = json.load(f)
+
+    def get(self, scene_name):
+        """Get the reason why a scene is registered.
+
+        Args:
+            scene_name (str): Name of the scene (.SEN3 folder)
+
+        Returns:
+            (str): reason, None if the scene isn't registered
+        """
+        entry = self.entries.get(scene_name)
+
+        return entry["reason"] if entry else None
+
+    def add(self, scene_name, reason):
+        """Register a scene.
+
+        Args:
+            scene_name (str): Name of the scene (.SEN3 folder)
+            reason (str): Why the scene can't be processed
+        """
+        self.entries[scene_name] = {
+            "reason": reason,
+            "time": datetime.now().isoformat(),
+        }
+
+    def save(self, json_file):
+        """Save the registry to a json file.
+
+        Args:
+            json_file (PosixPath): Path to the output json file
+        """
+        with open(str(json_file), "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Run the SNAP processing of the scenes under a timeout (no SNAP required)."""
+import importlib
+import queue
+import time
+from multiprocessing import Process, Queue
+
+from run_metrics import EventLog, MemoryMonitor, ProgressMonitor, StageTimer
+from scene_utils import BadSceneRegistry, check_scene
+
+
+class SceneTimeout(Exception):
+    """The processing of a scene took longer than the timeout."""
+
+
+def call_function(func_name, args, kwargs):
+    """Import and call a function.
+
+    Args:
+        func_name (str): Module and name of the function (e.g.\
+                         "snappy_funcs.getS3values")
+        args (tuple): Positional arguments of the function
+        kwargs (dict): Keyword arguments of the function
+
+    Returns:
+        the result of the function
+    """
+    module_name, name = func_name.rsplit(".", 1)
+    func = getattr(importlib.import_module(module_name), name)
+
+    return func(*args, **kwargs)
+
+
+def _worker_loop(tasks, results):
+    """Run the functions received from the parent process."""
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        func_name, args, kwargs, sync = task
+
+        try:
+            result = call_function(func_name, args, kwargs)
+        except Exception as err:  # Report the error to the parent
+            results.put(("error", repr(err), None))
+            continue
+
+        # Send back the objects updated by the function
+        results.put(("ok", result, {x: kwargs[x] for x in sync}))
+
+
+class SceneWatchdog(object):
+    """Run functions in a worker process, with a timeout.
+
+    SNAP can hang indefinitely on some corrupt products, which the exception
+    handling can't catch. The processing functions are run in a worker
+    process (where the JVM is started): if a call doesn't return within the
+    timeout, the worker is killed and a new one is started for the next
+    call. The functions are passed by name, so that SNAP is never imported
+    in the parent process. If no timeout is set, the functions are called in
+    the current process.
+
+    Args:
+        timeout (float): Maximum time (s) of a call, None to run the calls\
+                         in the current process
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.worker = None
+        self.tasks = None
+        self.results = None
+
+    def start(self):
+        """Start a new worker process."""
+        self.tasks = Queue()
+        self.results = Queue()
+        self.worker = Process(
+            target=_worker_loop, args=(self.tasks, self.results)
+        )
+        self.worker.daemon = True
+        self.worker.start()
+
+    def call(self, func_name, args=(), kwargs=None, sync=()):
+        """Call a function, in the worker process if a timeout is set.
+
+        Args:
+            func_name (str): Module and name of the function (e.g.\
+                             "snappy_funcs.getS3values")
+            args (tuple): Positional arguments of the function
+            kwargs (dict): Keyword arguments of the function
+            sync (tuple): Names of the keyword arguments updated by the\
+                          function (e.g. a StageTimer), whose state is copied\
+                          back from the worker
+
+        Returns:
+            the result of the function
+
+        Raises:
+            SceneTimeout: the call took longer than the timeout
+            RuntimeError: the function raised an error, or the worker\
+                          process crashed
+        """
+        kwargs = kwargs or {}
+
+        if not self.timeout:
+            # Report the errors as the worker process does
+            try:
+                return call_function(func_name, args, kwargs)
+            except Exception as err:
+                raise RuntimeError(repr(err)) from err
+
+        if self.worker is None or not self.worker.is_alive():
+            self.start()
+
+        self.tasks.put((func_name, args, kwargs, sync))
+
+        # Wait for the result, checking that the worker didn't crash
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                status, result, synced = self.results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    self.worker = None
+                    raise RuntimeError("The worker process stopped.")
+                if time.time() > deadline:
+                    self.kill()
+                    raise SceneTimeout(
+                        "No result after %s s, worker restarted."
+                        % self.timeout
+                    )
+
+        if status == "error":
+            raise RuntimeError(result)
+
+        for name in sync:
+            kwargs[name].__dict__.update(synced[name].__dict__)
+
+        return result
+
+    def kill(self):
+        """Kill the worker process."""
+        if self.worker is not None:
+            self.worker.terminate()
+            self.worker.join(5)
+            self.worker = None
+
+    def close(self):
+        """Stop the worker process."""
+        if self.worker is not None and self.worker.is_alive():
+            self.tasks.put(None)
+            self.worker.join(30)
+        self.kill()
+
+
+class SceneRunner(object):
+    """Run the SNAP processing of the scenes of an extraction run.
+
+    Keep the objects shared by the scenes of a s3_extract_snow_products or
+    s3_band_extract run: the watchdog running SNAP, the log of the failed
+    processing, the stage timer, the bad scene registry, the memory monitor
+    and the progress monitor. For each scene, the registry is checked (see
+    start), then the SNAP processing is run and the monitors updated (see
+    run). A scene that hangs is logged, registered and skipped. A scene
+    whose processing fails is logged and skipped, but not registered: the
+    error can come from the settings of the run (e.g. a mistyped band name)
+    rather than from the scene.
+
+    Args:
+        out_fold (PosixPath): Path to the output folder of the run
+        n_scenes (int): Number of scenes of the run
+        timings_file (PosixPath): Path to the json file storing the timings\
+                                  of the processing stages
+        timeout (float): Maximum processing time (s) of a scene, None to run\
+                         SNAP in the current process
+        memory_log (PosixPath): Path to the csv file of the memory use\
+                                (optional)
+        bad_scenes_file (PosixPath): Path to the json file registering the\
+                                     bad scenes (optional)
+        verify_checksums (bool): Verify the MD5 checksums of the files of\
+                                 each scene before opening it
+        metrics_file (PosixPath): Path to a Prometheus textfile (optional)
+        snap_settings (dict): SNAP settings applied before each scene (see\
+                              snap_config.read_snap_config)
+    """
+
+    def __init__(
+        self,
+        out_fold,
+        n_scenes,
+        timings_file,
+        timeout=None,
+        memory_log=None,
+        bad_scenes_file=None,
+        verify_checksums=False,
+        metrics_file=None,
+        snap_settings=None,
+    ):
+        self.n_scenes = n_scenes
+        self.timings_file = timings_file
+        self.timeout = timeout
+        self.bad_scenes_file = bad_scenes_file
+        self.verify_checksums = verify_checksums
+        self.snap_settings = snap_settings or {}
+        self.counter = 0
+
+        # Log the failed processing (json lines, written in batches)
+        self.event_log = EventLog(out_fold / "failed_log.jsonl")
+
+        # Time the processing stages, adding to the previous runs
+        self.timer = StageTimer(timings_file)
+
+        # Run the SNAP processing in a worker process restarted if a scene
+        # hangs (in the current process if no timeout is set)
+        self.snap = SceneWatchdog(timeout)
+
+        # Skip the known bad scenes, and check the files of the others before
+        # opening them
+        if bad_scenes_file or verify_checksums:
+            self.bad_scenes = BadSceneRegistry(bad_scenes_file)
+        else:
+            self.bad_scenes = None
+
+        # Record the memory use around each scene to track leaks
+        if memory_log:
+            self.memory_monitor = MemoryMonitor(memory_log)
+        else:
+            self.memory_monitor = None
+
+        # Report the throughput and the estimated time left
+        self.progress = ProgressMonitor(
+            n_scenes, metrics_file, {"output": str(out_fold)}
+        )
+
+    def start(self, sat_image):
+        """Start the processing of a scene.
+
+        Args:
+            sat_image (PosixPath): Path to the scene (.SEN3 folder)
+
+        Returns:
+            (bool): the scene can be processed, False if it is a bad scene\
+                    (logged and skipped)
+        """
+        self.counter += 1
+        print(
+            "Processing image n°%s/%s: %s (%s)"
+            % (
+                self.counter,
+                self.n_scenes,
+                sat_image.name,
+                self.progress.status(),
+            )
+        )
+
+        if self.bad_scenes is None:
+            return True
+
+        reason = self.bad_scenes.get(sat_image.name)
+        if reason is None:
+            reason = check_scene(sat_image, self.verify_checksums)
+            if reason:
+                self.register(sat_image.name, reason)
+
+        if reason:
+            self.event_log.log(
+                sat_image.name, "bad_scene", reason, stage="check"
+            )
+            self.progress.update(skipped=True, failures=self.event_log.counts)
+            return False
+
+        return True
+
+    def register(self, scene_name, reason):
+        """Register a bad scene, if the registry is enabled.
+
+        Args:
+            scene_name (str): Name of the scene
+            reason (str): Why the scene can't be processed
+        """
+        if self.bad_scenes is None:
+            return
+
+        self.bad_scenes.add(scene_name, reason)
+        if self.bad_scenes_file:
+            self.bad_scenes.save(self.bad_scenes_file)
+
+    def run(self, sat_image, func_name, args=(), kwargs=None, sync=()):
+        """Run the SNAP processing of a scene.
+
+        The SNAP settings are applied (again if the worker was restarted)
+        and the memory use is recorded around the processing. snappy is only
+        imported by the functions called: starting the JVM takes time and
+        requires SNAP, which isn't needed in recovery mode or to sort the
+        outputs.
+
+        Args:
+            sat_image (PosixPath): Path to the scene (.SEN3 folder)
+            func_name (str): Module and name of the processing function\
+                             (e.g. "snappy_funcs.getS3values")
+            args (tuple): Positional arguments of the function
+            kwargs (dict): Keyword arguments of the function
+            sync (tuple): Names of the keyword arguments updated by the\
+                          function (see SceneWatchdog.call)
+
+        Returns:
+            (dict): values of each site returned by the function, or None if\
+                    the scene timed out or its processing failed
+        """
+        try:
+            if self.snap_settings:
+                self.snap.call(
+                    "snappy_funcs.configure_snap", kwargs=self.snap_settings
+                )
+
+            if self.memory_monitor:
+                self.memory_monitor.record(
+                    sat_image.name,
+                    "before",
+                    self.snap.call("snappy_funcs.memory_state"),
+                )
+
+            results = self.snap.call(func_name, args, kwargs, sync)
+        except (SceneTimeout, RuntimeError) as err:
+            # The scene hung, or its processing failed (error raised or
+            # worker process crashed): log the scene and move on to the next
+            # one
+            if isinstance(err, SceneTimeout):
+                reason, message = "timeout", "Timed out. %s" % err
+            else:
+                reason, message = "scene_error", "Failed. %s" % err
+            self.event_log.log(
+                sat_image.name,
+                reason,
+                message,
+                stage="scene",
+                duration=self.timeout if reason == "timeout" else None,
+            )
+            if reason == "timeout":
+                self.register(sat_image.name, message)
+            self.progress.update(skipped=True, failures=self.event_log.counts)
+            return None
+
+        self.timer.save(self.timings_file)
+        self.event_log.flush()
+        self.progress.update(
+            len(results),
+            averages=self.timer.averages(),
+            failures=self.event_log.counts,
+        )
+
+        if self.memory_monitor:
+            self.memory_monitor.record(
+                sat_image.name,
+                "after",
+                self.snap.call(
+                    "snappy_funcs.memory_state", kwargs={"run_gc": True}
+                ),
+            )
+
+        return results
+
+    def close(self):
+        """Stop the worker process, write the log and print a summary."""
+        self.snap.close()
+        self.event_log.flush()
+        print(
+            "%s scenes processed, %s skipped: %s"
+            % (
+                self.progress.scenes,
+                self.progress.skipped,
+                self.progress.status(),
+            )
+        )
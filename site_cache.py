@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Caches of per-site values reused from scene to scene (no SNAP required)."""
+import json
+import math
+import threading
+
+# Mean Earth radius (m)
+EARTH_RADIUS = 6371000.0
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Get the great-circle distance between two points.
+
+    Args:
+        lat1 (float): latitude of the first point in degrees
+        lon1 (float): longitude of the first point in degrees
+        lat2 (float): latitude of the second point in degrees
+        lon2 (float): longitude of the second point in degrees
+
+    Returns:
+        (float): distance in meters
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+
+    a = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class TerrainCache(object):
+    """Cache of the DEM products of the sites.
+
+    The altitude, slope, aspect and elevation variance of a site only depend
+    on the OLCI pixel the site falls in. The values computed by the S3 SNOW
+    DEM plugin are stored with the coordinates of the centre of the pixel,
+    and reused for a later scene if the centre of the site's pixel is within
+    a tolerance of a stored one. The cache can be saved to a json file to be
+    reused from run to run.
+
+    Args:
+        json_file (PosixPath): Path to a json file containing the values of\
+                               previous runs (optional)
+        tolerance (float): Maximum distance (m) between the pixel centres to\
+                           reuse the values. If None, the tolerance passed\
+                           to get (half the diagonal of the pixel).
+    """
+
+    def __init__(self, json_file=None, tolerance=None):
+        self.tolerance = tolerance
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if json_file and json_file.is_file():
+            with open(str(json_file), "r") as f:
+                self.entries = json.load(f)
+
+    def get(self, site, lat, lon, tolerance=None):
+        """Get the DEM values of a site.
+
+        Args:
+            site (str): Name of the site
+            lat (float): latitude of the centre of the site's pixel
+            lon (float): longitude of the centre of the site's pixel
+            tolerance (float): Maximum distance (m) between the pixel centres\
+                               if the cache has no tolerance (e.g. half the\
+                               diagonal of the pixel)
+
+        Returns:
+            (dict): DEM values of the nearest stored pixel, or None if no\
+                    pixel is within the tolerance
+        """
+        if self.tolerance is not None:
+            tolerance = self.tolerance
+
+        nearest = None
+        with self.lock:
+            for entry in self.entries.get(site, []):
+                distance = distance_m(lat, lon, entry["lat"], entry["lon"])
+                if distance <= tolerance and (
+                    nearest is None or distance < nearest[0]
+                ):
+                    nearest = (distance, entry)
+
+            if nearest is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+        return dict(nearest[1]["values"])
+
+    def add(self, site, lat, lon, values):
+        """Store the DEM values of a site.
+
+        Args:
+            site (str): Name of the site
+            lat (float): latitude of the centre of the site's pixel
+            lon (float): longitude of the centre of the site's pixel
+            values (dict): DEM band names and values
+        """
+        with self.lock:
+            self.entries.setdefault(site, []).append(
+                {"lat": lat, "lon": lon, "values": dict(values)}
+            )
+
+    def __getstate__(self):
+        # The lock can't be pickled (e.g. to be sent to the scene_watchdog
+        # worker): a new one is created when unpickling
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def save(self, json_file):
+        """Save the cache to a json file.
+
+        Args:
+            json_file (PosixPath): Path to the output json file
+        """
+        with open(str(json_file), "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+
+class PixelPositionCache(object):
+    """Cache of the pixel positions of the sites.
+
+    The scenes acquired on the same ground track (platform, relative orbit
+    and frame, see scene_utils.track_key) place a site at almost the same
+    pixel. The position found for a site is stored by track, and reused for
+    a later scene of the same track if the centre of the cached pixel is
+    within a tolerance of the site (checked with a single geolocation
+    query). Otherwise, the position is computed again and the cache updated.
+
+    Args:
+        json_file (PosixPath): Path to a json file containing the positions\
+                               of previous runs (optional)
+        tolerance (float): Maximum distance (m) between the site and the\
+                           centre of the cached pixel to reuse the position.\
+                           If None, half the diagonal of the pixel of the\
+                           product (OLCI or SLSTR grid).
+    """
+
+    def __init__(self, json_file=None, tolerance=None):
+        self.tolerance = tolerance
+        self.entries = {}
+
+        if json_file and json_file.is_file():
+            with open(str(json_file), "r") as f:
+                self.entries = json.load(f)
+
+    def get(self, track, site):
+        """Get the cached pixel position of a site.
+
+        Args:
+            track (str): Ground track key of the scene
+            site (str): Name of the site
+
+        Returns:
+            (tuple): pixel position (xx, yy), or None if not cached
+        """
+        position = self.entries.get(track, {}).get(site)
+
+        if position is None:
+            return None
+
+        return tuple(position)
+
+    def add(self, track, site, position):
+        """Store the pixel position of a site.
+
+        Args:
+            track (str): Ground track key of the scene
+            site (str): Name of the site
+            position (tuple): pixel position (xx, yy)
+        """
+        self.entries.setdefault(track, {})[site] = list(position)
+
+    def save(self, json_file):
+        """Save the cache to a json file.
+
+        Args:
+            json_file (PosixPath): Path to the output json file
+        """
+        with open(str(json_file), "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
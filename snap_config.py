@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""SNAP performance settings of the runs (no SNAP required)."""
+import json
+
+# SNAP settings stored in a configuration file (see
+# snappy_funcs.configure_snap and s3_autotune.py)
+SNAP_SETTINGS = ["tile_cache_mb", "tile_size", "parallelism"]
+
+
+def read_snap_config(
+    config_file=None, tile_cache_mb=None, tile_size=None, parallelism=None
+):
+    """Get the SNAP settings of a run.
+
+    Args:
+        config_file (PosixPath): Path to a json file written by\
+                                 s3_autotune.py (optional)
+        tile_cache_mb (int): JAI tile cache capacity (MB), overrides the file
+        tile_size (int): Default tile size (pixels), overrides the file
+        parallelism (int): Number of threads computing the tiles, overrides\
+                           the file
+
+    Returns:
+        (dict): settings to pass to snappy_funcs.configure_snap, empty if\
+                SNAP's own configuration is used
+    """
+    config = {}
+    if config_file:
+        with open(str(config_file), "r") as f:
+            config = {
+                x: y for x, y in json.load(f).items() if x in SNAP_SETTINGS
+            }
+
+    overrides = {
+        "tile_cache_mb": tile_cache_mb,
+        "tile_size": tile_size,
+        "parallelism": parallelism,
+    }
+    config.update({x: y for x, y in overrides.items() if y is not None})
+
+    return config
@@ -1,11 +1,71 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """ESA SNAP python (snappy) based functions."""
+import csv
 import math
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+
+import snow_engine
+from run_metrics import StageTimer, python_rss_mb
+from scene_utils import instrument_solar_flux, track_key
+from site_cache import distance_m
 
 # Import SNAP libraries
 from snappy import ProductIO, GeoPos, PixelPos, HashMap, GPF, jpy, Mask
 
+# SNAP readers for the SLSTR grids
+SLSTR_READERS = {"500": "Sen3_SLSTRL1B_500m", "1000": "Sen3_SLSTRL1B_1km"}
+
+# Number of products opened with open_prod and not disposed yet
+OPEN_PRODUCTS = {"count": 0}
+
+# OLCI bands for which the S3 SNOW processor can compute spectral albedos
+SPECTRAL_ALBEDO_BANDS = [
+    "Oa01 (400 nm)",
+    "Oa02 (412.5 nm)",
+    "Oa03 (442.5 nm)",
+    "Oa04 (490 nm)",
+    "Oa05 (510 nm)",
+    "Oa06 (560 nm)",
+    "Oa07 (620 nm)",
+    "Oa08 (665 nm)",
+    "Oa09 (673.75 nm)",
+    "Oa10 (681.25 nm)",
+    "Oa11 (708.75 nm)",
+    "Oa12 (753.75 nm)",
+    "Oa13 (761.25 nm)",
+    "Oa14 (764.375 nm)",
+    "Oa15 (767.5 nm)",
+    "Oa16 (778.75 nm)",
+    "Oa17 (865 nm)",
+    "Oa18 (885 nm)",
+    "Oa19 (900 nm)",
+    "Oa20 (940 nm)",
+    "Oa21 (1020 nm)",
+]
+
+# Variables of the S3 SNOW outputs (see output_utils.SNOW_VARIABLES)
+SNOW_SCALARS = ["grain_diameter", "ndbi", "ndsi", "snow_specific_area"]
+SNOW_BAND_GROUPS = {
+    "rBRR": "BRR",
+    "spectral_planar": "spectral_planar",
+    "albedo_bb": "albedo_bb",
+}
+
+# Above this size (pixels), flag bands are read site by site instead of over
+# the window containing all the sites
+MAX_WINDOW_PIXELS = 4000000
+
+# If the window containing all the sites of a scene is too large, the
+# operators run once per scene (Idepix, Rayleigh correction) are run on a small
+# window for each group of sites in the same cell of this size (pixels)
+SITE_GROUP_SIZE = 64
+
 
 def open_prod(inpath, s3_instrument, resolution):
     """Open SNAP product.
@@ -29,10 +89,8 @@ def open_prod(inpath, s3_instrument, resolution):
 
         elif s3_instrument == "SLSTR":
             # Reader based on input
-            if resolution == "500":
-                reader = ProductIO.getProductReader("Sen3_SLSTRL1B_500m")
-            elif resolution == "1000":
-                reader = ProductIO.getProductReader("Sen3_SLSTRL1B_1km")
+            if resolution in SLSTR_READERS:
+                reader = ProductIO.getProductReader(SLSTR_READERS[resolution])
             else:
                 raise ValueError("Wrong SLSTR resolution, set to 500 or 1000m")
 
@@ -46,9 +104,172 @@ def open_prod(inpath, s3_instrument, resolution):
     except IOError:
         print("Error: SNAP cannot read specified file!")
 
+    OPEN_PRODUCTS["count"] += 1
+
     return prod
 
 
+def dispose_prod(prod):
+    """Dispose a SNAP product opened with open_prod.
+
+    Args:
+        prod (java.lang.Object): snappy java object: SNAP image product
+    """
+    prod.dispose()
+    OPEN_PRODUCTS["count"] -= 1
+
+
+def memory_state(run_gc=False):
+    """Get the memory used by SNAP.
+
+    Args:
+        run_gc (bool): Run the Java garbage collector before measuring, to
+            get the heap used by live objects only
+
+    Returns:
+        (dict): JVM heap used and committed (MB), resident memory (MB) of\
+                the Python process running the JVM, and number of products\
+                opened with open_prod and not disposed yet
+    """
+    runtime = jpy.get_type("java.lang.Runtime").getRuntime()
+    if run_gc:
+        runtime.gc()
+
+    committed = runtime.totalMemory() / 1024.0 ** 2
+
+    return {
+        "jvm_used_mb": committed - runtime.freeMemory() / 1024.0 ** 2,
+        "jvm_committed_mb": committed,
+        "python_rss_mb": python_rss_mb(),
+        "open_products": OPEN_PRODUCTS["count"],
+    }
+
+
+def configure_snap(tile_cache_mb=None, tile_size=None, parallelism=None):
+    """Configure the tile cache, tile size and parallelism of SNAP.
+
+    The settings override the ones of the user's snap.properties file for the
+    current JVM. The JAI tile cache and scheduler are updated directly, and
+    the matching SNAP system properties are set for the products opened
+    afterwards.
+
+    Args:
+        tile_cache_mb (int): JAI tile cache capacity (MB), unchanged if None
+        tile_size (int): Default tile width and height (pixels), unchanged\
+                         if None
+        parallelism (int): Number of threads computing the tiles, unchanged\
+                           if None
+
+    Returns:
+        (dict): the current tile cache capacity (MB), tile size and\
+                parallelism
+    """
+    jai = jpy.get_type("javax.media.jai.JAI").getDefaultInstance()
+    system = jpy.get_type("java.lang.System")
+
+    if tile_cache_mb is not None:
+        system.setProperty("snap.jai.tileCacheSize", str(int(tile_cache_mb)))
+        jai.getTileCache().setMemoryCapacity(int(tile_cache_mb) * 1024 ** 2)
+
+    if tile_size is not None:
+        system.setProperty("snap.jai.defaultTileSize", str(int(tile_size)))
+        dimension = jpy.get_type("java.awt.Dimension")
+        jpy.get_type("javax.media.jai.JAI").setDefaultTileSize(
+            dimension(int(tile_size), int(tile_size))
+        )
+
+    if parallelism is not None:
+        system.setProperty("snap.parallelism", str(int(parallelism)))
+        jai.getTileScheduler().setParallelism(int(parallelism))
+
+    default_size = jpy.get_type("javax.media.jai.JAI").getDefaultTileSize()
+
+    return {
+        "tile_cache_mb": jai.getTileCache().getMemoryCapacity() / 1024 ** 2,
+        "tile_size": default_size.width if default_size else None,
+        "parallelism": jai.getTileScheduler().getParallelism(),
+    }
+
+
+def flush_tile_cache():
+    """Remove all the tiles from the JAI tile cache."""
+    jai = jpy.get_type("javax.media.jai.JAI").getDefaultInstance()
+    jai.getTileCache().flush()
+
+
+class ProductCache(object):
+    """Cache of open SNAP products.
+
+    Keep the most recently used products open, so that queries hitting the
+    same scene don't reopen it. The least recently used product is disposed
+    when the cache is full.
+
+    Args:
+        max_products (int): Maximum number of products kept open
+    """
+
+    def __init__(self, max_products=4):
+        self.max_products = max_products
+        self.products = OrderedDict()
+
+    def get(self, inpath, s3_instrument, resolution):
+        """Get an open product, opening it if it isn't in the cache.
+
+        Args:
+            inpath (str): Path to a S3 image xfdumanisfest.xml file
+            s3_instrument (str): S3 instrument (OLCI or SLSTR)
+            resolution (str): For SLSTR, resolution of the product to be
+                opened (500 or 1000)
+
+        Returns:
+            (java.lang.Object): snappy java object: SNAP image product
+        """
+        key = (str(inpath), s3_instrument, resolution)
+
+        if key in self.products:
+            self.products.move_to_end(key)
+        else:
+            self.products[key] = open_prod(
+                str(inpath), s3_instrument, resolution
+            )
+
+            # Dispose the least recently used products
+            while len(self.products) > self.max_products:
+                dispose_prod(self.products.popitem(last=False)[1])
+
+        return self.products[key]
+
+    def clear(self):
+        """Dispose all the cached products."""
+        while self.products:
+            dispose_prod(self.products.popitem(last=False)[1])
+
+
+def slstr_band_grid(band_name):
+    """Get the grid of a SLSTR band.
+
+    The grid is given by the view suffix of the band (or mask) name: stripes
+    a, b and the TDI c are on the 500m grid (e.g. S1_radiance_an), the
+    thermal i and fire f channels on the 1km grid (e.g. F1_BT_in,
+    confidence_in_coastline).
+
+    Args:
+        band_name (str): Name of a SLSTR band, TiePointGrid or mask
+
+    Returns:
+        (str): "500" or "1000", or None if the band isn't on a given grid\
+               (e.g. TiePointGrids)
+    """
+    view = re.search("_([abcif])[no](_|$)", band_name)
+
+    if not view:
+        return None
+    elif view.group(1) in "abc":
+        return "500"
+    else:
+        return "1000"
+
+
 def pixel_position(inprod, inlat, inlon):
     """Get pixel position in a product.
 
@@ -94,6 +315,24 @@ def pixel_position(inprod, inlat, inlon):
     return (xx, yy)
 
 
+def pixel_center(inprod, xx, yy):
+    """Get the coordinates of the centre of a pixel.
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        xx (int): x position of the pixel in the product
+        yy (int): y position of the pixel in the product
+
+    Returns:
+        (tuple): latitude and longitude of the pixel centre in degrees
+    """
+    gpos = inprod.getSceneGeoCoding().getGeoPos(
+        PixelPos(xx + 0.5, yy + 0.5), None
+    )
+
+    return (gpos.getLat(), gpos.getLon())
+
+
 def subset(inprod, inlat, inlon, subset_size=3, copyMetadata="true"):
     """Subset a S3 scene opened in snappy around lat lon coordinates.
 
@@ -198,6 +437,7 @@ def snap_snow_albedo(
     copyrefl="true",  # Copy rBRR bands to product
     refwvl="1020.0",  # Reference wvl for albedo calculation
     cloud_mask_name="cloud_over_snow",
+    spectral_bands=None,
 ):
     """Snow Albedo Processor v2.0.9
 
@@ -219,6 +459,10 @@ def snap_snow_albedo(
             refwvl
             cloud_mask_name (str): specify the name of the cloud mask if it \
                                    exists
+            spectral_bands (list): OLCI bands for which the spectral albedos\
+                                   are computed (see SPECTRAL_ALBEDO_BANDS),\
+                                   all if None. If empty, the operator\
+                                   default is kept.
 
 
         Returns:
@@ -273,17 +517,15 @@ def snap_snow_albedo(
     parameters.put("olciGainBand17", gain_b17)
     parameters.put("olciGainBand21", gain_b21)
 
-    # Band list for output (for the moment hard code 21 bands)
-    bandlist = (
-        "Oa01 (400 nm),Oa02 (412.5 nm),Oa03 (442.5 nm),Oa04 (490 nm),"
-        "Oa05 (510 nm),Oa06 (560 nm),Oa07 (620 nm),Oa08 (665 nm),Oa09"
-        " (673.75 nm),Oa10 (681.25 nm),Oa11 (708.75 nm),Oa12 (753.75 "
-        "nm),Oa13 (761.25 nm),Oa14 (764.375 nm),Oa15 (767.5 nm),Oa16 "
-        "(778.75 nm),Oa17 (865 nm),Oa18 (885 nm),Oa19 (900 nm),Oa20 ("
-        "940 nm),Oa21 (1020 nm)"
-    )
+    # Band list for output. An empty list isn't a valid value: the operator
+    # default is kept instead (its bands aren't read)
+    if spectral_bands is None:
+        spectral_bands = SPECTRAL_ALBEDO_BANDS
 
-    parameters.put("spectralAlbedoTargetBands", bandlist)
+    if spectral_bands:
+        parameters.put(
+            "spectralAlbedoTargetBands", ",".join(spectral_bands)
+        )
 
     # Run the Albedo computation
     albedo = GPF.createProduct("OLCI.SnowProperties", parameters, inprod)
@@ -315,6 +557,233 @@ def idepix_cloud(in_prod, xpix, ypix):
     return cloudband.getPixelInt(xpix, ypix)
 
 
+def window_subset(inprod, pixels, margin=3):
+    """Subset the window of a product containing a list of sites.
+
+    Args:
+        inprod (java.lang.Object): snappy java object: SNAP image product
+        pixels (dict): pixel coordinates (xx, yy) of each site in the product
+        margin (int): number of pixels added around the sites in the subset
+
+    Returns:
+        (tuple): tuple containing:
+            prod_window (java.lang.Object): snappy subset product
+            xmin, ymin (int): position of the subset in the product
+    """
+    xmin = max(min(x[0] for x in pixels.values()) - margin, 0)
+    ymin = max(min(x[1] for x in pixels.values()) - margin, 0)
+    xmax = min(
+        max(x[0] for x in pixels.values()) + margin,
+        inprod.getSceneRasterWidth() - 1,
+    )
+    ymax = min(
+        max(x[1] for x in pixels.values()) + margin,
+        inprod.getSceneRasterHeight() - 1,
+    )
+
+    parameters = HashMap()
+    parameters.put(
+        "region",
+        "%s,%s,%s,%s" % (xmin, ymin, xmax - xmin + 1, ymax - ymin + 1),
+    )
+    parameters.put("subSamplingX", "1")
+    parameters.put("subSamplingY", "1")
+    parameters.put("copyMetadata", "true")
+    prod_window = GPF.createProduct("Subset", parameters, inprod)
+
+    return prod_window, xmin, ymin
+
+
+def site_groups(pixels, margin=3):
+    """Group the sites of a scene in windows small enough to be processed.
+
+    The sites are kept in a single group if the window containing them all is
+    at most MAX_WINDOW_PIXELS, otherwise they are grouped by cell of
+    SITE_GROUP_SIZE pixels, so that each group is processed on a small window.
+
+    Args:
+        pixels (dict): pixel coordinates (xx, yy) of each site in the product
+        margin (int): number of pixels added around the sites in the windows
+
+    Returns:
+        (list): pixel coordinates (dict) of the sites of each group
+    """
+    xs = [x[0] for x in pixels.values()]
+    ys = [x[1] for x in pixels.values()]
+    width = max(xs) - min(xs) + 1 + 2 * margin
+    height = max(ys) - min(ys) + 1 + 2 * margin
+
+    if width * height <= MAX_WINDOW_PIXELS:
+        return [pixels]
+
+    groups = OrderedDict()
+    for site, (xx, yy) in pixels.items():
+        cell = (int(xx) // SITE_GROUP_SIZE, int(yy) // SITE_GROUP_SIZE)
+        groups.setdefault(cell, OrderedDict())[site] = (xx, yy)
+
+    return list(groups.values())
+
+
+def rayleigh_brr(inprod):
+    """Run the Rayleigh correction.
+
+    Args:
+        inprod (java.lang.Object): snappy java object: SNAP image product
+
+    Returns:
+        (java.lang.Object): snappy product with the rBRR_01 to rBRR_21 bands
+    """
+    parameters = HashMap()
+    parameters.put(
+        "sourceBandNames",
+        ",".join("Oa%02d_radiance" % x for x in range(1, 22)),
+    )
+    parameters.put("computeRBrr", "true")
+    parameters.put("computeTaur", "false")
+    parameters.put("computeRtoa", "false")
+    parameters.put("computeRtoaNg", "false")
+    parameters.put("addAirMass", "false")
+
+    return GPF.createProduct("RayleighCorrection", parameters, inprod)
+
+
+def numpy_snow_values(
+    inprod,
+    pixels,
+    snow_pollution,
+    pollution_delta,
+    gains,
+    ndsi_flag="false",
+    ndsi_thres="0.03",
+    refwvl="1020.0",
+    margin=3,
+):
+    """Retrieve the snow properties of a list of sites with snow_engine.
+
+    The rBRR of all the sites are computed by SNAP on a single subset
+    containing the sites (or on a small subset for each group of nearby sites
+    if it is too large, see site_groups), and the snow properties are then
+    retrieved for all the sites at once. The S3 SNOW options have the same
+    defaults as in snap_snow_albedo, so that both engines run with the same
+    settings.
+
+    Args:
+        inprod (java.lang.Object): snappy java object: SNAP image product
+        pixels (dict): pixel coordinates (xx, yy) of each site in the product
+        snow_pollution (bool): Flag the polluted snow pixels
+        pollution_delta (float): Delta value to consider dirty snow
+        gains (bool): Consider vicarious calibration gains
+        ndsi_flag (str): Only retrieve the properties of the pixels with a\
+                         NDSI above the threshold ("true" or "false")
+        ndsi_thres (str): NDSI threshold
+        refwvl (str): Reference wavelength of the retrieval (nm)
+        margin (int): number of pixels added around the sites in the subset
+
+    Returns:
+        (dict): snow properties of each site, named as the S3 SNOW outputs
+    """
+    if not pixels:
+        return {}
+
+    sites = []
+    brr = []
+    geometry = {"SZA": [], "OZA": [], "SAA": [], "OAA": []}
+    for group in site_groups(pixels, margin):
+        prod_window, xmin, ymin = window_subset(inprod, group, margin)
+        positions = [(x[0] - xmin, x[1] - ymin) for x in group.values()]
+        sites += list(group)
+
+        # Read the rBRR spectra of the sites, only at the site pixels
+        brr_prod = rayleigh_brr(prod_window)
+        group_brr = np.zeros((len(positions), 21))
+        pixel = np.zeros(1, dtype=np.float32)
+        for band in range(21):
+            currentband = brr_prod.getBand("rBRR_%02d" % (band + 1))
+            for i, (xx, yy) in enumerate(positions):
+                currentband.readPixels(xx, yy, 1, 1, pixel)
+                group_brr[i, band] = pixel[0]
+        brr.append(group_brr)
+
+        # Read the geometry from the tie point grids
+        for tpg in geometry:
+            grid = prod_window.getTiePointGrid(tpg)
+            grid.readRasterDataFully()
+            geometry[tpg] += [
+                grid.getPixelFloat(xx, yy) for xx, yy in positions
+            ]
+
+        # Garbage collector
+        brr_prod.dispose()
+        prod_window.dispose()
+
+    brr = np.concatenate(brr)
+    geometry = {x: np.array(y) for x, y in geometry.items()}
+
+    outputs = snow_engine.retrieve(
+        brr,
+        geometry["SZA"],
+        geometry["OZA"],
+        geometry["SAA"],
+        geometry["OAA"],
+        pollution_flag=snow_pollution,
+        pollution_delta=float(pollution_delta),
+        gains=gains,
+        ref_wvl=float(refwvl),
+        ndsi_flag=str(ndsi_flag).lower() == "true",
+        ndsi_thres=float(ndsi_thres),
+    )
+
+    return {
+        site: {x: round(float(outputs[x][i]), 4) for x in outputs}
+        for i, site in enumerate(sites)
+    }
+
+
+def idepix_cloud_sites(in_prod, pixels, margin=3):
+    """Run the cloud over snow processor once for a list of sites.
+
+    The Idepix cloud over snow processor is run on a single subset of the
+    product containing all the sites (or on a small subset for each group of
+    nearby sites if it is too large, see site_groups), and the cloud over snow
+    values are read at the position of each site.
+
+    Args:
+        in_prod (java.lang.Object): snappy java object: SNAP image product
+        pixels (dict): pixel coordinates (xx, yy) of each site in the product
+        margin (int): number of pixels added around the sites in the subset
+
+    Returns:
+        (dict): cloud over snow value of each site
+    """
+    if not pixels:
+        return {}
+
+    cloud_values = {}
+    for group in site_groups(pixels, margin):
+        # Subset the window containing the sites of the group
+        prod_window, xmin, ymin = window_subset(in_prod, group, margin)
+
+        # Run the processor once on the window
+        parameters = HashMap()
+        parameters.put("demBandName", "band_1")
+        idepix_cld = GPF.createProduct(
+            "Snap.Idepix.Olci.S3Snow", parameters, prod_window
+        )
+
+        # Only read the site pixels
+        cloudband = idepix_cld.getBand("cloud_over_snow")
+        pixel = np.zeros(1, dtype=np.int32)
+        for site, (xx, yy) in group.items():
+            cloudband.readPixels(xx - xmin, yy - ymin, 1, 1, pixel)
+            cloud_values[site] = int(pixel[0])
+
+        # Garbage collector
+        idepix_cld.dispose()
+        prod_window.dispose()
+
+    return cloud_values
+
+
 def dem_extract(in_prod, xpix, ypix, bandname="altitude"):
     """Run the S3 SNOW DEM tool.
 
@@ -353,7 +822,7 @@ def getTiePointGrid_value(inprod, tpg_name, xx, yy):
     tpg = inprod.getTiePointGrid(tpg_name)
     tpg.readRasterDataFully()
 
-    return tpg.getPixelFloat(yy, xx)
+    return tpg.getPixelFloat(xx, yy)
 
 
 def merge2dicts(x, y):
@@ -383,244 +852,1035 @@ def get_valid_mask(inprod, xx, yy):
     return valid_mask_asmask.getSampleInt(xx, yy)
 
 
-def getS3values(
-    in_file,
-    coords,
+def pixel_tolerance(inprod, xx, yy):
+    """Get half the diagonal of a pixel of a product.
+
+    The size of the pixel is given by the distances to the centres of the
+    previous pixels along x and y (300 m for OLCI, 500 m or 1 km for the
+    SLSTR grids, varying across the swath).
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        xx (int): x position of the pixel in the product (above 0)
+        yy (int): y position of the pixel in the product (above 0)
+
+    Returns:
+        (float): half the diagonal of the pixel (m)
+    """
+    lat, lon = pixel_center(inprod, xx, yy)
+    size_x = distance_m(lat, lon, *pixel_center(inprod, xx - 1, yy))
+    size_y = distance_m(lat, lon, *pixel_center(inprod, xx, yy - 1))
+
+    return 0.5 * math.hypot(size_x, size_y)
+
+
+def verify_pixel(inprod, xx, yy, inlat, inlon, tolerance=None):
+    """Test if a coordinate is located in a pixel.
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        xx (int): x position of the pixel in the product
+        yy (int): y position of the pixel in the product
+        inlat (float): latitude of the coordinate in degrees EPSG:4326
+        inlon (float): longitude of the coordinate in degrees EPSG:4326
+        tolerance (float): maximum distance (m) between the coordinate and\
+                           the centre of the pixel. If None, half the\
+                           diagonal of the pixel (see pixel_tolerance).
+
+    Returns:
+        (bool): the pixel is in the product and its centre is within the\
+                tolerance of the coordinate
+    """
+    if not (
+        0 < xx < inprod.getSceneRasterWidth()
+        and 0 < yy < inprod.getSceneRasterHeight()
+    ):
+        return False
+
+    if tolerance is None:
+        tolerance = pixel_tolerance(inprod, xx, yy)
+
+    lat, lon = pixel_center(inprod, xx, yy)
+
+    return distance_m(inlat, inlon, lat, lon) <= tolerance
+
+
+def site_pixels(inprod, coords, position_cache=None, track=None):
+    """Get the pixel positions of a list of coordinates.
+
+    If a cache of positions is provided, the position found for a site in a
+    previous scene of the same ground track is reused if it is verified.
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        coords (list): List of coordinates (name, lat, lon)
+        position_cache (PixelPositionCache): Cache of the pixel positions of\
+                                             the sites (optional)
+        track (str): Ground track key of the product (see\
+                     scene_utils.track_key), needed with the cache
+
+    Returns:
+        (dict): pixel coordinates (xx, yy) of the sites located in the scene
+    """
+    pixels = {}
+    for coord in coords:
+        # Reuse the position of a previous scene of the same track
+        if position_cache is not None:
+            cached = position_cache.get(track, coord[0])
+            if cached and verify_pixel(
+                inprod,
+                cached[0],
+                cached[1],
+                coord[1],
+                coord[2],
+                position_cache.tolerance,
+            ):
+                pixels[coord[0]] = cached
+                continue
+
+        xx, yy = pixel_position(inprod, coord[1], coord[2])
+
+        # Store the position for the next scenes of the track
+        if position_cache is not None and xx and yy:
+            position_cache.add(track, coord[0], (xx, yy))
+
+        # Skip the sites located outside of the scene
+        if xx and yy:
+            pixels[coord[0]] = (xx, yy)
+
+    return pixels
+
+
+def flag_masks(inprod):
+    """List the masks defined by the flag codings of a product.
+
+    SNAP creates a mask named <flag band>_<flag name> for each flag of the
+    flag bands (e.g. quality_flags_invalid, confidence_an_coastline).
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+
+    Returns:
+        (dict): mask names as keys, (flag band name, flag mask) as values
+    """
+    masks = {}
+    for band_name in list(inprod.getBandNames()):
+        flag_coding = inprod.getBand(band_name).getFlagCoding()
+        if flag_coding is None:
+            continue
+        for flag in list(flag_coding.getFlagNames()):
+            masks["%s_%s" % (band_name, flag)] = (
+                band_name,
+                flag_coding.getFlagMask(flag),
+            )
+
+    return masks
+
+
+def read_band_samples(inprod, band_name, pixels, dtype=np.float32):
+    """Read the samples of a band at the site pixels.
+
+    The band is read once over the window containing all the sites (or site
+    by site if the window is too large).
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        band_name (str): Name of the band
+        pixels (list): List of pixel coordinates (xx, yy)
+        dtype (numpy.dtype): Type of the values read (numpy.int32 or\
+                             numpy.float32)
+
+    Returns:
+        (numpy.ndarray): geophysical values at each pixel
+    """
+    band = inprod.getBand(band_name)
+    xs = np.array([x[0] for x in pixels])
+    ys = np.array([x[1] for x in pixels])
+
+    xmin, ymin = int(xs.min()), int(ys.min())
+    width, height = int(xs.max()) - xmin + 1, int(ys.max()) - ymin + 1
+
+    if width * height <= MAX_WINDOW_PIXELS:
+        window = np.zeros(width * height, dtype=dtype)
+        band.readPixels(xmin, ymin, width, height, window)
+        samples = window.reshape(height, width)[ys - ymin, xs - xmin]
+    else:
+        samples = np.zeros(len(pixels), dtype=dtype)
+        pixel = np.zeros(1, dtype=dtype)
+        for i, (xx, yy) in enumerate(pixels):
+            band.readPixels(xx, yy, 1, 1, pixel)
+            samples[i] = pixel[0]
+
+    return samples
+
+
+def read_flag_samples(inprod, band_name, pixels):
+    """Read the samples of a flag band at the site pixels.
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        band_name (str): Name of the flag band
+        pixels (list): List of pixel coordinates (xx, yy)
+
+    Returns:
+        (numpy.ndarray): unsigned flag values at each pixel
+    """
+    samples = read_band_samples(inprod, band_name, pixels, np.int32)
+
+    # Flags are stored as unsigned integers
+    return samples.astype(np.int64) & 0xFFFFFFFF
+
+
+def toa_reflectance_sites(inprod, pixels, solar_flux=None):
+    """Convert the OLCI radiances of a list of sites to TOA reflectance.
+
+    The reflectance of each band is pi * L / (F0 * cos(SZA)), with F0 the
+    solar flux of the detector that acquired the pixel and the SZA
+    interpolated from the tie point grid. The bands are read once for all the
+    sites, without creating a Rad2Refl product.
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        pixels (dict): pixel coordinates (xx, yy) of each site in the product
+        solar_flux (numpy.ndarray): solar flux of each band and detector\
+                                    (bands x detectors, see\
+                                    scene_utils.instrument_solar_flux). If\
+                                    None, the flux is read from the\
+                                    solar_flux_band_N bands of the product.
+
+    Returns:
+        (dict): Oa01_reflectance to Oa21_reflectance values of each site
+    """
+    if not pixels:
+        return {}
+
+    sites = list(pixels)
+    positions = [pixels[x] for x in sites]
+
+    # Solar zenith angle at the pixels
+    sza_grid = inprod.getTiePointGrid("SZA")
+    sza_grid.readRasterDataFully()
+    cos_sza = np.cos(
+        np.radians([sza_grid.getPixelFloat(xx, yy) for xx, yy in positions])
+    )
+
+    if solar_flux is not None:
+        detectors = read_band_samples(
+            inprod, "detector_index", positions, np.int32
+        )
+        valid = (detectors >= 0) & (detectors < solar_flux.shape[1])
+        detectors[~valid] = 0
+
+    reflectances = {}
+    for band in range(1, 22):
+        radiance = read_band_samples(
+            inprod, "Oa%02d_radiance" % band, positions
+        ).astype(float)
+
+        if solar_flux is not None:
+            flux = np.where(valid, solar_flux[band - 1, detectors], np.nan)
+        else:
+            flux = read_band_samples(
+                inprod, "solar_flux_band_%s" % band, positions
+            ).astype(float)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            reflectances["Oa%02d_reflectance" % band] = (
+                np.pi * radiance / (flux * cos_sza)
+            )
+
+    return {
+        site: {x: round(float(y[i]), 4) for x, y in reflectances.items()}
+        for i, site in enumerate(sites)
+    }
+
+
+def decode_masks(inprod, pixels, mask_names):
+    """Get the values of masks for all the sites of a scene.
+
+    The flag masks are decoded with bit tests on the flag band samples, read
+    once for all the sites. The other masks (e.g. defined by an expression)
+    are queried site by site.
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        pixels (dict): pixel coordinates (xx, yy) of each site
+        mask_names (list): Names of the masks
+
+    Returns:
+        (dict): mask values (255 if set, 0 otherwise) for each site
+    """
+    decoded = {site: {} for site in pixels}
+    if not pixels or not mask_names:
+        return decoded
+
+    sites = list(pixels)
+    product_flags = flag_masks(inprod)
+    flag_samples = {}
+
+    for mask_name in mask_names:
+        if mask_name in product_flags:
+            band_name, flag_mask = product_flags[mask_name]
+            if band_name not in flag_samples:
+                flag_samples[band_name] = read_flag_samples(
+                    inprod, band_name, [pixels[x] for x in sites]
+                )
+            values = np.where(
+                (flag_samples[band_name] & flag_mask) == flag_mask, 255, 0
+            )
+        else:
+            mask = jpy.cast(inprod.getMaskGroup().get(mask_name), Mask)
+            values = [mask.getSampleInt(*pixels[x]) for x in sites]
+
+        for site, value in zip(sites, values):
+            decoded[site][mask_name] = int(value)
+
+    return decoded
+
+
+def get_valid_masks(inprod, pixels):
+    """Test if the site pixels are valid.
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        pixels (dict): pixel coordinates (xx, yy) of each site
+
+    Returns:
+        (dict): "quality_flags_invalid" mask value of each site (255 if the
+        pixel is invalid, or if SNAP can't query the position)
+    """
+    try:
+        masks = decode_masks(inprod, pixels, ["quality_flags_invalid"])
+        return {x: masks[x]["quality_flags_invalid"] for x in masks}
+    except:  # Bare except needed to catch the JAVA exception
+        pass
+
+    # Query the sites one by one if the flags can't be read at once
+    valid_masks = {}
+    for site, (xx, yy) in pixels.items():
+        try:
+            valid_masks[site] = get_valid_mask(inprod, xx, yy)
+        except:  # Bare except needed to catch the JAVA exception
+            valid_masks[site] = 255  # If SNAP can't query position return 255
+
+    return valid_masks
+
+
+def cloudy_pixel_values(inprod, xx, yy, cloud_flag):
+    """Get the values written for a cloudy pixel.
+
+    Args:
+        inprod (java.lang.Object): SNAP image product
+        xx (int): x position of the pixel in the product
+        yy (int): y position of the pixel in the product
+        cloud_flag (int): Idepix cloud over snow value of the pixel
+
+    Returns:
+        (dict): cloud flag and solar and viewing angles
+    """
+    out_values = {"auto_cloud": cloud_flag}
+    for tpg, name in (
+        ("SZA", "sza"),
+        ("OZA", "vza"),
+        ("SAA", "saa"),
+        ("OAA", "vaa"),
+    ):
+        out_values[name] = getTiePointGrid_value(inprod, tpg, xx, yy)
+
+    return out_values
+
+
+def read_snow_albedo(
+    prod_subset,
+    pix_coords,
     snow_pollution,
     pollution_delta,
     gains,
-    dem_prods,
-    errorfile,
-    s3_instrument="OLCI",
-    slstr_res=None,
+    variables,
+    snow_scalars,
+    snow_groups,
 ):
-    """Extract data from S3 SNOW.
-
-    Read the input S3 file and run the S3 OLCI SNOW processor for the
-    coordinates located within the scene.
+    """Run the S3 OLCI SNOW processor on a subset and read a pixel.
 
     Args:
-        in_file (str): Path to a S3 OLCI image xfdumanisfest.xml file
-        coords (list): List of coordinates to extract the data from
-        pollution (bool): S3 SNOW dirty snow flag
-        delta_pol (int): Delta value to consider dirty snow in S3 SNOW
+        prod_subset (java.lang.Object): SNAP subset product
+        pix_coords (tuple): Position (xx, yy) of the pixel in the subset
+        snow_pollution (bool): S3 SNOW dirty snow flag
+        pollution_delta (int): Delta value to consider dirty snow in S3 SNOW
         gains (bool): Consider vicarious calibration gains
-        dem_prods (bool): Run the S3 Snow DEM slope plugin
-        errorfile (str): Path to the file where all errors are logged
-        """
-    # Make a dictionnary to store results
-    stored_vals = {}
+        variables (list): Selected variables
+        snow_scalars (list): Selected single value outputs
+        snow_groups (list): Band name patterns of the selected spectral\
+                            outputs
 
-    # Open SNAP product
-    prod = open_prod(in_file, s3_instrument, slstr_res)
+    Returns:
+        (dict): S3 SNOW outputs at the pixel
+    """
+    # Run the S3 OLCI SNOW processor on the subset, without the rBRR bands
+    # if they aren't selected (nor the spectral albedo bands, which are left
+    # to the operator default and not read)
+    snap_albedo = snap_snow_albedo(
+        prod_subset,
+        snow_pollution,
+        pollution_delta,
+        gains,
+        copyrefl="true" if "rBRR" in variables else "false",
+        spectral_bands=None if "spectral_planar" in variables else [],
+    )
 
-    # Loop over coordinates to extract values.
-    for coord in coords:
-        # Check if data exists at the queried location
-        # Transform lat/lon to position to x, y in scene
-        xx, yy = pixel_position(prod, coord[1], coord[2])
+    # Extract values from albedo product
+    out_values = dict.fromkeys(snow_scalars)
 
-        # Test if the pixel is valid (in the scene and not in the image border)
-        try:
-            mask = get_valid_mask(prod, xx, yy)
-        except:  # Bare except needed to catch the JAVA exception
-            mask = 255  # If SNAP can't query position return 255
+    # Add band names to extract to the dictionnary
+    alb_bands = [
+        x
+        for x in list(snap_albedo.getBandNames())
+        if any(y in x for y in snow_groups)
+    ]
+    for item in alb_bands:
+        out_values.update({item: None})
+
+    # Update albedo values
+    for key in out_values:
+        item = next(x for x in list(snap_albedo.getBandNames()) if key in x)
+        currentband = None
+        currentband = snap_albedo.getBand(item)
+        currentband.loadRasterData()
+        out_values[key] = round(
+            currentband.getPixelFloat(pix_coords[0], pix_coords[1]), 4
+        )
 
-        # Log if location is outside of file
-        if not xx or not yy:
-            pass
-        # Log if coordinate is in file but invalid pixel
-        elif mask == 255:
-            with open(str(errorfile), "a") as fd:
-                fd.write(
-                    "%s, %s: Invalid pixel.\n" % (prod.getName(), coord[0])
-                )
-        else:
+    # Garbage collector
+    snap_albedo.dispose()
 
-            # Save resources by working on a small subset around each
-            # coordinates pair contained within the S3 scene. Doesn't process
-            # if the coordinates pair is not in the product
-            try:
-                prod_subset, pix_coords = subset(prod, coord[1], coord[2])
-                if not prod_subset or pix_coords[0] is None:
-                    out_values = None  # None if location not in product
-                    prod_subset = None  # None to stop processing
-                    with open(str(errorfile), "a") as fd:
-                        fd.write(
-                            "%s, %s: Unable to subset,"
-                            " too close to the edge.\n"
-                            % (prod.getName(), coord[0])
-                        )
+    return out_values
 
-            except:  # Bare except needed to catch the JAVA exception
-                with open(str(errorfile), "a") as fd:
-                    fd.write(
-                        "%s, %s: Corrupt file or"
-                        " SNAP issue.\n" % (prod.getName(), coord[0])
-                    )
-                prod_subset = None  # Set a marker to ignore rest of processing
 
-            if prod_subset:  # Run the processing if subset exists
+def param_set_values(out_values, param_sets, snow_values=None):
+    """Split the outputs of a pixel by S3 SNOW parameter set.
 
-                # Fetch the TOA reflectance for the image
-                toa_refl = rad2refl(prod_subset)
+    Args:
+        out_values (dict): Outputs shared by all the sets (geometry, TOA\
+                           reflectances, cloud flag, DEM)
+        param_sets (list): S3 SNOW parameter sets (name, pollution,\
+                           pollution delta, gains)
+        snow_values (dict): S3 SNOW outputs of each set, by set name (none\
+                            for a cloudy pixel)
 
-                # Some pixel positions in S3 images are considered valid by the
-                # mask (returns 0 and not 255), but are located outside of the
-                # image (in the top or bottom border). It is not possible to
-                # determine the validity of the pixel without querying the
-                # product. Here we query the TOA product and return an entry
-                # in the log if it fails.
-                try:
-                    # Get first TOA band
-                    toa_band1 = list(toa_refl.getBandNames())[0]
+    Returns:
+        (list): outputs of each set, tagged with its name ("param_set")
+    """
+    if snow_values is None:
+        snow_values = {}
+
+    return [
+        merge2dicts(
+            merge2dicts(out_values, snow_values.get(x[0], {})),
+            {"param_set": x[0]},
+        )
+        for x in param_sets
+    ]
 
-                    # Extract pixel value for the band
-                    currentband = None
-                    currentband = toa_refl.getBand(toa_band1)
-                    currentband.loadRasterData()
-                    currentband.getPixelFloat(pix_coords[0], pix_coords[1])
-                    currentband = None
 
-                    # Marker to continue processing
-                    processing = True
+def snow_pixel_values(
+    prod,
+    coord,
+    pixel,
+    sites,
+    snow_pollution,
+    pollution_delta,
+    gains,
+    dem_prods,
+    event_log,
+    timer,
+    cloud_flag=None,
+    terrain_cache=None,
+    variables=None,
+    engine_values=None,
+    toa_values=None,
+    param_sets=None,
+):
+    """Run the S3 OLCI SNOW processor for a pixel.
 
-                except:  # Bare except needed to catch the JAVA exception
-                    with open(str(errorfile), "a") as fd:
-                        fd.write(
-                            "%s, %s: Invalid pixel.\n"
-                            % (prod.getName(), coord[0])
-                        )
-                    processing = False
+    Only the selected variables are computed and read: the TOA reflectances,
+    the S3 SNOW processor and the cloud over snow processor are skipped if
+    none of their outputs are selected.
 
-                if processing:
-                    # Run the S3 OLCI SNOW processor on the subset
-                    snap_albedo = snap_snow_albedo(
-                        prod_subset, snow_pollution, pollution_delta, gains
-                    )
+    Args:
+        prod (java.lang.Object): SNAP image product
+        coord (tuple): Coordinates (name, lat, lon) of a site in the pixel
+        pixel (tuple): Position (xx, yy) of the pixel in the product
+        sites (list): Names of all the sites located in the pixel
+        snow_pollution (bool): S3 SNOW dirty snow flag
+        pollution_delta (int): Delta value to consider dirty snow in S3 SNOW
+        gains (bool): Consider vicarious calibration gains
+        dem_prods (bool): Run the S3 Snow DEM slope plugin
+        event_log (EventLog): Log of the processing failures
+        timer (StageTimer): Accumulates the time spent in each stage
+        cloud_flag (int): Idepix cloud over snow value, if already computed
+        terrain_cache (TerrainCache): Cache of the DEM values of the sites
+        variables (list): Selected variables (see\
+                          output_utils.SNOW_VARIABLES), all if None
+        engine_values (dict): Snow properties already retrieved with\
+                              snow_engine. If provided, the S3 SNOW processor\
+                              isn't run.
+        toa_values (dict): TOA reflectances already computed with\
+                           toa_reflectance_sites. If provided, the Rad2Refl\
+                           operator isn't run.
+        param_sets (list): S3 SNOW parameter sets (name, pollution,\
+                           pollution delta, gains). If provided, the S3 SNOW\
+                           processor is run on the subset once per set,\
+                           instead of with snow_pollution, pollution_delta\
+                           and gains.
 
-                    # Extract values from albedo product
-                    out_values = {
-                        "grain_diameter": None,
-                        "ndbi": None,
-                        "ndsi": None,
-                        "snow_specific_area": None,
-                    }
+    Returns:
+        (dict): S3 SNOW outputs at the pixel, or None if the pixel couldn't\
+                be processed. With param_sets, a list of the outputs of each\
+                set, tagged with its name ("param_set").
+    """
+    out_values = None
+    snow_values = {}
+
+    # Outputs to compute
+    if variables is None:
+        variables = SNOW_SCALARS + list(SNOW_BAND_GROUPS)
+        variables += ["auto_cloud", "reflectance"]
+    snow_scalars = [x for x in SNOW_SCALARS if x in variables]
+    snow_groups = [
+        SNOW_BAND_GROUPS[x] for x in SNOW_BAND_GROUPS if x in variables
+    ]
 
-                    # Add band names to extract to the dictionnary
-                    rbrr_bands = [
-                        x
-                        for x in list(snap_albedo.getBandNames())
-                        if "BRR" in x
-                    ]
-                    planar_bands = [
-                        x
-                        for x in list(snap_albedo.getBandNames())
-                        if "spectral_planar" in x
-                    ]
-                    bb_bands = [
-                        x
-                        for x in list(snap_albedo.getBandNames())
-                        if "albedo_bb" in x
-                    ]
-                    alb_bands = rbrr_bands + planar_bands + bb_bands
-                    for item in alb_bands:
-                        out_values.update({item: None})
-
-                    # Update albedo values
-                    for key in out_values:
-                        item = next(
-                            x
-                            for x in list(snap_albedo.getBandNames())
-                            if key in x
-                        )
-                        currentband = None
-                        currentband = snap_albedo.getBand(item)
-                        currentband.loadRasterData()
-                        out_values[key] = round(
+    # Save resources by working on a small subset around each
+    # coordinates pair contained within the S3 scene. Doesn't process
+    # if the coordinates pair is not in the product
+    try:
+        with timer.stage("subset"):
+            prod_subset, pix_coords = subset(prod, coord[1], coord[2])
+        if not prod_subset or pix_coords[0] is None:
+            event_log.log(
+                prod.getName(),
+                "edge",
+                "Unable to subset, too close to the edge.",
+                sites,
+                "subset",
+            )
+            return None
+
+    except:  # Bare except needed to catch the JAVA exception
+        event_log.log(
+            prod.getName(),
+            "snap_error",
+            "Corrupt file or SNAP issue.",
+            sites,
+            "subset",
+        )
+        return None
+
+    # Fetch the TOA reflectance for the image (the validity of the pixel is
+    # tested on the radiances if the reflectances aren't selected)
+    timer_start = time.time()
+    if "reflectance" in variables and toa_values is None:
+        toa_refl = rad2refl(prod_subset)
+        test_prod = toa_refl
+    else:
+        toa_refl = None
+        test_prod = prod_subset
+
+    # Some pixel positions in S3 images are considered valid by the
+    # mask (returns 0 and not 255), but are located outside of the
+    # image (in the top or bottom border). It is not possible to
+    # determine the validity of the pixel without querying the
+    # product. Here we query the TOA product and return an entry
+    # in the log if it fails.
+    try:
+        # Get first TOA band
+        toa_band1 = list(test_prod.getBandNames())[0]
+
+        # Extract pixel value for the band
+        currentband = None
+        currentband = test_prod.getBand(toa_band1)
+        currentband.loadRasterData()
+        currentband.getPixelFloat(pix_coords[0], pix_coords[1])
+        currentband = None
+
+        # Marker to continue processing
+        processing = True
+
+    except:  # Bare except needed to catch the JAVA exception
+        event_log.log(
+            prod.getName(),
+            "invalid_pixel",
+            "Invalid pixel.",
+            sites,
+            "rad2refl",
+        )
+        processing = False
+    timer.add("rad2refl", time.time() - timer_start)
+
+    if processing:
+        out_values = {}
+
+        # Use the snow properties retrieved with snow_engine
+        if engine_values is not None:
+            out_values = {
+                x: y
+                for x, y in engine_values.items()
+                if x in snow_scalars or any(z in x for z in snow_groups)
+            }
+
+        # Only run the S3 OLCI SNOW processor if its outputs are selected,
+        # once for each parameter set on the same subset
+        elif snow_scalars or snow_groups:
+            timer_start = time.time()
+            for set_name, set_pollution, set_delta, set_gains in (
+                param_sets
+                or [(None, snow_pollution, pollution_delta, gains)]
+            ):
+                snow_values[set_name] = read_snow_albedo(
+                    prod_subset,
+                    pix_coords,
+                    set_pollution,
+                    set_delta,
+                    set_gains,
+                    variables,
+                    snow_scalars,
+                    snow_groups,
+                )
+            timer.add("snow", time.time() - timer_start)
+
+            if not param_sets:
+                out_values.update(snow_values[None])
+
+        timer_start = time.time()
+
+        # Read geometry from the tie point grids
+        vza = getTiePointGrid_value(
+            prod_subset, "OZA", pix_coords[0], pix_coords[1]
+        )
+        vaa = getTiePointGrid_value(
+            prod_subset, "OAA", pix_coords[0], pix_coords[1]
+        )
+        saa = getTiePointGrid_value(
+            prod_subset, "SAA", pix_coords[0], pix_coords[1]
+        )
+        sza = getTiePointGrid_value(
+            prod_subset, "SZA", pix_coords[0], pix_coords[1]
+        )
+
+        # Update geometry
+        out_values.update({"sza": sza, "vza": vza, "vaa": vaa, "saa": saa})
+
+        # Get TOA Reflectance and update dictionnary
+        if toa_refl is not None:
+            toa_refl_bands = list(toa_refl.getBandNames())
+            for bnd in toa_refl_bands:
+                currentband = None
+                currentband = toa_refl.getBand(bnd)
+                currentband.loadRasterData()
+
+                out_values.update(
+                    {
+                        bnd: round(
                             currentband.getPixelFloat(
                                 pix_coords[0], pix_coords[1]
                             ),
                             4,
                         )
+                    }
+                )
+        elif toa_values is not None:
+            out_values.update(toa_values)
+
+        timer.add("toa", time.time() - timer_start)
+
+        # Add experimental cloud over snow result (already computed if the
+        # sites were pre-screened)
+        if cloud_flag is not None:
+            out_values["auto_cloud"] = cloud_flag
+        elif "auto_cloud" in variables:
+            with timer.stage("idepix"):
+                out_values.update(
+                    {
+                        "auto_cloud": idepix_cloud(
+                            prod_subset, pix_coords[0], pix_coords[1]
+                        )
+                    }
+                )
 
-                    # Read geometry from the tie point grids
-                    vza = getTiePointGrid_value(
-                        prod_subset, "OZA", pix_coords[0], pix_coords[1]
-                    )
-                    vaa = getTiePointGrid_value(
-                        prod_subset, "OAA", pix_coords[0], pix_coords[1]
-                    )
-                    saa = getTiePointGrid_value(
-                        prod_subset, "SAA", pix_coords[0], pix_coords[1]
-                    )
-                    sza = getTiePointGrid_value(
-                        prod_subset, "SZA", pix_coords[0], pix_coords[1]
+        # Run the DEM product as an options
+        if dem_prods:
+            # Reuse the values computed for the same pixel
+            dem_values = None
+            if terrain_cache is not None:
+                center = pixel_center(prod, *pixel)
+                tolerance = None
+                if terrain_cache.tolerance is None:
+                    tolerance = pixel_tolerance(prod, *pixel)
+                for site in sites:
+                    dem_values = terrain_cache.get(
+                        site, center[0], center[1], tolerance
                     )
+                    if dem_values is not None:
+                        break
 
-                    # Update geometry
-                    out_values.update(
-                        {"sza": sza, "vza": vza, "vaa": vaa, "saa": saa}
+            if dem_values is None:
+                with timer.stage("dem"):
+                    dem_values = dem_extract(
+                        prod_subset, pix_coords[0], pix_coords[1]
                     )
-
-                    # Get TOA Reflectance and update dictionnary
-                    toa_refl_bands = list(toa_refl.getBandNames())
-                    for bnd in toa_refl_bands:
-                        currentband = None
-                        currentband = toa_refl.getBand(bnd)
-                        currentband.loadRasterData()
-
-                        out_values.update(
-                            {
-                                bnd: round(
-                                    currentband.getPixelFloat(
-                                        pix_coords[0], pix_coords[1]
-                                    ),
-                                    4,
-                                )
-                            }
+                if terrain_cache is not None:
+                    for site in sites:
+                        terrain_cache.add(
+                            site, center[0], center[1], dem_values
                         )
+            # Merge DEM dictionnary
+            out_values = merge2dicts(out_values, dem_values)
 
-                    # Add experimental cloud over snow result
-                    out_values.update(
-                        {
-                            "auto_cloud": idepix_cloud(
-                                prod_subset, pix_coords[0], pix_coords[1]
-                            )
-                        }
-                    )
+    # Garbage collector
+    if toa_refl is not None:
+        toa_refl.dispose()
+    prod_subset.dispose()
 
-                    # Garbage collector
-                    snap_albedo.dispose()
-                    toa_refl.dispose()
+    # Tag the outputs of each parameter set
+    if out_values is not None and param_sets:
+        return param_set_values(out_values, param_sets, snow_values)
 
-                # Run the DEM product as an options
-                if dem_prods:
-                    dem_values = dem_extract(
-                        prod_subset, pix_coords[0], pix_coords[1]
-                    )
-                    # Merge DEM dictionnary
-                    out_values = merge2dicts(out_values, dem_values)
+    return out_values
+
+
+def write_validation(
+    validation_file, prod_name, sites, snap_values, engine_values
+):
+    """Write the comparison of the S3 SNOW and snow_engine outputs.
+
+    The variables computed by a single engine are written with an empty
+    value for the other engine, so that the gaps of the validation show.
+
+    Args:
+        validation_file (PosixPath): Path to the output csv file
+        prod_name (str): Name of the S3 product
+        sites (list): Names of the sites located in the pixel
+        snap_values (dict): S3 SNOW processor outputs
+        engine_values (dict): snow_engine outputs
+    """
+    header = not validation_file.is_file()
+
+    # Snow properties of the S3 SNOW outputs (not the geometry or DEM)
+    snap_variables = [
+        x
+        for x in snap_values
+        if x in SNOW_SCALARS
+        or any(y in x for y in SNOW_BAND_GROUPS.values())
+    ]
+
+    with open(str(validation_file), "a") as f:
+        writer = csv.writer(f)
+        if header:
+            writer.writerow(
+                ["scene", "site", "variable", "snap", "numpy", "difference"]
+            )
+        for site in sites:
+            for variable in sorted(set(engine_values) | set(snap_variables)):
+                snap_value = snap_values.get(variable)
+                engine_value = engine_values.get(variable)
+                if snap_value is None or engine_value is None:
+                    difference = None
+                else:
+                    difference = round(engine_value - snap_value, 4)
+                writer.writerow(
+                    [
+                        prod_name,
+                        site,
+                        variable,
+                        snap_value,
+                        engine_value,
+                        difference,
+                    ]
+                )
+
+
+def getS3values(
+    in_file,
+    coords,
+    snow_pollution,
+    pollution_delta,
+    gains,
+    dem_prods,
+    event_log,
+    s3_instrument="OLCI",
+    slstr_res=None,
+    timer=None,
+    products=None,
+    cloud_screen=False,
+    terrain_cache=None,
+    variables=None,
+    engine="snap",
+    validation_file=None,
+    toa_engine="snap",
+    position_cache=None,
+    threads=1,
+    param_sets=None,
+):
+    """Extract data from S3 SNOW.
+
+    Read the input S3 file and run the S3 OLCI SNOW processor for the
+    coordinates located within the scene. With the cloud pre-screen, the
+    Idepix cloud over snow processor is run first for all the sites, and only
+    the cloud flag and the geometry are returned for the cloudy sites.
+
+    Args:
+        in_file (str): Path to a S3 OLCI image xfdumanisfest.xml file
+        coords (list): List of coordinates to extract the data from
+        pollution (bool): S3 SNOW dirty snow flag
+        delta_pol (int): Delta value to consider dirty snow in S3 SNOW
+        gains (bool): Consider vicarious calibration gains
+        dem_prods (bool): Run the S3 Snow DEM slope plugin
+        event_log (EventLog): Log of the processing failures
+        timer (StageTimer): Accumulates the time spent in each stage
+        products (ProductCache): Cache of open products to get the product
+            from. If None, the product is opened and disposed after use.
+        cloud_screen (bool): Skip the S3 SNOW processor for the sites flagged\
+                             as cloudy by Idepix
+        terrain_cache (TerrainCache): Cache of the DEM values of the sites.\
+                                      The DEM plugin is only run if the\
+                                      values of the site's pixel are missing
+        variables (list): Variables to extract (see\
+                          output_utils.SNOW_VARIABLES), all if None
+        engine (str): Snow properties retrieval: "snap" (S3 SNOW processor),\
+                      "numpy" (snow_engine, all sites at once) or "validate"\
+                      (S3 SNOW processor, compared to snow_engine)
+        validation_file (PosixPath): Path to the csv file where the\
+                                     "validate" comparisons are written
+        toa_engine (str): TOA reflectance conversion: "snap" (Rad2Refl\
+                          operator for each site) or "numpy" (all sites at\
+                          once, see toa_reflectance_sites)
+        position_cache (PixelPositionCache): Cache of the pixel positions\
+                                             of the sites, reused for the\
+                                             scenes of the same ground track
+        threads (int): Number of sites processed concurrently with the S3\
+                       SNOW processor: the subset and processor chains of\
+                       the pixels run in threads sharing the JVM
+        param_sets (list): S3 SNOW parameter sets (name, pollution,\
+                           pollution delta, gains) to sweep. The upstream\
+                           processing of each pixel is shared by the sets,\
+                           and the values of each site are a list of the\
+                           outputs of each set, tagged with its name\
+                           ("param_set").
+        """
+    # The numpy engine doesn't compute all the S3 SNOW outputs
+    if engine == "numpy":
+        snow_engine.check_outputs(variables, snow_pollution)
+
+    # Make a dictionnary to store results
+    stored_vals = {}
 
-                # Update the full dictionnary
-                stored_vals.update({coord[0]: out_values})
+    # Time the processing stages (discarded if no timer is provided)
+    if timer is None:
+        timer = StageTimer()
 
-                # Garbage collector
-                prod_subset.dispose()
+    # Open SNAP product
+    with timer.stage("open"):
+        if products is None:
+            prod = open_prod(in_file, s3_instrument, slstr_res)
+        else:
+            prod = products.get(in_file, s3_instrument, slstr_res)
+
+    # Check if data exists at the queried locations
+    # Transform lat/lon to position to x, y in scene
+    pixels = site_pixels(
+        prod,
+        coords,
+        position_cache,
+        track_key(Path(in_file).parent.name)
+        if position_cache is not None
+        else None,
+    )
+
+    # Test if the pixels are valid (in the scene and not in the image border),
+    # reading the quality flags once for all sites
+    valid_masks = get_valid_masks(prod, pixels)
+
+    # Run the cloud over snow classification once for all the valid sites
+    cloud_flags = {}
+    if cloud_screen:
+        try:
+            with timer.stage("idepix_sites"):
+                cloud_flags = idepix_cloud_sites(
+                    prod,
+                    {x: pixels[x] for x in pixels if valid_masks[x] != 255},
+                )
+        except:  # Bare except needed to catch the JAVA exception
+            event_log.log(
+                prod.getName(),
+                "cloud_screen_failed",
+                "Cloud pre-screen failed, processing all sites.",
+                stage="idepix_sites",
+            )
+
+    # Group the sites located in the same pixel: each pixel is processed
+    # once and the values are copied to all its sites
+    pixel_sites = OrderedDict()
+    for coord in coords:
+        if coord[0] in pixels:
+            pixel_sites.setdefault(pixels[coord[0]], []).append(coord)
+
+    # Valid clear pixels, processed with the S3 SNOW processor (one site per
+    # pixel)
+    clear_pixels = {
+        x[0][0]: pixel
+        for pixel, x in pixel_sites.items()
+        if valid_masks[x[0][0]] != 255 and not cloud_flags.get(x[0][0])
+    }
+
+    # Retrieve the snow properties of all the valid clear pixels at once
+    engine_values = {}
+    if engine != "snap":
+        try:
+            with timer.stage("snow_engine"):
+                engine_values = numpy_snow_values(
+                    prod, clear_pixels, snow_pollution, pollution_delta, gains
+                )
+        except:  # Bare except needed to catch the JAVA exception
+            event_log.log(
+                prod.getName(),
+                "snow_engine_failed",
+                "Snow engine failed, running S3 SNOW.",
+                stage="snow_engine",
+            )
+
+    # Convert the radiances of all the valid clear pixels at once
+    toa_values = {}
+    if toa_engine == "numpy" and (
+        variables is None or "reflectance" in variables
+    ):
+        try:
+            with timer.stage("toa_sites"):
+                toa_values = toa_reflectance_sites(
+                    prod, clear_pixels, instrument_solar_flux(Path(in_file))
+                )
+        except:  # Bare except needed to catch the JAVA exception
+            event_log.log(
+                prod.getName(),
+                "toa_engine_failed",
+                "TOA reflectance conversion failed, running Rad2Refl.",
+                stage="toa_sites",
+            )
+
+    # Loop over the pixels to extract values.
+    pixel_values = {}
+    snow_tasks = {}
+    for (xx, yy), pixel_coords in pixel_sites.items():
+        coord = pixel_coords[0]
+        sites = [x[0] for x in pixel_coords]
+
+        # Log if coordinate is in file but invalid pixel: no processing
+        if valid_masks[coord[0]] == 255:
+            event_log.log(
+                prod.getName(),
+                "invalid_pixel",
+                "Invalid pixel.",
+                sites,
+                "mask",
+            )
+        # Cloudy pixel: only keep the cloud flag and the geometry
+        elif cloud_flags.get(coord[0]):
+            pixel_values[(xx, yy)] = cloudy_pixel_values(
+                prod, xx, yy, cloud_flags[coord[0]]
+            )
+            if param_sets:
+                pixel_values[(xx, yy)] = param_set_values(
+                    pixel_values[(xx, yy)], param_sets
+                )
+        else:
+            snow_tasks[(xx, yy)] = (
+                (
+                    prod,
+                    coord,
+                    (xx, yy),
+                    sites,
+                    snow_pollution,
+                    pollution_delta,
+                    gains,
+                    dem_prods,
+                    event_log,
+                    timer,
+                ),
+                {
+                    "cloud_flag": cloud_flags.get(coord[0]),
+                    "terrain_cache": terrain_cache,
+                    "variables": variables,
+                    "engine_values": engine_values.get(coord[0])
+                    if engine == "numpy"
+                    else None,
+                    "toa_values": toa_values.get(coord[0]),
+                    "param_sets": param_sets,
+                },
+            )
+
+    # Run the S3 SNOW processing of the clear pixels, in a pool of threads
+    # if requested: GPF computes the tiles of the concurrent subset and
+    # processor chains on the shared JVM
+    if threads > 1 and len(snow_tasks) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = {
+                x: executor.submit(snow_pixel_values, *args, **kwargs)
+                for x, (args, kwargs) in snow_tasks.items()
+            }
+        for pixel in futures:
+            pixel_values[pixel] = futures[pixel].result()
+    else:
+        for pixel, (args, kwargs) in snow_tasks.items():
+            pixel_values[pixel] = snow_pixel_values(*args, **kwargs)
+
+    for pixel, pixel_coords in pixel_sites.items():
+        coord = pixel_coords[0]
+        sites = [x[0] for x in pixel_coords]
+        out_values = pixel_values.get(pixel)
+
+        # Compare the S3 SNOW processor and snow_engine outputs
+        if (
+            engine == "validate"
+            and pixel in snow_tasks
+            and out_values
+            and validation_file
+        ):
+            write_validation(
+                validation_file,
+                prod.getName(),
+                sites,
+                out_values,
+                engine_values.get(coord[0], {}),
+            )
+
+        # Update the full dictionnary
+        if out_values is not None:
+            for site in sites:
+                if param_sets:
+                    stored_vals.update({site: [dict(x) for x in out_values]})
+                else:
+                    stored_vals.update({site: dict(out_values)})
 
     # Log if no sites are found in image
     if not stored_vals:
-        with open(str(errorfile), "a") as fd:
-            fd.write("%s: No sites in image.\n" % (prod.getName()))
+        event_log.log(prod.getName(), "no_sites", "No sites in image.")
 
-    # Garbage collector
-    prod.dispose()
+    # Garbage collector (cached products are disposed by the cache)
+    if products is None:
+        dispose_prod(prod)
 
     return stored_vals
 
 
 def getS3bands(
-    in_file, coords, band_names, errorfile, s3_instrument, slstr_res
+    in_file,
+    coords,
+    band_names,
+    event_log,
+    s3_instrument,
+    slstr_res,
+    timer=None,
+    products=None,
+    position_cache=None,
 ):
     """Extract data from Sentinel-3 bands.
 
@@ -631,9 +1891,15 @@ def getS3bands(
         in_file (str): Path to a S3 OLCI image xfdumanisfest.xml file.
         coords (list): List of coordinates to extract the data from.
         band_names (list): List of bands names to extract the data from.
-        errorfile (str): Path to the file where all errors are logged.
+        event_log (EventLog): Log of the processing failures.
         s3_instrument (str): Sentinel-3 instrument name (OLCI or SLSTR).
-        slstr_res (str): SLSTR reader resolution (500m or 1km).
+        slstr_res (str): SLSTR reader resolution (500 or 1000). If "auto",
+            each band is read with the reader of its grid.
+        timer (StageTimer): Accumulates the time spent in each stage.
+        products (ProductCache): Cache of open products to get the product
+            from. If None, the product is opened for this extraction only.
+        position_cache (PixelPositionCache): Cache of the pixel positions of
+            the sites, reused for the scenes of the same ground track.
 
     Returns:
         (dict): Dictionnary containing the band names and values for all
@@ -642,18 +1908,71 @@ def getS3bands(
     # Make a dictionnary to store results
     stored_vals = {}
 
+    # For SLSTR, route each band to the reader of its grid: the scene is
+    # opened once per grid, and the values of both grids are merged. Bands
+    # that aren't on a given grid (TiePointGrids) are read on the 500m grid.
+    if s3_instrument == "SLSTR" and slstr_res == "auto":
+        grid_bands = {}
+        for band in band_names:
+            grid = slstr_band_grid(band) or "500"
+            grid_bands.setdefault(grid, []).append(band)
+
+        for grid in sorted(grid_bands):
+            grid_vals = getS3bands(
+                in_file,
+                coords,
+                grid_bands[grid],
+                event_log,
+                s3_instrument,
+                grid,
+                timer=timer,
+                products=products,
+                position_cache=position_cache,
+            )
+            for site in grid_vals:
+                stored_vals.setdefault(site, {}).update(grid_vals[site])
+
+        # A site can be valid on one grid only (e.g. near the scene edge):
+        # keep the same columns for all sites
+        for site in stored_vals:
+            for band in band_names:
+                stored_vals[site].setdefault(band, None)
+
+        return stored_vals
+
+    # Time the processing stages (discarded if no timer is provided)
+    if timer is None:
+        timer = StageTimer()
+
     # Open SNAP product
-    prod = open_prod(in_file, s3_instrument, slstr_res)
+    with timer.stage("open"):
+        if products is None:
+            prod = open_prod(in_file, s3_instrument, slstr_res)
+        else:
+            prod = products.get(in_file, s3_instrument, slstr_res)
+
+    # Check if data exists at the queried locations
+    # Transform lat/lon to position to x, y in scene
+    pixels = site_pixels(
+        prod,
+        coords,
+        position_cache,
+        track_key(Path(in_file).parent.name, slstr_res)
+        if position_cache is not None
+        else None,
+    )
+
+    # Decode the requested masks for all sites at once
+    mask_group_names = list(prod.getMaskGroup().getNodeNames())
+    site_masks = decode_masks(
+        prod, pixels, [x for x in band_names if x in mask_group_names]
+    )
 
     # Loop over coordinates to extract values.
     for coord in coords:
 
-        # Check if data exists at the queried location
-        # Transform lat/lon to position to x, y in scene
-        xx, yy = pixel_position(prod, coord[1], coord[2])
-
         # Log if location is outside of file
-        if not xx or not yy:
+        if coord[0] not in pixels:
             pass
 
         else:
@@ -662,26 +1981,32 @@ def getS3bands(
             # Doesn't process if the coordinates pair is not in the product.
             if s3_instrument == "OLCI":
                 try:
-                    prod_subset, pix_coords = subset(prod, coord[1], coord[2])
+                    with timer.stage("subset"):
+                        prod_subset, pix_coords = subset(
+                            prod, coord[1], coord[2]
+                        )
                     process_flag = True  # Set a flag to process data
 
                 except:  # Bare except needed to catch the JAVA exception
-                    with open(str(errorfile), "a") as fd:
-                        fd.write(
-                            "%s, %s: Unable to subset around coordinates.\n"
-                            % (prod.getName(), coord[0])
-                        )
-                        prod_subset = None
+                    event_log.log(
+                        prod.getName(),
+                        "snap_error",
+                        "Unable to subset around coordinates.",
+                        [coord[0]],
+                        "subset",
+                    )
+                    prod_subset = None
 
                 if not prod_subset or pix_coords[0] is None:
                     process_flag = False  # None to stop processing
 
-                    with open(str(errorfile), "a") as fd:  # Log error
-                        fd.write(
-                            "%s, %s: Unable to subset,"
-                            " too close to the edge.\n"
-                            % (prod.getName(), coord[0])
-                        )
+                    event_log.log(
+                        prod.getName(),
+                        "edge",
+                        "Unable to subset, too close to the edge.",
+                        [coord[0]],
+                        "subset",
+                    )
             else:
                 # If SLSTR, open full image: because of the bands at different
                 # resolutions, a resampling would be necessary before being
@@ -689,7 +2014,7 @@ def getS3bands(
                 prod_subset = prod
                 process_flag = True
                 # As th entire scene is used, set pix_coords to xx, yy
-                pix_coords = xx, yy
+                pix_coords = pixels[coord[0]]
 
             if process_flag:  # Run the processing if OLCI subset exists
                 # Before the processing, the validity of the opened product is
@@ -717,15 +2042,18 @@ def getS3bands(
                     processing = True
 
                 except:  # Bare except needed to catch the JAVA exception
-                    with open(str(errorfile), "a") as fd:
-                        fd.write(
-                            "%s, %s: Invalid pixel.\n"
-                            % (prod_subset.getName(), coord[0])
-                        )
+                    event_log.log(
+                        prod.getName(),
+                        "invalid_pixel",
+                        "Invalid pixel.",
+                        [coord[0]],
+                        "bands",
+                    )
                     processing = False  # Deactivate processing
 
                 if processing:
                     out_values = {}  # Initialise outvalues
+                    timer_start = time.time()
 
                     # Extract bands from product
                     for band in band_names:
@@ -755,14 +2083,9 @@ def getS3bands(
                             )
 
                         # If not if TiePointGrid list try from Masks
-                        elif band in list(
-                            prod_subset.getMaskGroup().getNodeNames()
-                        ):
-                            currentmask = prod_subset.getMaskGroup().get(band)
-                            currentmask_asmask = jpy.cast(currentmask, Mask)
-                            out_values[band] = currentmask_asmask.getSampleInt(
-                                pix_coords[0], pix_coords[1]
-                            )
+                        # (decoded for all sites before the loop)
+                        elif band in site_masks[coord[0]]:
+                            out_values[band] = site_masks[coord[0]][band]
 
                         else:
                             # Capture error
@@ -771,6 +2094,8 @@ def getS3bands(
                                 % (band, prod.getName())
                             )
 
+                    timer.add("bands", time.time() - timer_start)
+
                     # Update the full dictionnary
                     stored_vals.update({coord[0]: out_values})
 
@@ -779,10 +2104,10 @@ def getS3bands(
 
     # Log if no sites are found in image
     if not stored_vals:
-        with open(str(errorfile), "a") as fd:
-            fd.write("%s: No sites in image.\n" % (prod.getName()))
+        event_log.log(prod.getName(), "no_sites", "No sites in image.")
 
-    # Garbage collector
-    prod = None
+    # Garbage collector (cached products are disposed by the cache)
+    if products is None:
+        dispose_prod(prod)
 
     return stored_vals
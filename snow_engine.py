@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized retrieval of the clean snow properties from OLCI bottom of
+Rayleigh reflectances (rBRR), following the asymptotic radiative transfer
+theory used by the S3 SNOW processor (Kokhanovsky et al., 2018, 2019).
+The retrieval is run for an array of spectra at once (no SNAP required).
+"""
+import numpy as np
+
+# Central wavelengths of the 21 OLCI bands (nm)
+OLCI_WAVELENGTHS = np.array(
+    [
+        400.0,
+        412.5,
+        442.5,
+        490.0,
+        510.0,
+        560.0,
+        620.0,
+        665.0,
+        673.75,
+        681.25,
+        708.75,
+        753.75,
+        761.25,
+        764.375,
+        767.5,
+        778.75,
+        865.0,
+        885.0,
+        900.0,
+        940.0,
+        1020.0,
+    ]
+)
+
+# Imaginary part of the ice refractive index at the OLCI wavelengths
+ICE_CHI = np.array(
+    [
+        2.365e-11,
+        2.7042e-11,
+        7.0e-11,
+        4.17e-10,
+        8.04e-10,
+        2.84e-09,
+        8.58e-09,
+        1.78e-08,
+        1.95e-08,
+        2.1e-08,
+        3.3e-08,
+        6.23e-08,
+        7.1e-08,
+        7.68e-08,
+        8.13e-08,
+        9.88e-08,
+        2.4e-07,
+        3.64e-07,
+        4.2e-07,
+        5.53e-07,
+        2.25e-06,
+    ]
+)
+
+# Bulk ice absorption coefficient at the OLCI wavelengths (1/mm)
+ICE_ALPHA = 4.0 * np.pi * ICE_CHI / (OLCI_WAVELENGTHS * 1e-6)
+
+# Vicarious calibration gains of bands 1, 5, 17 and 21 (0-based index: gain)
+OLCI_GAINS = {0: 0.9798, 4: 0.9892, 16: 1.0, 20: 0.914}
+
+# Ice density (g/cm3)
+ICE_DENSITY = 0.917
+
+# Coefficients of the reflectance of a semi-infinite non-absorbing snow layer
+R0_COEFFS = (1.247, 1.186, 5.157)
+
+# Visible range of the broadband albedo (nm)
+VIS_RANGE = (400.0, 700.0)
+
+# Name of the spectral planar albedo outputs, as the S3 SNOW processor bands
+# (wavelength in nm, truncated to an integer)
+SPECTRAL_PLANAR_NAME = "albedo_spectral_planar_%d"
+
+
+def check_outputs(variables, pollution_flag=False):
+    """Check that the retrieval computes the requested S3 SNOW outputs.
+
+    The near infrared and shortwave broadband albedos aren't computed (only
+    the visible ones), and the properties of polluted snow aren't retrieved
+    (the polluted pixels are only flagged).
+
+    Args:
+        variables (list): Selected S3 SNOW variables (see\
+                          output_utils.SNOW_VARIABLES), all if None
+        pollution_flag (bool): S3 SNOW dirty snow option
+
+    Raises:
+        ValueError: some of the requested outputs aren't computed
+    """
+    if pollution_flag:
+        raise ValueError(
+            "The numpy engine doesn't retrieve the properties of polluted"
+            " snow: use the snap engine with the pollution option."
+        )
+
+    if variables is None or "albedo_bb" in variables:
+        raise ValueError(
+            "The numpy engine doesn't compute the near infrared and"
+            " shortwave broadband albedos: use the snap engine, or select"
+            " the variables without albedo_bb."
+        )
+
+
+def escape_function(mu):
+    """Escape function of a semi-infinite snow layer.
+
+    Args:
+        mu (numpy.ndarray): cosine of the solar or viewing zenith angle
+
+    Returns:
+        (numpy.ndarray): escape function u(mu)
+    """
+    return 3.0 / 7.0 * (1.0 + 2.0 * mu)
+
+
+def scattering_angle(sza, vza, saa, vaa):
+    """Get the scattering angle.
+
+    Args:
+        sza (numpy.ndarray): solar zenith angle (degrees)
+        vza (numpy.ndarray): viewing zenith angle (degrees)
+        saa (numpy.ndarray): solar azimuth angle (degrees)
+        vaa (numpy.ndarray): viewing azimuth angle (degrees)
+
+    Returns:
+        (numpy.ndarray): scattering angle (degrees)
+    """
+    sza, vza = np.radians(sza), np.radians(vza)
+    raa = np.radians(np.abs(np.asarray(saa) - np.asarray(vaa)))
+
+    cos_theta = -np.cos(sza) * np.cos(vza) + np.sin(sza) * np.sin(
+        vza
+    ) * np.cos(raa)
+
+    return np.degrees(np.arccos(np.clip(cos_theta, -1.0, 1.0)))
+
+
+def phase_function(theta):
+    """Phase function of the snow grains.
+
+    Args:
+        theta (numpy.ndarray): scattering angle (degrees)
+
+    Returns:
+        (numpy.ndarray): phase function p(theta)
+    """
+    return 11.1 * np.exp(-0.087 * theta) + 1.1 * np.exp(-0.014 * theta)
+
+
+def non_absorbing_reflectance(mu0, mu, theta):
+    """Reflectance of a semi-infinite non-absorbing snow layer.
+
+    Args:
+        mu0 (numpy.ndarray): cosine of the solar zenith angle
+        mu (numpy.ndarray): cosine of the viewing zenith angle
+        theta (numpy.ndarray): scattering angle (degrees)
+
+    Returns:
+        (numpy.ndarray): geometric reflectance R0
+    """
+    a, b, c = R0_COEFFS
+
+    return (a + b * (mu0 + mu) + c * mu0 * mu + phase_function(theta)) / (
+        4.0 * (mu0 + mu)
+    )
+
+
+def solar_weights(wavelengths):
+    """Relative solar spectral irradiance at the given wavelengths.
+
+    The solar spectrum is approximated by a black body at 5777 K.
+
+    Args:
+        wavelengths (numpy.ndarray): wavelengths (nm)
+
+    Returns:
+        (numpy.ndarray): relative irradiance
+    """
+    lam = wavelengths * 1e-9
+    h, c, k = 6.626e-34, 2.998e8, 1.381e-23
+
+    return 1.0 / (lam ** 5 * (np.exp(h * c / (lam * k * 5777.0)) - 1.0))
+
+
+def broadband_albedo(spectral_albedo, wavelengths, band_range):
+    """Integrate spectral albedos weighted by the solar irradiance.
+
+    Args:
+        spectral_albedo (numpy.ndarray): albedos (sites x wavelengths)
+        wavelengths (numpy.ndarray): wavelengths of the albedos (nm)
+        band_range (tuple): wavelength range of the integration (nm)
+
+    Returns:
+        (numpy.ndarray): broadband albedo of each site
+    """
+    grid = np.linspace(band_range[0], band_range[1], 301)
+    albedo = np.array(
+        [np.interp(grid, wavelengths, x) for x in spectral_albedo]
+    ).reshape(-1, grid.size)
+
+    # Trapezoidal integration on the regular grid
+    weights = solar_weights(grid)
+    weights[[0, -1]] /= 2.0
+
+    return (albedo * weights).sum(axis=1) / weights.sum()
+
+
+def retrieve(
+    brr,
+    sza,
+    vza,
+    saa,
+    vaa,
+    pollution_flag=False,
+    pollution_delta=0.1,
+    gains=False,
+    ref_wvl=1020.0,
+    ndsi_flag=False,
+    ndsi_thres=0.03,
+):
+    """Retrieve the clean snow properties.
+
+    The reflectance of the non-absorbing snow layer R0 and the effective
+    absorption length L are retrieved from the 865 nm band and the reference
+    band, assuming R = R0 exp(-u(mu0) u(mu) sqrt(alpha L) / R0). The grain
+    diameter, specific surface area and the spherical and planar albedos
+    follow from L.
+
+    Args:
+        brr (numpy.ndarray): rBRR of the 21 OLCI bands (sites x 21)
+        sza (numpy.ndarray): solar zenith angle of each site (degrees)
+        vza (numpy.ndarray): viewing zenith angle of each site (degrees)
+        saa (numpy.ndarray): solar azimuth angle of each site (degrees)
+        vaa (numpy.ndarray): viewing azimuth angle of each site (degrees)
+        pollution_flag (bool): Flag the polluted snow pixels
+        pollution_delta (float): Maximum difference between the measured and\
+                                 the clean snow reflectance at 400 nm for the\
+                                 snow to be clean
+        gains (bool): Apply the OLCI vicarious calibration gains
+        ref_wvl (float): Reference wavelength of the retrieval (nm), not in\
+                         the 865 nm band
+        ndsi_flag (bool): Only retrieve the properties of the pixels with a\
+                          NDSI above the threshold
+        ndsi_thres (float): NDSI threshold
+
+    Returns:
+        (dict): arrays of the outputs, named as the S3 SNOW processor bands.\
+                The outputs of the polluted or snow free pixels are NaN.
+    """
+    brr = np.atleast_2d(np.asarray(brr, dtype=float)).copy()
+    sza, vza, saa, vaa = [
+        np.atleast_1d(np.asarray(x, dtype=float)) for x in (sza, vza, saa, vaa)
+    ]
+    mu0 = np.cos(np.radians(sza))
+    mu = np.cos(np.radians(vza))
+    theta = scattering_angle(sza, vza, saa, vaa)
+
+    if gains:
+        for band, gain in OLCI_GAINS.items():
+            brr[:, band] *= gain
+
+    ref = int(np.argmin(np.abs(OLCI_WAVELENGTHS - ref_wvl)))
+    nir = 16  # 865 nm
+
+    # R0 can't be retrieved with the 865 nm band as the reference
+    if ref == nir:
+        raise ValueError(
+            "The reference wavelength (%s nm) can't be the 865 nm band."
+            % ref_wvl
+        )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Snow indexes
+        ndsi = (brr[:, nir] - brr[:, 20]) / (brr[:, nir] + brr[:, 20])
+        ndbi = (brr[:, 0] - brr[:, 20]) / (brr[:, 0] + brr[:, 20])
+
+        # R0 from the 865 nm and reference bands
+        eps = np.sqrt(ICE_ALPHA[nir] / ICE_ALPHA[ref])
+        r0 = brr[:, nir] ** (1.0 / (1.0 - eps)) * brr[:, ref] ** (
+            -eps / (1.0 - eps)
+        )
+
+        # Effective absorption length (mm)
+        f = escape_function(mu0) * escape_function(mu) / r0
+        length = np.log(brr[:, ref] / r0) ** 2 / (f ** 2 * ICE_ALPHA[ref])
+
+        # Grain diameter (mm) and specific surface area (m2/kg)
+        diameter = length / (9.2 * 16.0 / 9.0)
+        ssa = 6.0 / (ICE_DENSITY * diameter)
+
+        # Spherical and planar albedos
+        spherical = np.exp(-np.sqrt(np.outer(length, ICE_ALPHA)))
+        planar = spherical ** escape_function(mu0)[:, np.newaxis]
+
+    # Pixels where the retrieval isn't valid
+    invalid = ~np.isfinite(length) | (length <= 0)
+    if ndsi_flag:
+        invalid |= ndsi < ndsi_thres
+    if pollution_flag:
+        # Modelled clean snow reflectance at 400 nm
+        r0_clean = non_absorbing_reflectance(mu0, mu, theta)
+        clean = r0_clean * spherical[:, 0] ** (
+            escape_function(mu0) * escape_function(mu) / r0_clean
+        )
+        invalid |= np.abs(brr[:, 0] - clean) > pollution_delta
+
+    diameter[invalid] = np.nan
+    ssa[invalid] = np.nan
+    spherical[invalid] = np.nan
+    planar[invalid] = np.nan
+
+    outputs = {
+        "grain_diameter": diameter,
+        "snow_specific_area": ssa,
+        "ndsi": ndsi,
+        "ndbi": ndbi,
+        "albedo_bb_planar_vis": broadband_albedo(
+            planar, OLCI_WAVELENGTHS, VIS_RANGE
+        ),
+        "albedo_bb_spherical_vis": broadband_albedo(
+            spherical, OLCI_WAVELENGTHS, VIS_RANGE
+        ),
+    }
+    for i, wvl in enumerate(OLCI_WAVELENGTHS):
+        outputs[SPECTRAL_PLANAR_NAME % wvl] = planar[:, i]
+        outputs["rBRR_%02d" % (i + 1)] = brr[:, i]
+
+    return outputs
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Tests of the output file functions of output_utils."""
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    pyarrow = None
+
+DT_VALUES = {
+    "year": 2019,
+    "month": 1,
+    "hour": 10,
+    "minute": 5,
+    "second": 0,
+    "platform": 0,
+}
+
+
+@unittest.skipIf(pd is None, "pandas isn't installed")
+class SortColumnsTest(unittest.TestCase):
+    def test_sort_snow_columns(self):
+        from output_utils import DT_COLUMNS, sort_snow_columns
+
+        temp_df = pd.DataFrame(
+            columns=[
+                "rBRR_10",
+                "albedo_spectral_planar_400",
+                "rBRR_02",
+                "albedo_bb_planar_vis",
+                "Oa10_reflectance",
+                "Oa02_reflectance",
+            ]
+        )
+        columns = sort_snow_columns(temp_df, False)
+
+        self.assertEqual(columns[: len(DT_COLUMNS)], DT_COLUMNS)
+        self.assertEqual(
+            columns[-6:],
+            [
+                "albedo_bb_planar_vis",
+                "Oa02_reflectance",
+                "Oa10_reflectance",
+                "rBRR_02",
+                "rBRR_10",
+                "albedo_spectral_planar_400",
+            ],
+        )
+        self.assertNotIn("altitude", columns)
+
+    def test_sort_snow_columns_options(self):
+        from output_utils import DEM_COLUMNS, DT_COLUMNS, sort_snow_columns
+
+        temp_df = pd.DataFrame(columns=["param_set", "ndsi"])
+        columns = sort_snow_columns(temp_df, True, ["ndsi"])
+
+        # Parameter set after the date, DEM columns, unselected variables
+        # left out
+        self.assertEqual(columns[len(DT_COLUMNS)], "param_set")
+        self.assertEqual(columns[-len(DEM_COLUMNS):], DEM_COLUMNS)
+        self.assertIn("ndsi", columns)
+        self.assertIn("sza", columns)
+        self.assertNotIn("grain_diameter", columns)
+
+    def test_sort_band_columns(self):
+        from output_utils import DT_COLUMNS, sort_band_columns
+
+        temp_df = pd.DataFrame(
+            columns=["Oa10_radiance", "year", "Oa2_radiance", "SZA"]
+        )
+
+        self.assertEqual(
+            sort_band_columns(temp_df),
+            DT_COLUMNS + ["Oa2_radiance", "Oa10_radiance", "SZA"],
+        )
+
+
+@unittest.skipIf(pd is None, "pandas isn't installed")
+class FinalizeSiteTest(unittest.TestCase):
+    def setUp(self):
+        self.out_fold = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.out_fold))
+
+    def test_no_temporary_file(self):
+        from output_utils import finalize_site
+
+        self.assertIsNone(finalize_site(self.out_fold, "site", "bands"))
+
+    def test_finalize_bands(self):
+        from output_utils import DT_COLUMNS, finalize_site
+
+        rows = [
+            dict(DT_VALUES, day=x, dayofyear=x, Oa10_radiance=x, SZA=50)
+            for x in (3, 1, 2)
+        ]
+        pd.DataFrame(rows).to_csv(
+            str(self.out_fold / "site_tmp.csv"), index=False
+        )
+
+        self.assertEqual(
+            finalize_site(self.out_fold, "site", "bands"), "site"
+        )
+        self.assertFalse((self.out_fold / "site_tmp.csv").is_file())
+
+        site_df = pd.read_csv(str(self.out_fold / "site.csv"))
+        self.assertEqual(
+            list(site_df.columns), DT_COLUMNS + ["Oa10_radiance", "SZA"]
+        )
+        self.assertEqual(list(site_df["day"]), [1, 2, 3])
+        self.assertEqual(list(site_df["Oa10_radiance"]), [1, 2, 3])
+
+    def test_finalize_snow(self):
+        from output_utils import finalize_site
+
+        # A site with only cloudy rows (cloud flag and geometry)
+        rows = [
+            dict(DT_VALUES, day=x, dayofyear=x, auto_cloud=1, sza=50)
+            for x in (2, 1)
+        ]
+        pd.DataFrame(rows).to_csv(
+            str(self.out_fold / "site_tmp.csv"), index=False
+        )
+        finalize_site(self.out_fold, "site", "snow")
+
+        with open(str(self.out_fold / "site.csv"), "r") as f:
+            lines = f.read().splitlines()
+
+        header = lines[0].split(",")
+        self.assertIn("grain_diameter", header)
+        first = dict(zip(header, lines[1].split(",")))
+        self.assertEqual(first["day"], "1")
+        self.assertEqual(first["grain_diameter"], "-999")
+        self.assertEqual(first["auto_cloud"], "1")
+
+
+@unittest.skipIf(pd is None, "pandas isn't installed")
+class AppendSiteCsvTest(unittest.TestCase):
+    def setUp(self):
+        self.out_fold = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.out_fold))
+
+    def test_new_columns(self):
+        from output_utils import append_site_csv
+
+        output_file = self.out_fold / "site_tmp.csv"
+        for row in ({"a": 0.1, "b": 0.2}, {"b": 0.3}, {"c": 0.4, "a": 0.5}):
+            append_site_csv(output_file, pd.DataFrame([row]), "NA")
+
+        # The rows are aligned to the header, extended with the new columns
+        with open(str(output_file), "r") as f:
+            lines = f.read().splitlines()
+
+        self.assertEqual(
+            lines, ["a,b,c", "0.1,0.2,NA", "NA,0.3,NA", "0.5,NA,0.4"]
+        )
+
+
+@unittest.skipIf(pd is None or pyarrow is None, "pyarrow isn't installed")
+class ReadSiteTest(unittest.TestCase):
+    def setUp(self):
+        self.dataset_fold = Path(tempfile.mkdtemp()) / "dataset"
+
+    def tearDown(self):
+        shutil.rmtree(str(self.dataset_fold.parent))
+
+    def write(self, rows):
+        from output_utils import PartitionedWriter
+
+        writer = PartitionedWriter(self.dataset_fold, 4, buffer_rows=2)
+        for site, day, values in rows:
+            writer.add(site, datetime(2019, 1, day, 10), 0, values)
+        writer.close()
+
+    def test_read_site(self):
+        from output_utils import read_site
+
+        self.write(
+            [
+                ("site_a", 2, {"ndsi": 0.2, "ndbi": float("nan")}),
+                ("site_a", 1, {"ndsi": 0.1, "ndbi": float("nan")}),
+                ("site_b", 1, {"ndsi": 0.9, "grain_diameter": 0.3}),
+            ]
+        )
+        site_df = read_site(self.dataset_fold, "site_a")
+
+        # All the variables of the dataset, even without values for the site
+        self.assertEqual(
+            list(site_df.columns),
+            ["dt", "platform", "grain_diameter", "ndbi", "ndsi"],
+        )
+        self.assertEqual(list(site_df["ndsi"]), [0.1, 0.2])
+        self.assertTrue(site_df["grain_diameter"].isnull().all())
+
+        long_df = read_site(self.dataset_fold, "site_b", wide=False)
+        self.assertEqual(len(long_df), 2)
+        self.assertEqual(set(long_df["site"]), {"site_b"})
+
+    def test_duplicates(self):
+        from output_utils import read_site
+
+        # A scene processed again: the last values written are kept
+        self.write([("site_a", 1, {"ndsi": 0.1})])
+        self.write([("site_a", 1, {"ndsi": 0.5})])
+        site_df = read_site(self.dataset_fold, "site_a")
+
+        self.assertEqual(list(site_df["ndsi"]), [0.5])
+        self.assertEqual(
+            len(read_site(self.dataset_fold, "site_a", wide=False)), 2
+        )
+
+    def test_missing_site(self):
+        from output_utils import read_site
+
+        self.write([("site_a", 1, {"ndsi": 0.1})])
+        site_df = read_site(self.dataset_fold, "site_c")
+
+        self.assertTrue(site_df.empty)
+        self.assertEqual(list(site_df.columns), ["dt", "platform", "ndsi"])
+
+
+if __name__ == "__main__":
+    unittest.main()
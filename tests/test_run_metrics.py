@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Tests of the run monitoring helpers of run_metrics."""
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from run_metrics import (  # noqa: E402
+    EventLog,
+    format_duration,
+    prometheus_labels,
+    read_events,
+)
+
+
+class EventLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_fold = Path(tempfile.mkdtemp())
+        self.log_file = self.tmp_fold / "failed_log.jsonl"
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmp_fold))
+
+    def test_log(self):
+        event_log = EventLog(self.log_file)
+        event_log.log("scene", "invalid_pixel", "Invalid.", ["a", "b"], "mask")
+        event_log.log("scene", "timeout", "Timed out.", duration=60.0)
+
+        # Buffered until flushed
+        self.assertFalse(self.log_file.is_file())
+        self.assertEqual(event_log.counts, {"invalid_pixel": 2, "timeout": 1})
+
+        event_log.flush()
+        events = read_events(self.log_file)
+
+        self.assertEqual([x["site"] for x in events], ["a", "b", None])
+        self.assertEqual(events[0]["stage"], "mask")
+        self.assertEqual(events[0]["reason"], "invalid_pixel")
+        self.assertEqual(events[2]["duration"], 60.0)
+        self.assertIsNone(events[2]["stage"])
+
+    def test_buffer_size(self):
+        event_log = EventLog(self.log_file, buffer_size=2)
+        event_log.log("scene", "no_sites", "No sites.")
+        self.assertFalse(self.log_file.is_file())
+        event_log.log("scene", "no_sites", "No sites.")
+
+        self.assertEqual(len(read_events(self.log_file)), 2)
+        self.assertEqual(event_log.events, [])
+
+    def test_pickle(self):
+        # Sent to the scene_watchdog worker, with a new lock
+        event_log = EventLog(self.log_file)
+        event_log.log("scene", "no_sites", "No sites.")
+        copy = pickle.loads(pickle.dumps(event_log))
+        copy.log("scene", "no_sites", "No sites.")
+
+        self.assertEqual(copy.counts, {"no_sites": 2})
+        self.assertEqual(event_log.counts, {"no_sites": 1})
+
+    def test_read_events(self):
+        # The truncated line of a crashed run is skipped
+        event_log = EventLog(self.log_file)
+        event_log.log("scene", "no_sites", "No sites.")
+        event_log.flush()
+        with open(str(self.log_file), "a") as f:
+            f.write('{"scene": "trunc')
+
+        self.assertEqual(len(read_events(self.log_file)), 1)
+
+
+class FormatTest(unittest.TestCase):
+    def test_format_duration(self):
+        self.assertEqual(format_duration(None), "unknown")
+        self.assertEqual(format_duration(0), "0:00:00")
+        self.assertEqual(format_duration(59.6), "0:01:00")
+        self.assertEqual(format_duration(3725), "1:02:05")
+        self.assertEqual(format_duration(100 * 3600), "100:00:00")
+
+    def test_prometheus_labels(self):
+        self.assertEqual(prometheus_labels({}), "")
+        self.assertEqual(
+            prometheus_labels({"stage": "open", "output": 'a"b\\c'}),
+            '{output="a\\"b\\\\c",stage="open"}',
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
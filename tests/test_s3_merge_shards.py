@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Tests of the shard merge of s3_merge_shards."""
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+try:
+    import pandas  # noqa: F401
+except ImportError:
+    pandas = None
+
+HEADER = "year,month,day,hour,minute,second,dayofyear,platform"
+
+
+@unittest.skipIf(pandas is None, "pandas isn't installed")
+class MergeSiteFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_fold = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(str(self.tmp_fold))
+
+    def write(self, name, lines):
+        csv_file = self.tmp_fold / name
+        with open(str(csv_file), "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return csv_file
+
+    def test_merge(self):
+        from s3_merge_shards import merge_site_files
+
+        in_files = [
+            self.write(
+                "shard_1.csv",
+                [
+                    HEADER + ",ndsi",
+                    "2019,1,3,10,5,0,3,0,0.5000",
+                    "2019,1,1,10,5,0,1,1,0.1",
+                ],
+            ),
+            self.write(
+                "shard_2.csv",
+                [HEADER + ",ndsi,ndbi", "2019,1,2,10,5,0,2,0,-999,0.2"],
+            ),
+        ]
+        output_file = self.tmp_fold / "site.csv"
+        merge_site_files(in_files, output_file, "-999")
+
+        with open(str(output_file), "r") as f:
+            lines = f.read().splitlines()
+
+        # Sorted by date, the values written unchanged and the missing
+        # columns set to the no data value
+        self.assertEqual(
+            lines,
+            [
+                HEADER + ",ndsi,ndbi",
+                "2019,1,1,10,5,0,1,1,0.1,-999",
+                "2019,1,2,10,5,0,2,0,-999,0.2",
+                "2019,1,3,10,5,0,3,0,0.5000,-999",
+            ],
+        )
+
+    def test_is_site_file(self):
+        from s3_merge_shards import is_site_file
+
+        self.assertTrue(
+            is_site_file(self.write("site.csv", [HEADER + ",ndsi"]))
+        )
+        self.assertFalse(
+            is_site_file(
+                self.write("other.csv", ["scene,site,variable,snap,numpy"])
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
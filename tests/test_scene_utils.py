@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Tests of the scene sharding functions of scene_utils."""
+import sys
+import unittest
+from argparse import ArgumentTypeError
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from scene_utils import parse_shard, scene_shard, select_shard  # noqa: E402
+
+SCENES = [
+    "S3A_OL_1_EFR____20190101T%02d0000_20190101T%02d0300_20190102T150000"
+    "_0179_040_065_1800_LN1_O_NT_002.SEN3" % (x, x)
+    for x in range(24)
+]
+
+
+class ParseShardTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(parse_shard("2/4"), (2, 4))
+        self.assertEqual(parse_shard("1/1"), (1, 1))
+
+    def test_invalid(self):
+        for instring in ("2", "a/4", "0/4", "5/4", "1/0"):
+            with self.assertRaises(ArgumentTypeError):
+                parse_shard(instring)
+
+
+class SceneShardTest(unittest.TestCase):
+    def test_range(self):
+        for scene in SCENES:
+            self.assertIn(scene_shard(scene, 4), [1, 2, 3, 4])
+
+    def test_deterministic(self):
+        # The shard only depends on the scene name
+        self.assertEqual(
+            [scene_shard(x, 3) for x in SCENES],
+            [scene_shard(x, 3) for x in reversed(SCENES)][::-1],
+        )
+        self.assertEqual(scene_shard(SCENES[0], 1), 1)
+
+    def test_select_shard(self):
+        # Each scene is selected by a single shard
+        scenes = [Path("/archive") / x for x in SCENES]
+        shards = [select_shard(scenes, (x, 3)) for x in (1, 2, 3)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(scenes))
+        for shard, selected in enumerate(shards, 1):
+            for scene in selected:
+                self.assertEqual(scene_shard(scene.name, 3), shard)
+
+
+if __name__ == "__main__":
+    unittest.main()
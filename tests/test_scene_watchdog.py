@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Tests of the scene timeout and error handling of scene_watchdog."""
+import json
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from run_metrics import read_events  # noqa: E402
+from scene_watchdog import (  # noqa: E402
+    SceneRunner,
+    SceneTimeout,
+    SceneWatchdog,
+)
+
+
+class SceneWatchdogTest(unittest.TestCase):
+    def test_in_process(self):
+        watchdog = SceneWatchdog()
+
+        self.assertEqual(watchdog.call("json.loads", ("[1]",)), [1])
+        # The errors are reported as in the worker process
+        with self.assertRaises(RuntimeError):
+            watchdog.call("json.loads", ("{",))
+
+    def test_worker(self):
+        watchdog = SceneWatchdog(timeout=30)
+        try:
+            self.assertEqual(watchdog.call("json.loads", ("[1]",)), [1])
+            with self.assertRaises(RuntimeError):
+                watchdog.call("json.loads", ("{",))
+        finally:
+            watchdog.close()
+
+    def test_timeout(self):
+        watchdog = SceneWatchdog(timeout=1)
+        try:
+            with self.assertRaises(SceneTimeout):
+                watchdog.call("time.sleep", (10,))
+            # A new worker is started for the next call
+            self.assertEqual(watchdog.call("json.loads", ("[1]",)), [1])
+        finally:
+            watchdog.close()
+
+
+class SceneRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.out_fold = Path(tempfile.mkdtemp())
+        self.bad_scenes_file = self.out_fold / "bad_scenes.json"
+        self.sat_image = self.out_fold / "S3A_OL_1_EFR____scene.SEN3"
+
+    def tearDown(self):
+        shutil.rmtree(str(self.out_fold))
+
+    def runner(self, timeout=None):
+        return SceneRunner(
+            self.out_fold,
+            1,
+            self.out_fold / "timings.json",
+            timeout=timeout,
+            bad_scenes_file=self.bad_scenes_file,
+        )
+
+    def registered(self):
+        if not self.bad_scenes_file.is_file():
+            return {}
+        with open(str(self.bad_scenes_file), "r") as f:
+            return json.load(f)
+
+    def test_error_not_registered(self):
+        # The error can come from the options of the run, not the scene
+        runner = self.runner()
+        self.assertIsNone(runner.run(self.sat_image, "json.loads", ("{",)))
+        runner.close()
+
+        events = read_events(self.out_fold / "failed_log.jsonl")
+        self.assertEqual([x["reason"] for x in events], ["scene_error"])
+        self.assertEqual(self.registered(), {})
+
+    def test_timeout_registered(self):
+        runner = self.runner(timeout=1)
+        self.assertIsNone(runner.run(self.sat_image, "time.sleep", (10,)))
+        runner.close()
+
+        events = read_events(self.out_fold / "failed_log.jsonl")
+        self.assertEqual([x["reason"] for x in events], ["timeout"])
+        self.assertIn(self.sat_image.name, self.registered())
+
+        # Skipped in the next runs
+        runner = self.runner()
+        self.assertFalse(runner.start(self.sat_image))
+        runner.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Tests of the per-site caches of site_cache."""
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from site_cache import (  # noqa: E402
+    PixelPositionCache,
+    TerrainCache,
+    distance_m,
+)
+
+# Centre of a pixel, and a point about 100 m north of it
+LAT, LON = 58.0, 10.0
+LAT_100M = LAT + 100.0 / 111195.0
+
+
+class DistanceTest(unittest.TestCase):
+    def test_distance(self):
+        self.assertAlmostEqual(distance_m(0.0, 0.0, 1.0, 0.0), 111195, -1)
+        self.assertAlmostEqual(distance_m(LAT, LON, LAT_100M, LON), 100, 3)
+        self.assertEqual(distance_m(LAT, LON, LAT, LON), 0.0)
+
+
+class TerrainCacheTest(unittest.TestCase):
+    def test_tolerance(self):
+        cache = TerrainCache(tolerance=150.0)
+        cache.add("site", LAT, LON, {"altitude": 1000.0})
+
+        self.assertEqual(
+            cache.get("site", LAT_100M, LON), {"altitude": 1000.0}
+        )
+        self.assertIsNone(cache.get("other", LAT, LON))
+
+        # The tolerance of the cache overrides the one of the pixel
+        self.assertIsNotNone(cache.get("site", LAT_100M, LON, 50.0))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_pixel_tolerance(self):
+        # Without a cache tolerance, the one passed (pixel size) is used
+        cache = TerrainCache()
+        cache.add("site", LAT, LON, {"altitude": 1000.0})
+
+        self.assertIsNotNone(cache.get("site", LAT_100M, LON, 150.0))
+        self.assertIsNone(cache.get("site", LAT_100M, LON, 50.0))
+
+    def test_nearest(self):
+        cache = TerrainCache(tolerance=500.0)
+        cache.add("site", LAT, LON, {"altitude": 1.0})
+        cache.add("site", LAT_100M, LON, {"altitude": 2.0})
+
+        self.assertEqual(cache.get("site", LAT_100M, LON)["altitude"], 2.0)
+
+    def test_save(self):
+        tmp_fold = Path(tempfile.mkdtemp())
+        try:
+            cache = TerrainCache(tolerance=150.0)
+            cache.add("site", LAT, LON, {"altitude": 1000.0})
+            cache.save(tmp_fold / "terrain.json")
+            cache = TerrainCache(tmp_fold / "terrain.json", 150.0)
+        finally:
+            shutil.rmtree(str(tmp_fold))
+
+        self.assertIsNotNone(cache.get("site", LAT, LON))
+        # Picklable, to be sent to the scene_watchdog worker
+        self.assertIsNotNone(
+            pickle.loads(pickle.dumps(cache)).get("site", LAT, LON)
+        )
+
+
+class PixelPositionCacheTest(unittest.TestCase):
+    def test_get(self):
+        cache = PixelPositionCache()
+        cache.add("A_065_1800", "site", (120, 45))
+
+        self.assertEqual(cache.get("A_065_1800", "site"), (120, 45))
+        self.assertIsNone(cache.get("B_065_1800", "site"))
+        self.assertIsNone(cache.get("A_065_1800", "other"))
+
+
+if __name__ == "__main__":
+    unittest.main()
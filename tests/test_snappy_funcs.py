@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Tests of the snappy_funcs helpers that can run without SNAP."""
+import sys
+import types
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# snappy_funcs imports snappy when loaded: use a placeholder module if SNAP
+# isn't installed (the tested functions only call the objects passed to them)
+if "snappy" not in sys.modules:
+    try:
+        import snappy  # noqa: F401
+    except ImportError:
+        snappy = types.ModuleType("snappy")
+        for name in ("ProductIO", "GeoPos", "PixelPos", "HashMap", "GPF"):
+            setattr(snappy, name, None)
+        snappy.jpy = None
+        snappy.Mask = None
+        sys.modules["snappy"] = snappy
+
+import snappy_funcs  # noqa: E402
+
+
+class FakeTiePointGrid(object):
+    """Tie point grid whose value encodes the pixel position (x, y)."""
+
+    def readRasterDataFully(self):
+        pass
+
+    def getPixelFloat(self, x, y):
+        return 1000.0 * x + y
+
+
+class FakeProduct(object):
+    """Product with a single tie point grid."""
+
+    def getTiePointGrid(self, name):
+        return FakeTiePointGrid()
+
+
+class TiePointGridValueTest(unittest.TestCase):
+    def test_pixel_order(self):
+        # getPixelFloat takes the x position first, then y
+        value = snappy_funcs.getTiePointGrid_value(FakeProduct(), "SZA", 3, 7)
+        self.assertEqual(value, 3007.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
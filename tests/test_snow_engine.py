@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Tests of the vectorized snow properties retrieval of snow_engine."""
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import snow_engine  # noqa: E402
+
+
+def clean_snow_brr(length, r0, sza, vza):
+    """Reflectances of a clean snow layer, from the model of retrieve."""
+    mu0, mu = np.cos(np.radians(sza)), np.cos(np.radians(vza))
+    f = snow_engine.escape_function(mu0) * snow_engine.escape_function(mu)
+
+    return r0 * np.exp(-f / r0 * np.sqrt(snow_engine.ICE_ALPHA * length))
+
+
+class RetrieveTest(unittest.TestCase):
+    def setUp(self):
+        # Two sites, with absorption lengths of 0.2 and 0.8 mm
+        self.lengths = np.array([0.2, 0.8])
+        self.sza, self.vza = np.array([50.0, 60.0]), np.array([10.0, 20.0])
+        self.brr = np.array(
+            [
+                clean_snow_brr(x, 0.95, y, z)
+                for x, y, z in zip(self.lengths, self.sza, self.vza)
+            ]
+        )
+
+    def retrieve(self, brr, **kwargs):
+        return snow_engine.retrieve(
+            brr, self.sza, self.vza, [100.0, 100.0], [20.0, 20.0], **kwargs
+        )
+
+    def test_clean_snow(self):
+        outputs = self.retrieve(self.brr)
+
+        diameter = self.lengths / (9.2 * 16.0 / 9.0)
+        np.testing.assert_allclose(outputs["grain_diameter"], diameter)
+        np.testing.assert_allclose(
+            outputs["snow_specific_area"],
+            6.0 / (snow_engine.ICE_DENSITY * diameter),
+        )
+
+        # Planar albedo at 1020 nm
+        mu0 = np.cos(np.radians(self.sza))
+        spherical = np.exp(
+            -np.sqrt(self.lengths * snow_engine.ICE_ALPHA[20])
+        )
+        np.testing.assert_allclose(
+            outputs["albedo_spectral_planar_1020"],
+            spherical ** snow_engine.escape_function(mu0),
+        )
+
+        # Snow indexes and rBRR from the input reflectances
+        np.testing.assert_allclose(
+            outputs["ndsi"],
+            (self.brr[:, 16] - self.brr[:, 20])
+            / (self.brr[:, 16] + self.brr[:, 20]),
+        )
+        np.testing.assert_allclose(outputs["rBRR_01"], self.brr[:, 0])
+
+    def test_broadband_albedo(self):
+        outputs = self.retrieve(self.brr)
+
+        # Visible albedos of clean snow: high, lower for larger grains
+        for name in ("albedo_bb_planar_vis", "albedo_bb_spherical_vis"):
+            self.assertTrue(np.all(outputs[name] > 0.9))
+            self.assertTrue(np.all(outputs[name] <= 1.0))
+            self.assertGreater(outputs[name][0], outputs[name][1])
+
+    def test_spectral_names(self):
+        # Named as the S3 SNOW processor bands
+        outputs = self.retrieve(self.brr)
+
+        self.assertIn("albedo_spectral_planar_412", outputs)
+        self.assertIn("albedo_spectral_planar_1020", outputs)
+        self.assertIn("rBRR_21", outputs)
+
+    def test_invalid_pixels(self):
+        # No signal: the absorption length can't be retrieved
+        brr = self.brr.copy()
+        brr[1] = 0.0
+        outputs = self.retrieve(brr)
+
+        self.assertFalse(np.isnan(outputs["grain_diameter"][0]))
+        self.assertTrue(np.isnan(outputs["grain_diameter"][1]))
+        self.assertTrue(np.isnan(outputs["albedo_spectral_planar_400"][1]))
+
+    def test_ndsi_flag(self):
+        outputs = self.retrieve(self.brr, ndsi_flag=True, ndsi_thres=0.99)
+
+        self.assertTrue(np.all(np.isnan(outputs["grain_diameter"])))
+
+    def test_gains(self):
+        outputs = self.retrieve(self.brr, gains=True)
+
+        np.testing.assert_allclose(
+            outputs["rBRR_21"],
+            self.brr[:, 20] * snow_engine.OLCI_GAINS[20],
+        )
+
+    def test_reference_band(self):
+        with self.assertRaises(ValueError):
+            self.retrieve(self.brr, ref_wvl=865.0)
+
+
+class CheckOutputsTest(unittest.TestCase):
+    def test_check_outputs(self):
+        snow_engine.check_outputs(["grain_diameter", "spectral_planar"])
+
+        for variables in (None, ["ndsi", "albedo_bb"]):
+            with self.assertRaises(ValueError):
+                snow_engine.check_outputs(variables)
+
+        with self.assertRaises(ValueError):
+            snow_engine.check_outputs(["ndsi"], pollution_flag=True)
+
+
+if __name__ == "__main__":
+    unittest.main()